@@ -0,0 +1,479 @@
+"""Compares the MMEarth train loaders: ffcv.Loader, the no_ffcv DataLoader and raw h5 reads as upper bound.
+
+Example:
+    python -m benchmarks.data_loading --synthetic-sizes 1000 10000 --num-workers 0 4 8 --batch-sizes 64 256 \
+        --storages float32 int16 --out-file results.json
+    python -m benchmarks.data_loading --data-dir $MMEARTH_DIR --compare results.json
+
+Every configuration (backend x num_workers x batch size x storage x order x dataset) is measured --repeats times
+after --warmup-batches batches, the median is reported. Measured are:
+    samples/s: of --num-batches batches after the warmup.
+    first batch: seconds from creating the loader iterator to the first batch (worker start, prefetching).
+    peak RSS: maximum resident memory of the process and its loader workers together, shared pages (e.g., the
+        memory mapped beton file) are counted once per process.
+    read: bytes the process and its workers fetched from storage (/proc/<pid>/io read_bytes), 0 if everything
+        is served from the page cache. For cold reads drop the page cache between runs.
+
+The results are written as JSON together with the environment (host, cpus, versions, git commit). With --compare,
+the samples/s are compared to an earlier results file and configurations slower by more than --tolerance are
+reported as regressions.
+"""
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import threading
+import time
+from argparse import ArgumentParser
+from itertools import product
+from pathlib import Path
+from typing import Iterator, Union
+
+import h5py
+import numpy as np
+import torch
+
+from data.constants import INP_MODALITIES, MODALITIES_FULL, ori_input_size
+from data.mmearth_dataset import create_MMEearth_args, get_mmearth_dataloaders, read_rows
+from data.storage import SENTINEL2_STORAGE
+from data.synthetic import write_synthetic_mmearth
+
+BACKENDS = ["ffcv", "dataloader", "h5"]
+ORDERS = ["quasi_random", "sequential"]
+
+parser = ArgumentParser("MMEarth data loading benchmark")
+parser.add_argument(
+    "--data-dir",
+    type=Path,
+    nargs="+",
+    default=[],
+    help="Raw MMEarth dataset folders to benchmark (default: none).",
+)
+parser.add_argument(
+    "--synthetic-sizes",
+    type=int,
+    nargs="+",
+    default=[],
+    help="Sizes of synthetic datasets (see data.synthetic) to benchmark, written to the work dir once "
+    "(default: none).",
+)
+parser.add_argument(
+    "--image-size",
+    type=int,
+    default=ori_input_size,
+    help=f"Image size of the synthetic datasets (default: {ori_input_size}).",
+)
+parser.add_argument(
+    "--chunk-rows",
+    type=int,
+    default=64,
+    help="Number of samples per h5 chunk of the synthetic datasets (default: 64).",
+)
+parser.add_argument(
+    "--work-dir",
+    type=Path,
+    default=Path("benchmark_data"),
+    help="Folder for the synthetic datasets and the beton files (default: 'benchmark_data').",
+)
+parser.add_argument(
+    "--backends",
+    type=str,
+    nargs="+",
+    default=BACKENDS,
+    choices=BACKENDS,
+    help=f"Loaders to benchmark (default: {' '.join(BACKENDS)}).",
+)
+parser.add_argument(
+    "--num-workers", type=int, nargs="+", default=[4], help="Numbers of loader workers (default: 4)."
+)
+parser.add_argument(
+    "--batch-sizes", type=int, nargs="+", default=[128], help="Batch sizes (default: 128)."
+)
+parser.add_argument(
+    "--storages",
+    type=str,
+    nargs="+",
+    default=["float32"],
+    choices=SENTINEL2_STORAGE,
+    help="Sentinel-2 storage of the beton files, only for ffcv (default: float32).",
+)
+parser.add_argument(
+    "--orders",
+    type=str,
+    nargs="+",
+    default=ORDERS,
+    choices=ORDERS,
+    help="Sample orders: 'quasi_random' (the shuffled train loader) or 'sequential' (default: both).",
+)
+parser.add_argument(
+    "--target",
+    type=str,
+    default="biome",
+    help="Target modality loaded with the input, 'none' for the input only (default: 'biome').",
+)
+parser.add_argument(
+    "--num-batches",
+    type=int,
+    default=50,
+    help="Number of measured batches per run (default: 50).",
+)
+parser.add_argument(
+    "--warmup-batches",
+    type=int,
+    default=5,
+    help="Number of batches per run before the measurement starts (default: 5).",
+)
+parser.add_argument(
+    "--repeats", type=int, default=3, help="Number of runs per configuration (default: 3)."
+)
+parser.add_argument(
+    "--out-file",
+    type=Path,
+    default=None,
+    help="JSON file the results are written to (default: None).",
+)
+parser.add_argument(
+    "--compare",
+    type=Path,
+    default=None,
+    help="Results file of an earlier run to compare the samples/s with (default: None).",
+)
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.1,
+    help="Relative slowdown compared to --compare that is reported as regression (default: 0.1).",
+)
+
+
+def child_pids(pid: int) -> list[int]:
+    """All descendants of a process (e.g., DataLoader workers), from /proc/<pid>/task/<tid>/children."""
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", "r") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        return []
+    return children + [grandchild for child in children for grandchild in child_pids(child)]
+
+
+def read_proc(pid: int) -> Union[tuple[int, int], None]:
+    """(RSS, read bytes) of a process, None if the process is gone."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/io", "r") as f:
+            read_bytes = next(int(line.split()[1]) for line in f if line.startswith("read_bytes:"))
+    except (OSError, StopIteration):
+        return None
+    return rss, read_bytes
+
+
+class ResourceMonitor:
+    """Samples the RSS and read bytes of this process and its workers in a background thread."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.pid = os.getpid()
+        self.peak_rss = 0
+        # read bytes of every process seen, the workers start at 0
+        self._start_read = read_proc(self.pid)[1]
+        self._read = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        rss = 0
+        for pid in [self.pid, *child_pids(self.pid)]:
+            stats = read_proc(pid)
+            if stats is not None:
+                rss += stats[0]
+                self._read[pid] = stats[1]
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "ResourceMonitor":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+    @property
+    def read_bytes(self) -> int:
+        return sum(self._read.values()) - self._start_read
+
+
+def raw_h5_batches(data_dir: Path, batch_size: int, order: str, seed: int = 0) -> Iterator[tuple[np.ndarray]]:
+    """Raw sentinel2 rows of the train split, without normalization, in batches sorted by row."""
+    args = create_MMEearth_args(data_dir, INP_MODALITIES, None)
+    rows = np.asarray(args.tile_index.split("train"))
+    rng = np.random.default_rng(seed)
+    with h5py.File(args.data_path, "r") as f:
+        while True:
+            epoch_rows = rows if order == "sequential" else rng.permutation(rows)
+            for start in range(0, len(epoch_rows) - batch_size + 1, batch_size):
+                yield (read_rows(f["sentinel2"], np.sort(epoch_rows[start : start + batch_size])),)
+
+
+def get_loader(
+    backend: str,
+    data_dir: Path,
+    processed_dir: Path,
+    target_modality: Union[dict, None],
+    num_workers: int,
+    batch_size: int,
+    storage: str,
+    order: str,
+):
+    if backend == "h5":
+        return None
+    (loader, _) = get_mmearth_dataloaders(
+        data_dir,
+        processed_dir,
+        INP_MODALITIES,
+        target_modality,
+        num_workers,
+        batch_size,
+        ["train", "val"],
+        no_ffcv=backend == "dataloader",
+        storage=storage,
+        sequential=order == "sequential",
+    )
+    return loader
+
+
+def iterate(loader, data_dir: Path, batch_size: int, order: str) -> Iterator:
+    """Batches of the loader over as many epochs as needed."""
+    while True:
+        if loader is None:
+            yield from raw_h5_batches(data_dir, batch_size, order)
+        else:
+            yield from loader
+
+
+def run(
+    backend: str,
+    data_dir: Path,
+    processed_dir: Path,
+    target_modality: Union[dict, None],
+    num_workers: int,
+    batch_size: int,
+    storage: str,
+    order: str,
+    num_batches: int,
+    warmup_batches: int,
+) -> dict:
+    # creating the loader (and converting the beton file if needed) is not measured
+    loader = get_loader(
+        backend, data_dir, processed_dir, target_modality, num_workers, batch_size, storage, order
+    )
+    gc.collect()
+    with ResourceMonitor() as monitor:
+        start = time.perf_counter()
+        batches = iterate(loader, data_dir, batch_size, order)
+        next(batches)
+        first_batch = time.perf_counter() - start
+        for _ in range(warmup_batches):
+            next(batches)
+
+        num_samples = 0
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            num_samples += len(next(batches)[0])
+        duration = time.perf_counter() - start
+        batches.close()
+    # stops the workers before the next run
+    del batches, loader
+    gc.collect()
+
+    return {
+        "samples_per_s": num_samples / max(duration, 1e-9),
+        "first_batch_s": first_batch,
+        "peak_rss_mb": monitor.peak_rss / 1024**2,
+        "read_mb": monitor.read_bytes / 1024**2,
+    }
+
+
+def get_datasets(data_dirs: list[Path], synthetic_sizes: list[int], work_dir: Path, image_size: int, chunk_rows: int) -> dict:
+    """Name and folder of every dataset, synthetic datasets are written if they don't exist yet."""
+    datasets = {data_dir.name: data_dir for data_dir in data_dirs}
+    for size in synthetic_sizes:
+        data_dir = work_dir / f"synthetic_{size}_{image_size}px_{chunk_rows}rows"
+        if not (data_dir / "data_synthetic_band_stats.json").exists():
+            write_synthetic_mmearth(
+                data_dir, size, image_size=image_size, chunk_rows=chunk_rows, modalities=["sentinel2", "biome"]
+            )
+        datasets[data_dir.name] = data_dir
+    return datasets
+
+
+def configurations(
+    backends: list[str], num_workers: list[int], batch_sizes: list[int], storages: list[str], orders: list[str]
+) -> list[dict]:
+    """All combinations, without the ones that are the same for a backend (storage and workers only change some)."""
+    configs = []
+    for backend, workers, batch_size, storage, order in product(
+        backends, num_workers, batch_sizes, storages, orders
+    ):
+        if backend != "ffcv":
+            # the storage only exists in the beton files
+            storage = "float32" if backend == "dataloader" else "raw"
+        if backend == "h5":
+            # read in the main process
+            workers = 0
+        config = dict(
+            backend=backend, num_workers=workers, batch_size=batch_size, storage=storage, order=order
+        )
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import ffcv
+
+        ffcv_version = getattr(ffcv, "__version__", "unknown")
+    except ImportError:
+        ffcv_version = None
+    return {
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "h5py": h5py.__version__,
+        "ffcv": ffcv_version,
+        "commit": commit,
+    }
+
+
+def config_key(result: dict) -> tuple:
+    return tuple(
+        result[k] for k in ["dataset", "backend", "num_workers", "batch_size", "storage", "order"]
+    )
+
+
+def print_table(results: list[dict], baseline: dict = None):
+    columns = [
+        ("dataset", "dataset", 36, "{}"),
+        ("backend", "backend", 11, "{}"),
+        ("num_workers", "workers", 8, "{}"),
+        ("batch_size", "batch", 7, "{}"),
+        ("storage", "storage", 9, "{}"),
+        ("order", "order", 14, "{}"),
+        ("samples_per_s", "samples/s", 11, "{:.1f}"),
+        ("first_batch_s", "first [s]", 11, "{:.2f}"),
+        ("peak_rss_mb", "RSS [MB]", 10, "{:.0f}"),
+        ("read_mb", "read [MB]", 11, "{:.1f}"),
+    ]
+    header = "".join(f"{label:>{width}}" for _, label, width, _ in columns)
+    print(header + (f"{'vs base':>10}" if baseline else ""))
+    for result in results:
+        line = "".join(f"{fmt.format(result[name]):>{width}}" for name, _, width, fmt in columns)
+        if baseline:
+            base = baseline.get(config_key(result))
+            line += f"{result['samples_per_s'] / base['samples_per_s']:>9.2f}x" if base else f"{'-':>10}"
+        print(line)
+
+
+def main(
+    data_dir: list[Path],
+    synthetic_sizes: list[int],
+    image_size: int,
+    chunk_rows: int,
+    work_dir: Path,
+    backends: list[str],
+    num_workers: list[int],
+    batch_sizes: list[int],
+    storages: list[str],
+    orders: list[str],
+    target: str,
+    num_batches: int,
+    warmup_batches: int,
+    repeats: int,
+    out_file: Union[Path, None],
+    compare: Union[Path, None],
+    tolerance: float,
+) -> dict:
+    assert data_dir or synthetic_sizes, "give --data-dir and/or --synthetic-sizes"
+    (work_dir / "processed").mkdir(parents=True, exist_ok=True)
+    datasets = get_datasets(data_dir, synthetic_sizes, work_dir, image_size, chunk_rows)
+    target_modality = None if target == "none" else {target: MODALITIES_FULL[target]}
+
+    results = []
+    configs = configurations(backends, num_workers, batch_sizes, storages, orders)
+    for (dataset, dataset_dir), config in product(datasets.items(), configs):
+        runs = [
+            run(
+                data_dir=dataset_dir,
+                processed_dir=work_dir / "processed" / dataset,
+                target_modality=target_modality,
+                num_batches=num_batches,
+                warmup_batches=warmup_batches,
+                **config,
+            )
+            for _ in range(repeats)
+        ]
+        result = {"dataset": dataset, **config}
+        for metric in runs[0]:
+            result[metric] = statistics.median(r[metric] for r in runs)
+        # spread of the runs, to tell noise from regressions
+        result["samples_per_s_min"] = min(r["samples_per_s"] for r in runs)
+        result["samples_per_s_max"] = max(r["samples_per_s"] for r in runs)
+        results.append(result)
+        print(
+            f"{dataset} {config}: {result['samples_per_s']:.1f} samples/s, "
+            f"first batch {result['first_batch_s']:.2f}s"
+        )
+
+    report = {
+        "environment": environment(),
+        "settings": {
+            "target": target,
+            "num_batches": num_batches,
+            "warmup_batches": warmup_batches,
+            "repeats": repeats,
+        },
+        "results": results,
+    }
+    if out_file is not None:
+        with open(out_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+    baseline = None
+    if compare is not None:
+        with open(compare, "r") as f:
+            baseline = {config_key(r): r for r in json.load(f)["results"]}
+    print_table(results, baseline)
+    if baseline:
+        regressions = [
+            r
+            for r in results
+            if config_key(r) in baseline
+            and r["samples_per_s"] < (1 - tolerance) * baseline[config_key(r)]["samples_per_s"]
+        ]
+        for r in regressions:
+            print(f"regression: {config_key(r)} {baseline[config_key(r)]['samples_per_s']:.1f} -> "
+                  f"{r['samples_per_s']:.1f} samples/s")
+        report["regressions"] = [config_key(r) for r in regressions]
+    return report
+
+
+if __name__ == "__main__":
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,93 @@
+"""Compares the read throughput of a random sample order with the chunk aware shuffle of the no_ffcv path.
+
+Example:
+    python -m benchmarks.h5_sampling --data-dir $MMEARTH_DIR --num-batches 200
+
+Note that the OS page cache also caches the h5 file, for cold reads drop it between runs.
+"""
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import h5py
+import numpy as np
+from torch.utils.data import RandomSampler
+
+from data.constants import INP_MODALITIES, MMEARTH_DIR, MODALITIES_FULL
+from data.mmearth_dataset import (
+    CHUNK_SHUFFLE_WINDOW,
+    MMEarthDataset,
+    create_MMEearth_args,
+)
+from data.samplers import ChunkShuffleSampler, SortedBatchSampler, get_chunk_rows
+
+parser = ArgumentParser("MMEarth h5 sampling benchmark")
+parser.add_argument(
+    "--data-dir",
+    type=Path,
+    default=MMEARTH_DIR,
+    help="Path to the raw MMEarth dataset folder (default: MMEARTH_DIR).",
+)
+parser.add_argument(
+    "--batch-size", type=int, default=128, help="Batch size (default: 128)."
+)
+parser.add_argument(
+    "--num-batches",
+    type=int,
+    default=100,
+    help="Number of batches read per sample order (default: 100).",
+)
+parser.add_argument(
+    "--window",
+    type=int,
+    default=CHUNK_SHUFFLE_WINDOW,
+    help=f"Number of chunks shuffled together (default: {CHUNK_SHUFFLE_WINDOW}).",
+)
+
+
+def run(dataset: MMEarthDataset, batch_sampler, num_batches: int, chunk_rows: int) -> dict:
+    rows = np.asarray(dataset.indices)
+    n_samples, n_chunks = 0, []
+    start = time.perf_counter()
+    for i, batch in enumerate(batch_sampler):
+        if i >= num_batches:
+            break
+        dataset.__getitems__(batch)
+        n_samples += len(batch)
+        n_chunks.append(len(np.unique(rows[batch] // chunk_rows)))
+    duration = time.perf_counter() - start
+    return {
+        "samples/s": n_samples / duration,
+        # how well a batch is mixed, a random order touches (almost) batch size chunks
+        "chunks/batch": float(np.mean(n_chunks)),
+    }
+
+
+def main(data_dir: Path, batch_size: int, num_batches: int, window: int):
+    target_modality = {"biome": MODALITIES_FULL["biome"]}
+    args = create_MMEearth_args(data_dir, INP_MODALITIES, target_modality)
+    with h5py.File(args.data_path, "r") as f:
+        chunk_rows = get_chunk_rows(f["sentinel2"])
+    print(f"sentinel2 chunk rows: {chunk_rows}")
+
+    results = {}
+    for order in ["random", "chunk"]:
+        if order == "random":
+            dataset = MMEarthDataset(args, split="train")
+            sampler = RandomSampler(dataset)
+        else:
+            dataset = MMEarthDataset(args, split="train", cache_chunks=window)
+            sampler = ChunkShuffleSampler(dataset.indices, chunk_rows, window=window)
+        batch_sampler = SortedBatchSampler(
+            sampler, batch_size=batch_size, drop_last=True, rows=dataset.indices
+        )
+        results[order] = run(dataset, batch_sampler, num_batches, chunk_rows)
+
+    print(f"{'order':<10}{'samples/s':>12}{'chunks/batch':>15}")
+    for order, result in results.items():
+        print(f"{order:<10}{result['samples/s']:>12.1f}{result['chunks/batch']:>15.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    main(**vars(parser.parse_args()))
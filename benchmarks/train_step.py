@@ -0,0 +1,266 @@
+"""Benchmarks the pretraining step of every method on synthetic tensors, e.g., to size CPU machines.
+
+Example:
+    python -m benchmarks.train_step --methods simclr mae --backbones default resnet18 --batch-sizes 32 64 \
+        --threads 16 --out-file train_step.json
+
+Every method is built like in main.py and trained for --warmup-steps + --steps steps on one random batch of
+the --input-channel channels at the MMEarth image size, without data loading. For the last --steps steps the
+ThroughputProfiler (methods/profiler.py) measures the time of the augmentation (view creation), forward,
+backward and optimizer step. Reported are also the parameter count and the activation memory, the size of the
+tensors the forward saves for the backward, which grows with the batch size on top of the parameters,
+gradients and optimizer state.
+"""
+import json
+import os
+import platform
+from argparse import ArgumentParser
+from itertools import product
+from pathlib import Path
+from typing import Union
+
+import torch
+from pytorch_lightning import Callback, LightningModule, Trainer
+from torch import Tensor
+from torch.utils.data import DataLoader
+
+from data.constants import CLASSIFICATION_CLASSES, IN_MODALITIES, ori_input_size
+from main import METHODS
+from methods.profiler import PROFILER_PHASES, ThroughputProfiler
+
+# the schedulers warm up for 10 (amae: 40) epochs, max_steps ends the training long before
+BENCHMARK_EPOCHS = 100
+
+parser = ArgumentParser("Pretraining step benchmark")
+parser.add_argument(
+    "--methods",
+    type=str,
+    nargs="+",
+    default=list(METHODS),
+    choices=list(METHODS),
+    help="Methods to benchmark (default: all).",
+)
+parser.add_argument(
+    "--backbones",
+    type=str,
+    nargs="+",
+    default=["default"],
+    help="Encoder architectures, 'default' is the default of each method (default: 'default').",
+)
+parser.add_argument(
+    "--batch-sizes", type=int, nargs="+", default=[32], help="Batch sizes (default: 32)."
+)
+parser.add_argument(
+    "--input-channel",
+    "-i",
+    type=str,
+    default="all",
+    choices=list(IN_MODALITIES),
+    help="Input channels, like in main.py (default: 'all').",
+)
+parser.add_argument(
+    "--target",
+    "-t",
+    type=str,
+    default="biome",
+    help="Target of the online classifier, 'none' to train without it (default: 'biome').",
+)
+parser.add_argument(
+    "--image-size",
+    type=int,
+    default=ori_input_size,
+    help=f"Size of the input images, before the augmentation (default: {ori_input_size}).",
+)
+parser.add_argument(
+    "--warmup-steps",
+    type=int,
+    default=3,
+    help="Number of steps before the measurement starts (default: 3).",
+)
+parser.add_argument(
+    "--steps", type=int, default=10, help="Number of measured steps (default: 10)."
+)
+parser.add_argument(
+    "--precision",
+    type=str,
+    default="32-true",
+    help="Lightning precision (default: '32-true').",
+)
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=None,
+    help="Number of torch threads (default: torch default).",
+)
+parser.add_argument(
+    "--out-file",
+    type=Path,
+    default=None,
+    help="JSON file the results are written to (default: None).",
+)
+
+
+class ActivationMemory(Callback):
+    """Measures the tensors saved for the backward (without the parameters) during training_step."""
+
+    def __init__(self):
+        super().__init__()
+        self.peak_bytes = 0
+        self._hooks = None
+        self._storages = None
+        self._parameters = None
+
+    def _pack(self, tensor: Tensor) -> Tensor:
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self._parameters:
+            # views of the same tensor share the storage, count it once
+            self._storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def on_train_batch_start(
+        self, trainer: Trainer, pl_module: LightningModule, batch, batch_idx: int
+    ):
+        self._parameters = {p.untyped_storage().data_ptr() for p in pl_module.parameters()}
+        self._storages = {}
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda tensor: tensor)
+        self._hooks.__enter__()
+
+    def on_before_backward(self, trainer: Trainer, pl_module: LightningModule, loss):
+        if self._hooks is None:
+            return
+        self._hooks.__exit__(None, None, None)
+        self._hooks = None
+        self.peak_bytes = max(self.peak_bytes, sum(self._storages.values()))
+
+
+def run(
+    method: str,
+    backbone: str,
+    batch_size: int,
+    input_channel: str,
+    target: Union[str, None],
+    image_size: int,
+    warmup_steps: int,
+    steps: int,
+    precision: str,
+) -> dict:
+    in_channels = sum(len(bands) for bands in IN_MODALITIES[input_channel].values())
+    num_classes = CLASSIFICATION_CLASSES[target]
+    model = METHODS[method]["model"](
+        backbone=backbone,
+        batch_size_per_device=batch_size,
+        num_classes=num_classes,
+        in_channels=in_channels,
+        has_online_classifier=target is not None,
+        train_transform=METHODS[method]["transform"],
+    )
+
+    # the same batch in every step, the loader costs nothing
+    generator = torch.Generator().manual_seed(0)
+    batch = (
+        torch.randn(batch_size, in_channels, image_size, image_size, generator=generator),
+        torch.randint(max(num_classes, 1), (batch_size,), generator=generator),
+    )
+    profiler = ThroughputProfiler(every_n_steps=steps, skip_steps=warmup_steps)
+    activation_memory = ActivationMemory()
+    trainer = Trainer(
+        max_epochs=BENCHMARK_EPOCHS,
+        max_steps=warmup_steps + steps,
+        accelerator="cpu",
+        devices=1,
+        precision=precision,
+        callbacks=[profiler, activation_memory],
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        num_sanity_val_steps=0,
+    )
+    trainer.fit(model, DataLoader([batch] * (warmup_steps + steps), batch_size=None))
+    assert len(profiler.reports) == 1, f"{method} stopped after {trainer.global_step} steps"
+    report = profiler.reports[0]
+
+    # without the projection heads, decoders and the online classifier
+    backbone_parameters = sum(p.numel() for p in model.backbone.parameters())
+    parameters = sum(p.numel() for p in model.parameters())
+    trainable_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    return {
+        "backbone": model.default_backbone if backbone == "default" else backbone,
+        "samples_per_s": report["profiler/samples_per_s"],
+        "step_ms": sum(report[f"profiler/{phase}_ms"] for phase in PROFILER_PHASES),
+        **{f"{phase}_ms": report[f"profiler/{phase}_ms"] for phase in PROFILER_PHASES},
+        **{f"{phase}_fraction": report[f"profiler/{phase}_fraction"] for phase in PROFILER_PHASES},
+        "step_p90_ms": report["profiler/step_p90_ms"],
+        "parameters": parameters,
+        "trainable_parameters": trainable_parameters,
+        "backbone_parameters": backbone_parameters,
+        "parameter_mb": sum(p.numel() * p.element_size() for p in model.parameters()) / 1024**2,
+        "activation_mb": activation_memory.peak_bytes / 1024**2,
+    }
+
+
+def main(
+    methods: list[str],
+    backbones: list[str],
+    batch_sizes: list[int],
+    input_channel: str,
+    target: str,
+    image_size: int,
+    warmup_steps: int,
+    steps: int,
+    precision: str,
+    threads: Union[int, None],
+    out_file: Union[Path, None],
+) -> dict:
+    if threads is not None:
+        torch.set_num_threads(threads)
+    target = None if target.lower() == "none" else target
+
+    results = []
+    for method, backbone, batch_size in product(methods, backbones, batch_sizes):
+        result = run(
+            method, backbone, batch_size, input_channel, target, image_size, warmup_steps, steps, precision
+        )
+        results.append({"method": method, "batch_size": batch_size, **result})
+
+    report = {
+        "environment": {
+            "host": platform.node(),
+            "cpus": os.cpu_count(),
+            "threads": torch.get_num_threads(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+        },
+        "settings": {
+            "input_channel": input_channel,
+            "target": target,
+            "image_size": image_size,
+            "warmup_steps": warmup_steps,
+            "steps": steps,
+            "precision": precision,
+        },
+        "results": results,
+    }
+    if out_file is not None:
+        with open(out_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+    columns = [
+        ("method", "method", 12, "{}"),
+        ("backbone", "backbone", 24, "{}"),
+        ("batch_size", "batch", 7, "{}"),
+        ("samples_per_s", "samples/s", 11, "{:.1f}"),
+        ("step_ms", "step [ms]", 11, "{:.0f}"),
+        *[(f"{phase}_ms", phase[:7], 9, "{:.0f}") for phase in PROFILER_PHASES],
+        ("parameters", "params [M]", 12, "{:.1f}"),
+        ("activation_mb", "act. [MB]", 11, "{:.0f}"),
+    ]
+    print("".join(f"{label:>{width}}" for _, label, width, _ in columns))
+    for result in results:
+        values = {**result, "parameters": result["parameters"] / 1e6}
+        print("".join(f"{fmt.format(values[name]):>{width}}" for name, _, width, fmt in columns))
+    return report
+
+
+if __name__ == "__main__":
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,217 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Union
+
+from ffcv.reader import Reader
+from lightly.utils.dist import print_rank_zero
+
+# increase whenever the content written by one of the beton converters changes
+# 2: sentinel2 storage (float16, int16 with l2a field and quantization metadata)
+# 3: one field per target modality, all targets of a split in one file
+# 4: segmentation labels remapped with lookup tables, nodata as ignore index
+# 5: geobench mean and std in the manifest instead of per sample fields
+CONVERTER_VERSION = 5
+
+# how long to wait for another process that creates the same beton file, converting a full split can take hours
+LOCK_TIMEOUT = 12 * 60 * 60
+
+
+def hash_key(key_parts: dict) -> str:
+    """Short, stable hash of everything that determines the content of a beton file."""
+    key = json.dumps(key_parts, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def hash_indices(indices: Union[list, None]) -> Union[str, None]:
+    if indices is None:
+        return None
+    return hashlib.sha256(
+        ",".join(str(int(i)) for i in indices).encode("utf-8")
+    ).hexdigest()
+
+
+def content_digest(path: Path) -> str:
+    """sha256 of the full file content, meant for small files like the split or band stats json."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def file_checksum(path: Path, n_blocks: int = 16, block_size: int = 1 << 20) -> str:
+    """Cheap checksum of large files based on the file size and evenly spaced blocks of the file."""
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode("utf-8"))
+    with open(path, "rb") as f:
+        if size <= n_blocks * block_size:
+            digest.update(f.read())
+        else:
+            for i in range(n_blocks):
+                f.seek(i * (size - block_size) // (n_blocks - 1))
+                digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def get_beton_file(processed_dir: Path, name: str, key_parts: dict) -> Path:
+    """Path of the beton file, the readable name is followed by the hash of the key parts."""
+    return processed_dir / f"{name}_{hash_key(key_parts)}.beton"
+
+
+def get_manifest_file(beton_file: Path) -> Path:
+    return beton_file.with_suffix(".json")
+
+
+def get_lock_file(beton_file: Path) -> Path:
+    return beton_file.with_suffix(".lock")
+
+
+def get_tmp_file(path: Path) -> Path:
+    """Temporary file that is written first and then renamed to path."""
+    return path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+
+@contextmanager
+def beton_lock(beton_file: Path, timeout: float = LOCK_TIMEOUT, poll_interval: float = 5.0):
+    """Exclusive lock for creating a beton file (or the shards of it), shared by all processes using the directory.
+
+    With several ranks (or several runs at once) only the first process that gets the lock creates the beton
+    file, all others wait until it is released and then validate and reuse the file. Temporary files left over
+    from interrupted conversions are removed as soon as the lock is acquired.
+    """
+    lock_file = get_lock_file(beton_file)
+    with open(lock_file, "a") as f:
+        start = time.monotonic()
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError(
+                        f"Waited {timeout:.0f}s for another process creating {beton_file}, "
+                        f"remove {lock_file} if no other process is running."
+                    )
+                if not waiting:
+                    print_rank_zero(f"Waiting for another process creating {beton_file}.")
+                    waiting = True
+                time.sleep(poll_interval)
+
+        try:
+            remove_partial_files(beton_file)
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_beton(beton_file: Path):
+    """Yields a temporary path to write the beton file to, which is only renamed to beton_file on success."""
+    tmp_file = get_tmp_file(beton_file)
+    try:
+        yield tmp_file
+        os.replace(tmp_file, beton_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def remove_partial_files(beton_file: Path):
+    """Removes temporary files of interrupted conversions of the beton file, its shards and manifests."""
+    for tmp_file in beton_file.parent.glob(f"{beton_file.stem}*.tmp"):
+        print_rank_zero(f"Removing partially written file {tmp_file}.")
+        tmp_file.unlink(missing_ok=True)
+
+
+def field_schema(fields: dict) -> dict:
+    schema = {}
+    for name, field in fields.items():
+        schema[name] = {"type": field.__class__.__name__}
+        if hasattr(field, "dtype"):
+            schema[name]["dtype"] = str(field.dtype)
+        if hasattr(field, "shape"):
+            schema[name]["shape"] = list(field.shape)
+    return schema
+
+
+def source_mtimes(sources: Iterable[Path]) -> dict:
+    return {str(source): os.path.getmtime(source) for source in sources}
+
+
+def write_manifest(
+    beton_file: Path,
+    key_parts: dict,
+    num_samples: int,
+    fields: dict,
+    sources: Iterable[Path],
+    metadata: dict = None,
+):
+    """Writes the manifest next to a finished beton file, which makes the beton file valid."""
+    manifest = {
+        "converter_version": CONVERTER_VERSION,
+        "key": hash_key(key_parts),
+        "key_parts": key_parts,
+        "num_samples": num_samples,
+        "fields": field_schema(fields),
+        "sources": source_mtimes(sources),
+        "checksum": file_checksum(beton_file),
+        "metadata": metadata or {},
+    }
+    manifest_file = get_manifest_file(beton_file)
+    tmp_file = get_tmp_file(manifest_file)
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(tmp_file, manifest_file)
+
+
+def read_manifest(beton_file: Path) -> Union[dict, None]:
+    manifest_file = get_manifest_file(beton_file)
+    if not manifest_file.exists():
+        return None
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+
+def validate_beton(
+    beton_file: Path,
+    key_parts: dict,
+    sources: Iterable[Path],
+    field_names: Iterable[str],
+) -> bool:
+    """Checks a beton file against its manifest.
+
+    The beton file is only valid if the manifest exists and the converter version, the key, the fields that
+    are going to be decoded, the modification times of the source files, the checksum and the number of
+    samples match.
+    """
+    manifest = read_manifest(beton_file)
+    if manifest is None:
+        reason = "no manifest"
+    elif manifest["converter_version"] != CONVERTER_VERSION:
+        reason = f"converter version {manifest['converter_version']} != {CONVERTER_VERSION}"
+    elif manifest["key"] != hash_key(key_parts):
+        reason = "key mismatch"
+    elif not set(field_names).issubset(manifest["fields"]):
+        reason = f"missing fields {set(field_names) - set(manifest['fields'])}"
+    elif manifest["sources"] != source_mtimes(sources):
+        reason = "source files changed"
+    elif manifest["checksum"] != file_checksum(beton_file):
+        reason = "checksum mismatch"
+    elif manifest["num_samples"] != _num_samples(beton_file):
+        reason = "number of samples mismatch"
+    else:
+        return True
+
+    print_rank_zero(f"Processed file {beton_file} is invalid ({reason}).")
+    return False
+
+
+def remove_beton(beton_file: Path):
+    beton_file.unlink(missing_ok=True)
+    get_manifest_file(beton_file).unlink(missing_ok=True)
+
+
+def _num_samples(beton_file: Path) -> int:
+    return Reader(str(beton_file)).num_samples
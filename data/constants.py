@@ -35,6 +35,20 @@ MMEARTH_DIR = Path("/work/data/MMEARTH100K")
 if _MMEARTH_DIR_ENV is not None:
     MMEARTH_DIR = Path(_MMEARTH_DIR_ENV)
 
+# cached metadata of the geobench tasks (see data.geobench_index)
+_GEOBENCH_INDEX_FILE_ENV = os.environ.get("GEOBENCH_INDEX_FILE", None)
+
+GEOBENCH_INDEX_FILE = Path("~/.cache/ssl4eo/geobench_index.json").expanduser()
+if _GEOBENCH_INDEX_FILE_ENV is not None:
+    GEOBENCH_INDEX_FILE = Path(_GEOBENCH_INDEX_FILE_ENV)
+
+# memory mapped metadata of the MMEarth h5 files (see data.tile_index), the data folder may be read-only
+_TILE_INDEX_DIR_ENV = os.environ.get("TILE_INDEX_DIR", None)
+
+TILE_INDEX_DIR = Path("~/.cache/ssl4eo/tile_index").expanduser()
+if _TILE_INDEX_DIR_ENV is not None:
+    TILE_INDEX_DIR = Path(_TILE_INDEX_DIR_ENV)
+
 
 NO_DATA_VAL = {
     "sentinel2": 0,
@@ -183,6 +197,19 @@ MODALITY_TASK = {
     "eco_region": "classification",
 }
 
+# class values of the segmentation modalities and the class index they are mapped to (see data.label_remap),
+# all other values (e.g., nodata) are mapped to SEGMENTATION_IGNORE_INDEX
+SEGMENTATION_CLASS_REMAP = {
+    # 0 is nodata
+    "dynamic_world": {1: 0, 2: 1, 3: 2, 4: 3, 5: 4, 6: 5, 7: 6, 8: 7, 9: 8},
+    # 255 is nodata
+    "esa_worldcover": {
+        10: 0, 20: 1, 30: 2, 40: 3, 50: 4, 60: 5, 70: 6, 80: 7, 90: 8, 95: 9, 100: 10
+    },
+}
+# same as the default ignore_index of the torch losses
+SEGMENTATION_IGNORE_INDEX = -100
+
 CLASSIFICATION_CLASSES = {
     "biome": 14,
     "eco_region": 846,
@@ -1,9 +1,9 @@
 import json
+from collections import OrderedDict
 from pathlib import Path
 from typing import Union, Tuple
 
 import ffcv
-import geobench
 import numpy as np
 from ffcv import DatasetWriter
 from ffcv.fields import NDArrayField, IntField
@@ -16,10 +16,25 @@ from lightly.utils.dist import print_rank_zero
 from torch.utils.data import Dataset, DataLoader
 
 from methods.transforms import to_tensor
-
-with open("data/BAND_NAMES.json", "r") as f:
+from .beton_cache import (
+    CONVERTER_VERSION,
+    atomic_beton,
+    beton_lock,
+    get_beton_file,
+    hash_indices,
+    read_manifest,
+    remove_beton,
+    validate_beton,
+    write_manifest,
+)
+from .geobench_index import get_task_info, load_task
+
+with open(Path(__file__).parent / "BAND_NAMES.json", "r") as f:
     BAND_NAMES = json.load(f)
 
+# memory of the sample caches of all no-ffcv workers of a split together (see GeobenchDataset)
+GEOBENCH_CACHE_BYTES = 2 * 1024**3
+
 GEOBENCH_TASK = {
     "m-eurosat": "classification",
     "m-so2sat": "classification",
@@ -39,6 +54,7 @@ class GeobenchDataset(Dataset):
         split: str = "train",
         transform=None,
         partition: str = "default",
+        cache_bytes: int = 0,
     ):
         if split == "val":
             split = "valid"
@@ -62,73 +78,85 @@ class GeobenchDataset(Dataset):
             raise Exception(f"Dataset {dataset_name} has no class names")
         self.num_classes = task.label_type.n_classes
 
-        self.tmp_band_names = [band.name for band in task.bands_info]
+        task_info = get_task_info(dataset_name, benchmark_name, BAND_NAMES[dataset_name])
+        self.tmp_band_names = task_info["band_names"]
         # get the tmp bands in the same order as the ones present in the BAND_NAMES.json file
-        self.tmp_band_indices = [
-            self.tmp_band_names.index(band_name)
-            for band_name in BAND_NAMES[dataset_name]
-        ]
+        self.tmp_band_indices = task_info["band_indices"]
         self.patch_size = task.patch_size
         self.label_type = task.label_type
 
         self.norm_stats = self.dataset.normalization_stats()
         self.in_channels = len(self.tmp_band_indices)
 
+        self.mean = np.array(self.norm_stats[0])
+        self.std = np.array(self.norm_stats[1])
+        if self.dataset_name == "m-so2sat":
+            # the mean and std are multiplied by 10000 only for the so2sat dataset, while the
+            # data values are in decimal range between 0 and 1. Hence, we need to divide the mean and std by 10000
+            self.mean = self.mean / 10000
+            self.std = self.std / 10000
+        self.mean = self.mean.astype(np.dtype("float32"))
+        self.std = self.std.astype(np.dtype("float32"))
+
+        # least recently used samples, bounded by cache_bytes (0 disables the cache)
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
     @staticmethod
     def get_task(dataset_name: str) -> Tuple[TaskSpecifications, str]:
+        # the dataset directory is looked up in the geobench index instead of walking over the whole benchmark
         benchmark_name = GEOBENCH_TASK[dataset_name]
-        benchmark_name_ = ""
-        if benchmark_name == "classification":
-            benchmark_name_ = "classification_v1.0/"
-        elif benchmark_name == "segmentation":
-            benchmark_name_ = "segmentation_v1.0/"
-        task = None
-        for task_ in geobench.task_iterator(benchmark_name=benchmark_name_):
-            if task_.dataset_name == dataset_name:
-                task = task_
-        assert task is not None, f"couldn't find {dataset_name} in {benchmark_name_}"
-        return task, benchmark_name
+        task_info = get_task_info(dataset_name, benchmark_name, BAND_NAMES[dataset_name])
+        return load_task(task_info["dataset_dir"]), benchmark_name
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
+        if idx in self._cache:
+            self._cache.move_to_end(idx)
+            x, label = self._cache[idx]
+        else:
+            x, label = self._load(idx)
+            self._add_to_cache(idx, x, label)
 
-        label = self.dataset[idx].label
-        x = []
-
-        for band_idx in self.tmp_band_indices:
-            x.append(self.dataset[idx].bands[band_idx].data)
-
-        x = np.stack(x, axis=0)
-
-        mean = np.array(self.norm_stats[0])
-        std = np.array(self.norm_stats[1])
+        if self.transform is not None:
+            self.transform(x)
 
-        if self.dataset_name == "m-so2sat":
-            # the mean and std are multiplied by 10000 only for the so2sat dataset, while the
-            # data values are in decimal range between 0 and 1. Hence, we need to divide the mean and std by 10000
-            mean = mean / 10000
-            std = std / 10000
+        return x, label
 
-        # normalize each band with its mean and std
-        x = (x - mean[:, None, None]) / std[:, None, None]
+    def _load(self, idx):
+        # every access of self.dataset[idx] loads the sample from disk again
+        sample = self.dataset[idx]
+        label = sample.label
 
-        # cast to float32
-        x = x.astype(np.dtype("float32"))
-        mean = mean.astype(np.dtype("float32"))
-        std = std.astype(np.dtype("float32"))
+        # normalize each band with its mean and std, written directly into the stacked array
+        x = np.empty(
+            (self.in_channels, *sample.bands[self.tmp_band_indices[0]].data.shape),
+            dtype=np.dtype("float32"),
+        )
+        for i, band_idx in enumerate(self.tmp_band_indices):
+            np.subtract(
+                sample.bands[band_idx].data, self.mean[i], out=x[i], casting="unsafe"
+            )
+            x[i] /= self.std[i]
 
         # check if label is an object or a number
         if not (isinstance(label, int) or isinstance(label, list)):
-            label = label.data
-            # label is a memoryview object, convert it to a list, and then to a numpy array
-            label = np.array(list(label), dtype=np.dtype("int64"))
+            # label is a memoryview object or an array
+            label = np.array(label.data, dtype=np.dtype("int64"))
 
-        if self.transform is not None:
-            self.transform(x)
+        return x, label
 
-        return x, label, mean, std
+    def _add_to_cache(self, idx, x, label):
+        if self.cache_bytes <= 0:
+            return
+        self._cache[idx] = (x, label)
+        self._cached_bytes += x.nbytes + np.asarray(label).nbytes
+        while self._cached_bytes > self.cache_bytes and self._cache:
+            _, (x_old, label_old) = self._cache.popitem(last=False)
+            self._cached_bytes -= x_old.nbytes + np.asarray(label_old).nbytes
 
 
 def get_geobench_dataloaders(
@@ -158,16 +186,20 @@ def get_geobench_dataloaders(
     splits : list[str], optional
         The dataset splits to be used. Default is ["train", "val", "test"].
     partition : str, optional
-        The partition strategy for the dataset. Default is "default".
+        The partition strategy for the dataset. Default is "default". All partitions share the beton files of the
+        default partition, the samples of a partition are selected when loading (see `partition_positions`).
     no_ffcv : bool, optional
         Disables the creation of beton files and returns PyTorch DataLoader instead. Default is False.
     indices : list[list[int]], optional
-        Select indices to use for each split (starting at 0). Default is None, meaning all samples are used. Only applicable with FFCV enabled.
+        Select indices of the partition to use for each split (starting at 0). Default is None, meaning all samples are used.
+        Only the selected samples are converted. Only applicable with FFCV enabled.
 
     Returns:
     -------
     Tuple[list[Union[ffcv.Loader, torch.utils.data.DataLoader]], TaskSpecifications]
         A tuple containing a list of data loaders and task specifications. Each loader can be either `ffcv.Loader` (for beton files) or `torch.utils.data.DataLoader` (for standard PyTorch datasets).
+        The loaders yield (input, label) batches, the normalization of the input bands is available as `loader.mean`
+        and `loader.std`.
 
     Example Usage:
     --------------
@@ -192,6 +224,12 @@ def get_geobench_dataloaders(
     -----
     - The function checks if the processed beton file exists for each split. If it doesn't exist, it processes the data
       and creates the beton file.
+    - Beton file names contain a hash of the dataset, bands, split, indices and converter version. The partition is not
+      part of it, a single beton file per split holds the samples of all partitions.
+      A JSON manifest is written next to each beton file and validated before the file is reused (see `data.beton_cache`).
+    - Beton files are created by a single process (e.g., one of several DDP ranks) under a file lock and written to a
+      temporary file first, the other processes wait for the lock and reuse the finished file.
+    - The mean and std of the input bands are stored once in the manifest instead of with every sample.
     - The `convert_geobench_to_beton` function is used to convert the dataset into beton format.
     - The `ffcv.Loader` is used to create the data loaders with appropriate pipelines for training and validation.
     """
@@ -207,26 +245,79 @@ def get_geobench_dataloaders(
 
     processed_dir.mkdir(exist_ok=True)
 
-    dataloaders = []
     task, _ = GeobenchDataset.get_task(dataset_name)
+
+    # everything that determines the content of the beton files, besides split and indices
+    dataset_dir = task.get_dataset_dir()
+    sources = [dataset_dir]
+    partition_file = dataset_dir / "default_partition.json"
+    if partition_file.exists():
+        sources.append(partition_file)
+    key_parts = {
+        "dataset": dataset_name,
+        "converter_version": CONVERTER_VERSION,
+        "band_names": BAND_NAMES[dataset_name],
+    }
+
+    # Data decoding and augmentation
+    # Pipeline for each data field
+    pipelines = {
+        "input": [NDArrayDecoder(), ToTensor()],
+    }
+    # get correct decoder for task
+    if isinstance(task.label_type, (MultiLabelClassification, SemanticSegmentation, SegmentationClasses)):
+        pipelines.update(
+            {
+                "label": [
+                    NDArrayDecoder(),
+                    ToTensor(),
+                ],
+            }
+        )
+    else:
+        pipelines.update(
+            {
+                "label": [
+                    IntDecoder(),
+                    ToTensor(),
+                    Squeeze([1]),
+                ],
+            }
+        )
+    dataloaders = []
     for i, split in enumerate(splits):
         is_train = split == "train"
-        subset = "" if indices is None else "_subset"
-        beton_file = processed_dir / f"{split}_{dataset_name}_{partition}{subset}.beton"
+        idx = None if indices is None else indices[i]
+        # positions of the partition samples in the default partition, which is converted
+        positions = (
+            None
+            if partition == "default" or no_ffcv
+            else partition_positions(dataset_dir, partition, split)
+        )
+        if idx is not None:
+            # only the selected samples are converted and loaded in full
+            convert_idx = idx if positions is None else [positions[j] for j in idx]
+            load_idx = None
+        else:
+            convert_idx = None
+            load_idx = positions
+        split_key_parts = {
+            **key_parts,
+            "split": split,
+            "indices": hash_indices(convert_idx),
+        }
+        beton_file = get_beton_file(
+            processed_dir, f"{split}_{dataset_name}", split_key_parts
+        )
 
-        if not beton_file.exists() or no_ffcv:
-            if not no_ffcv:
-                print_rank_zero(
-                    f"Processed file {beton_file} does not exist, trying to create it now."
-                )
-                transform = None
-            else:
-                transform = to_tensor
+        if no_ffcv:
+            # repeated epochs are served from the sample cache of the (persistent) workers
             dataset = GeobenchDataset(
                 dataset_name=dataset_name,
                 split=split,
-                transform=transform,
+                transform=to_tensor,
                 partition=partition,
+                cache_bytes=GEOBENCH_CACHE_BYTES // max(num_workers, 1),
             )
 
             if len(dataset) == 0:
@@ -237,57 +328,67 @@ def get_geobench_dataloaders(
                 dataloaders.append(None)
                 continue
 
-            if no_ffcv:
-                dataloader = DataLoader(
-                    dataset,
-                    batch_size=batch_size_per_device,
-                    shuffle=is_train,
-                    num_workers=num_workers,
-                    drop_last=is_train,
-                    persistent_workers=num_workers > 0,
+            dataloader = DataLoader(
+                dataset,
+                batch_size=batch_size_per_device,
+                shuffle=is_train,
+                num_workers=num_workers,
+                drop_last=is_train,
+                persistent_workers=num_workers > 0,
+            )
+            dataloader.mean, dataloader.std = dataset.mean, dataset.std
+            dataloaders.append(dataloader)
+            continue
+
+        if load_idx is not None and len(load_idx) == 0:
+            assert not is_train, "training dataset has no samples"
+            print_rank_zero(f"No samples in evaluation split '{split}', skipping it")
+            dataloaders.append(None)
+            continue
+
+        # only one process (e.g., one of several ranks) validates and creates the file, the others wait for it
+        with beton_lock(beton_file):
+            if beton_file.exists() and not validate_beton(
+                beton_file, split_key_parts, sources, pipelines
+            ):
+                remove_beton(beton_file)
+
+            if not beton_file.exists():
+                print_rank_zero(
+                    f"Processed file {beton_file} does not exist, trying to create it now."
                 )
-                dataloaders.append(dataloader)
-                continue
-            else:
-                idx = None if indices is None else indices[i]
-                convert_geobench_to_beton(
-                    dataset,
+                dataset = GeobenchDataset(
+                    dataset_name=dataset_name,
+                    split=split,
+                    transform=None,
+                    partition="default",
+                )
+
+                if len(dataset) == 0:
+                    assert not is_train, "training dataset has no samples"
+                    print_rank_zero(
+                        f"No samples in evaluation split '{split}', skipping it"
+                    )
+                    dataloaders.append(None)
+                    continue
+
+                with atomic_beton(beton_file) as tmp_file:
+                    fields = convert_geobench_to_beton(
+                        dataset,
+                        tmp_file,
+                        num_workers=num_workers,
+                        indices=convert_idx,
+                    )
+                write_manifest(
                     beton_file,
-                    num_workers=num_workers,
-                    indices=idx,
+                    split_key_parts,
+                    num_samples=len(dataset) if convert_idx is None else len(convert_idx),
+                    fields=fields,
+                    sources=sources,
+                    metadata=normalization_metadata(dataset),
                 )
 
-        # Data decoding and augmentation
-        # Pipeline for each data field
-        pipelines = {
-            "input": [NDArrayDecoder(), ToTensor()],
-        }
-        # get correct decoder for task
-        if isinstance(task.label_type, (MultiLabelClassification, SemanticSegmentation, SegmentationClasses)):
-            pipelines.update(
-                {
-                    "label": [
-                        NDArrayDecoder(),
-                        ToTensor(),
-                    ],
-                }
-            )
-        else:
-            pipelines.update(
-                {
-                    "label": [
-                        IntDecoder(),
-                        ToTensor(),
-                        Squeeze([1]),
-                    ],
-                }
-            )
-        pipelines.update(
-            {
-                "mean": [NDArrayDecoder(), ToTensor()],
-                "std": [NDArrayDecoder(), ToTensor()],
-            }
-        )
+            manifest = read_manifest(beton_file)
 
         # Replaces PyTorch data loader (`torch.utils.data.Dataloader`)
         dataloader = ffcv.Loader(
@@ -295,9 +396,14 @@ def get_geobench_dataloaders(
             batch_size=batch_size_per_device,
             num_workers=num_workers,
             order=OrderOption.QUASI_RANDOM if is_train else OrderOption.SEQUENTIAL,
-            pipelines=pipelines,
+            indices=load_idx,
+            # fields of the file that are not requested are not decoded
+            pipelines={name: pipelines.get(name) for name in manifest["fields"]},
             drop_last=is_train,
         )
+        # dataset level normalization of the input, the same for every sample
+        dataloader.mean = np.array(manifest["metadata"]["mean"], dtype=np.float32)
+        dataloader.std = np.array(manifest["metadata"]["std"], dtype=np.float32)
 
         dataloaders.append(dataloader)
 
@@ -309,7 +415,7 @@ def convert_geobench_to_beton(
     write_path: Path,
     num_workers: int = -1,
     indices: list = None,
-):
+) -> dict:
     """
     Converts a GeobenchDataset into a format optimized for a specified machine learning task and writes it to a specified path.
 
@@ -343,6 +449,11 @@ def convert_geobench_to_beton(
         Creates a DatasetWriter instance with the specified write_path, fields, and num_workers.
         Writes the dataset using the from_indexed_dataset method of the DatasetWriter.
 
+    Returns:
+    -------
+    dict
+        The fields written to the beton file.
+
     Example Usage:
     --------------
     ```python
@@ -398,21 +509,31 @@ def convert_geobench_to_beton(
             }
         )
 
-    fields.update(
-        {
-            "mean": NDArrayField(
-                dtype=np.dtype("float32"),
-                shape=(input_shape[0],),
-            ),
-            "std": NDArrayField(
-                dtype=np.dtype("float32"),
-                shape=(input_shape[0],),
-            ),
-        }
-    )
-
     # Pass a type for each data field
     writer = DatasetWriter(write_path, fields, num_workers=num_workers)
 
     # Write dataset
     writer.from_indexed_dataset(dataset, indices=indices)
+    return fields
+
+
+def normalization_metadata(dataset: GeobenchDataset) -> dict:
+    """Mean and std of the input bands, stored in the manifest instead of with every sample."""
+    return {"mean": dataset.mean.tolist(), "std": dataset.std.tolist()}
+
+
+def partition_positions(dataset_dir: Path, partition: str, split: str) -> list[int]:
+    """Positions of the samples of a partition in the default partition, from the partition files of geobench.
+
+    The partitions (e.g., 0.01x_train) are subsets of the default partition, so that a single beton file of the
+    default partition can be used for all of them.
+    """
+    geobench_split = "valid" if split == "val" else split
+    with open(dataset_dir / "default_partition.json", "r") as f:
+        default_names = json.load(f)[geobench_split]
+    with open(dataset_dir / f"{partition}_partition.json", "r") as f:
+        names = json.load(f)[geobench_split]
+    position = {name: i for i, name in enumerate(default_names)}
+    missing = [name for name in names if name not in position]
+    assert not missing, f"samples of partition '{partition}' not in the default partition: {missing[:5]}"
+    return [position[name] for name in names]
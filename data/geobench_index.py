@@ -0,0 +1,124 @@
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import geobench
+from geobench import TaskSpecifications
+from lightly.utils.dist import print_rank_zero
+
+from .beton_cache import beton_lock, get_tmp_file, source_mtimes
+from .constants import GEOBENCH_INDEX_FILE
+
+# increase whenever the content of an index entry changes
+GEOBENCH_INDEX_VERSION = 1
+
+GEOBENCH_BENCHMARKS = {
+    "classification": "classification_v1.0/",
+    "segmentation": "segmentation_v1.0/",
+}
+
+
+def find_task(dataset_name: str, benchmark_name: str) -> TaskSpecifications:
+    """Walks over all tasks of the benchmark, which loads the task specs of every dataset."""
+    task = None
+    for task_ in geobench.task_iterator(
+        benchmark_name=GEOBENCH_BENCHMARKS[benchmark_name]
+    ):
+        if task_.dataset_name == dataset_name:
+            task = task_
+    assert (
+        task is not None
+    ), f"couldn't find {dataset_name} in {GEOBENCH_BENCHMARKS[benchmark_name]}"
+    return task
+
+
+def task_sources(dataset_dir: Path) -> list[Path]:
+    return [dataset_dir / "task_specs.pkl", *sorted(dataset_dir.glob("*_partition.json"))]
+
+
+def build_task_entry(task: TaskSpecifications, band_names: list[str]) -> dict:
+    """Metadata of a task that is needed without loading the dataset."""
+    dataset_dir = task.get_dataset_dir()
+    task_band_names = [band.name for band in task.bands_info]
+
+    # number of samples per split of every partition
+    num_samples = {}
+    for partition_file in sorted(dataset_dir.glob("*_partition.json")):
+        with open(partition_file, "r") as f:
+            partition = json.load(f)
+        num_samples[partition_file.name[: -len("_partition.json")]] = {
+            split: len(names) for split, names in partition.items()
+        }
+
+    if hasattr(task.label_type, "class_names"):
+        class_names = task.label_type.class_names
+    else:
+        class_names = getattr(task.label_type, "class_name", None)
+
+    return {
+        "version": GEOBENCH_INDEX_VERSION,
+        "dataset_dir": str(dataset_dir),
+        "benchmark_dir": task.benchmark_name,
+        "band_names": task_band_names,
+        # selected bands (BAND_NAMES.json) in the order of the task bands
+        "selected_band_names": list(band_names),
+        "band_indices": [task_band_names.index(name) for name in band_names],
+        "class_names": None if class_names is None else list(class_names),
+        "label_type": task.label_type.__class__.__name__,
+        "n_classes": task.label_type.n_classes,
+        "patch_size": list(task.patch_size),
+        "num_samples": num_samples,
+        "sources": source_mtimes(task_sources(dataset_dir)),
+    }
+
+
+def _read_index() -> dict:
+    if not GEOBENCH_INDEX_FILE.exists():
+        return {}
+    with open(GEOBENCH_INDEX_FILE, "r") as f:
+        return json.load(f)
+
+
+def _is_valid(entry: dict, band_names: list[str]) -> bool:
+    if entry is None or entry["version"] != GEOBENCH_INDEX_VERSION:
+        return False
+    dataset_dir = Path(entry["dataset_dir"])
+    return (
+        dataset_dir.exists()
+        and entry["selected_band_names"] == list(band_names)
+        and entry["sources"] == source_mtimes(task_sources(dataset_dir))
+    )
+
+
+def get_task_info(dataset_name: str, benchmark_name: str, band_names: list[str]) -> dict:
+    """Index entry of a geobench task, looked up in the index file and added to it on first use.
+
+    Finding a task walks over the task specs of all datasets of a benchmark, the index keeps the result
+    (dataset directory, bands, classes, label type, patch size and number of samples per split and partition).
+    Entries are built again if the task specs or partition files change.
+    """
+    entry = _read_index().get(dataset_name)
+    if _is_valid(entry, band_names):
+        return entry
+
+    GEOBENCH_INDEX_FILE.parent.mkdir(parents=True, exist_ok=True)
+    # several processes can add entries at the same time
+    with beton_lock(GEOBENCH_INDEX_FILE):
+        index = _read_index()
+        entry = index.get(dataset_name)
+        if not _is_valid(entry, band_names):
+            print_rank_zero(f"Adding geobench task '{dataset_name}' to {GEOBENCH_INDEX_FILE}.")
+            entry = build_task_entry(find_task(dataset_name, benchmark_name), band_names)
+            index[dataset_name] = entry
+            tmp_file = get_tmp_file(GEOBENCH_INDEX_FILE)
+            with open(tmp_file, "w") as f:
+                json.dump(index, f, indent=2)
+            os.replace(tmp_file, GEOBENCH_INDEX_FILE)
+    return entry
+
+
+@lru_cache
+def load_task(dataset_dir: str) -> TaskSpecifications:
+    """Task specs of a single dataset, loaded once per process."""
+    return geobench.load_task_specs(Path(dataset_dir))
@@ -0,0 +1,21 @@
+import numpy as np
+
+from .constants import SEGMENTATION_IGNORE_INDEX
+
+# the segmentation maps are stored as uint8, larger values are treated like 255
+LUT_SIZE = 256
+
+
+def build_label_lut(remap: dict, ignore_index: int = SEGMENTATION_IGNORE_INDEX) -> np.ndarray:
+    """Lookup table from stored class value to class index, values that are not in remap are ignored."""
+    lut = np.full(LUT_SIZE, ignore_index, dtype=np.int64)
+    for value, index in remap.items():
+        lut[value] = index
+    return lut
+
+
+def remap_labels(data: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """Maps the class values of a single map or a stacked batch of maps with a single gather."""
+    if data.dtype != np.uint8:
+        data = np.clip(data, 0, len(lut) - 1).astype(np.intp)
+    return lut[data]
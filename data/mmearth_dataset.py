@@ -3,30 +3,202 @@ from argparse import Namespace
 from collections import OrderedDict
 from copy import copy
 from pathlib import Path
-from typing import Union, Tuple
+from typing import NamedTuple, Union, Tuple
 
 import ffcv
 import h5py
 import numpy as np
+import torch
 from ffcv import DatasetWriter
 from ffcv.fields import NDArrayField, IntField, FloatField
-from ffcv.fields.basics import IntDecoder
+from ffcv.fields.basics import IntDecoder, FloatDecoder
 from ffcv.fields.ndarray import NDArrayDecoder
 from ffcv.loader import OrderOption
-from ffcv.transforms import ToTensor, Squeeze
+from ffcv.transforms import ToTensor, Squeeze, Convert
 from lightly.utils.dist import print_rank_zero
 from torch.utils.data import Dataset, DataLoader
 from torchvision.transforms import Compose
 
 from methods.transforms import to_tensor
-from .constants import NO_DATA_VAL, MODALITIES_FULL, MODALITY_TASK, ori_input_size
+from .beton_cache import (
+    CONVERTER_VERSION,
+    atomic_beton,
+    beton_lock,
+    content_digest,
+    get_beton_file,
+    hash_indices,
+    read_manifest,
+    remove_beton,
+    validate_beton,
+    write_manifest,
+)
+from .constants import (
+    NO_DATA_VAL,
+    MODALITIES_FULL,
+    MODALITY_TASK,
+    SEGMENTATION_CLASS_REMAP,
+)
+from .label_remap import build_label_lut, remap_labels
+from .samplers import (
+    SortedBatchSampler,
+    ChunkShuffleSampler,
+    DistributedSequentialSampler,
+    get_chunk_rows,
+)
+from .sharding import (
+    ShardedLoader,
+    get_progress_file,
+    get_shard_files,
+    run_shard_jobs,
+    shard_indices,
+)
+from .storage import SENTINEL2_STORAGE, Dequantize, DequantizingLoader
+from .tile_index import load_tile_index
 
 
 ##################### FUNCTIONS FOR PRETRAINING DATASETS #####################
 
+# number of hdf5 chunks that are shuffled together in no_ffcv training (see ChunkShuffleSampler)
+CHUNK_SHUFFLE_WINDOW = 8
+
+# modalities that are normalized per pixel map (band, h, w) instead of per value (band,)
+PIXEL_MODALITIES = [
+    "sentinel2",
+    "sentinel1",
+    "aster",
+    "canopy_height_eth",
+    "dynamic_world",
+    "esa_worldcover",
+]
+
+
+class ModalityReadPlan(NamedTuple):
+    """Everything needed to read and normalize a single modality, computed once per dataset."""
+
+    # sorted (unique) band indices as required by h5py fancy indexing, a slice if contiguous
+    h5_idx: Union[np.ndarray, slice]
+    # maps the sorted read back to the requested band order, None if already in order
+    inverse_idx: Union[np.ndarray, None]
+    # number of axes of a single sample, the band axis is the first of them
+    ndim: int
+    # one hot encoded modalities (biome, eco_region) are returned as class index
+    one_hot: bool
+    # name of the band stats entry (l1c, l2a), the l2a flag of the sample is used as index
+    stats_names: Tuple[str, str]
+    # preshaped float32 mean/std per band stats entry, empty if not normalized
+    mean: dict
+    std: dict
+    nodata: float
+    dtype: np.dtype
+    # class value to class index of segmentation modalities (see data.label_remap), None otherwise
+    label_lut: Union[np.ndarray, None]
+
+
+def compile_read_plan(
+    modalities: dict, modalities_full: dict, band_stats: dict
+) -> "OrderedDict[str, ModalityReadPlan]":
+    """Resolves band indices, read order and normalization statistics for all modalities.
+
+    This is independent of the sample, so it is done once instead of in every __getitem__ call.
+    """
+    read_plan = OrderedDict()
+    for modality, bands in modalities.items():
+        # get the indices based on how it is in modalities_full
+        if bands == "all":
+            modality_idx = np.arange(len(modalities_full[modality]))
+        else:
+            modality_idx = np.array(
+                [modalities_full[modality].index(m) for m in bands]
+            )
+
+        # h5py needs increasing indices, so read in sorted order and swap back afterwards
+        h5_idx, inverse_idx = np.unique(modality_idx, return_inverse=True)
+        if len(h5_idx) == len(modality_idx) and np.all(h5_idx == modality_idx):
+            inverse_idx = None
+        if np.all(np.diff(h5_idx) == 1):
+            # slices are a lot cheaper for h5py than point selections
+            h5_idx = slice(int(h5_idx[0]), int(h5_idx[-1]) + 1)
+
+        # inside the band_stats, the name for sentinel2 is sentinel2_l1c or sentinel2_l2a
+        if modality == "sentinel2":
+            stats_names = ("sentinel2_l1c", "sentinel2_l2a")
+        else:
+            stats_names = (modality, modality)
+
+        mean, std = {}, {}
+        if modality not in [
+            "biome",
+            "eco_region",
+            "dynamic_world",
+            "esa_worldcover",
+        ]:
+            # single value mean and std (era5, lat, lon, month) or for each band of a map
+            shape = (-1, 1, 1) if modality in PIXEL_MODALITIES else (-1,)
+            for stats_name in set(stats_names):
+                if stats_name not in band_stats:
+                    continue
+                stats = band_stats[stats_name]
+                mean[stats_name] = (
+                    np.array(stats["mean"], dtype=np.float32)[modality_idx].reshape(shape)
+                )
+                std[stats_name] = (
+                    np.array(stats["std"], dtype=np.float32)[modality_idx].reshape(shape)
+                )
+
+        if MODALITY_TASK[modality] in ["classification", "segmentation"]:
+            dtype = np.dtype("int64")
+        else:
+            dtype = np.dtype("float32")
+
+        read_plan[modality] = ModalityReadPlan(
+            h5_idx=h5_idx,
+            inverse_idx=inverse_idx,
+            ndim=3 if modality in PIXEL_MODALITIES else 1,
+            one_hot=modality in ["biome", "eco_region"],
+            stats_names=stats_names,
+            mean=mean,
+            std=std,
+            nodata=NO_DATA_VAL[modality],
+            dtype=dtype,
+            label_lut=(
+                build_label_lut(SEGMENTATION_CLASS_REMAP[modality])
+                if modality in SEGMENTATION_CLASS_REMAP
+                else None
+            ),
+        )
+    return read_plan
+
+
+def chunk_cache_config(data_path: Union[str, Path], n_chunks: int, dataset_name: str = "sentinel2") -> dict:
+    """h5py raw data chunk cache settings that keep `n_chunks` chunks of the given dataset in memory.
+
+    The cache is allocated per opened h5 dataset, the size is derived from the (largest) sentinel2 chunks.
+    """
+    with h5py.File(data_path, "r") as f:
+        h5_dataset = f[dataset_name]
+        chunks = h5_dataset.chunks
+        if chunks is None:
+            # contiguous datasets are not cached by hdf5
+            return {}
+        chunk_bytes = int(np.prod(chunks)) * h5_dataset.dtype.itemsize
+
+    # hdf5 recommends a prime number of hash slots, about 100 times the number of cached chunks
+    n_slots = 100 * n_chunks + 1
+    while any(n_slots % d == 0 for d in range(2, int(n_slots**0.5) + 1)):
+        n_slots += 2
+    return {"rdcc_nbytes": n_chunks * chunk_bytes, "rdcc_nslots": n_slots}
+
 
 class MMEarthDataset(Dataset):
-    def __init__(self, args, split: str, transform = None, return_tuple: bool = False):
+    def __init__(
+        self,
+        args,
+        split: str,
+        transform = None,
+        return_tuple: bool = False,
+        cache_chunks: int = None,
+        sentinel2_storage: str = "float32",
+    ):
         # return_dict transform
         self.transform = transform
 
@@ -36,39 +208,55 @@ class MMEarthDataset(Dataset):
         self.data_name = args.data_name
         # path to the split file
         self.splits_path = args.splits_path
-        # tile info
-        self.tile_info = args.tile_info
+        # memory mapped l2a flags, names and split rows (see data.tile_index)
+        self.tile_index = args.tile_index
+        self.split = split
         # modalities used for training
         self.modalities = args.modalities
         # all modalities present in the datasets. This is used to keep track of the indices of the modalities in the dataset.
         self.modalities_full = args.modalities_full
-        with open(self.splits_path, "r") as f:
-            self.indices = json.load(f)[split]
 
         # mean, std, min and max of each band
         self.norm_stats = args.band_stats
 
+        # band selection, read order and normalization of each modality
+        self.read_plan = compile_read_plan(
+            self.modalities, self.modalities_full, self.norm_stats
+        )
+
+        # data type of sentinel2 (see SENTINEL2_STORAGE), with int16 the raw reflectances are returned
+        # together with the l2a flag of each sample and normalized later on (see Dequantize)
+        assert sentinel2_storage in SENTINEL2_STORAGE, f"unknown storage '{sentinel2_storage}'"
+        self.sentinel2_storage = sentinel2_storage
+        if sentinel2_storage == "float16":
+            self.read_plan["sentinel2"] = self.read_plan["sentinel2"]._replace(
+                dtype=np.dtype("float16")
+            )
+
         self.return_tuple = return_tuple
 
+        # size the hdf5 chunk cache to hold the chunks of a shuffle window (see ChunkShuffleSampler)
+        self.h5_kwargs = {}
+        if cache_chunks is not None:
+            self.h5_kwargs = chunk_cache_config(self.data_path, cache_chunks)
+
+    @property
+    def indices(self) -> np.ndarray:
+        # rows of the split in the h5 file, not stored on the dataset to keep it cheap to pickle
+        return self.tile_index.split(self.split)
+
     def apply_transform(self, return_dict: dict):
         # TODO if more modalities are used, this will create a distorted view
         #  (e.g., flip applied to one but not to another modality)
         # applying transform for every pixel-wise modality
         for modality in return_dict:
             # only pixel based modalities
-            if modality in [
-                "sentinel2",
-                "sentinel1",
-                "aster",
-                "canopy_height_eth",
-                "dynamic_world",
-                "esa_worldcover",
-            ]:
+            if modality in PIXEL_MODALITIES:
                 return_dict[modality] = self.transform(return_dict[modality])
         return return_dict
 
     def _open_hdf5(self, path: [str, Path]):
-        self.data_full = h5py.File(path, "r")
+        self.data_full = h5py.File(path, "r", **self.h5_kwargs)
 
     def __len__(self):
         return len(self.indices)
@@ -81,105 +269,103 @@ class MMEarthDataset(Dataset):
 
         # based on what bands and what modalities we need for training, we return the return_dict[idx].)
         return_dict = OrderedDict()
-        name = self.data_full["metadata"][self.indices[idx]][0].decode("utf-8")
-        l2a = self.tile_info[name]["S2_type"] == "l2a"
+        sample_idx = int(self.indices[idx])
+        name = self.tile_index.names([sample_idx])[0]
+        l2a = bool(self.tile_index.l2a[sample_idx])
 
-        for modality in self.modalities.keys():
-            # get the indices based on how it is in modalities_full
-            if self.modalities[modality] == "all":
-                modality_idx = [i for i in range(len(self.modalities_full[modality]))]
+        for modality, plan in self.read_plan.items():
+            if plan.one_hot:
+                data = self.data_full[modality][sample_idx]
             else:
-                modality_idx = [
-                    self.modalities_full[modality].index(m)
-                    for m in self.modalities[modality]
-                ]
+                data = self.data_full[modality][sample_idx, plan.h5_idx]
+            return_dict[modality] = self._process(modality, plan, data, l2a)
 
-            if modality in ["biome", "eco_region"]:
-                # for these modalities the array is already one hot encoded. hence modality_idx is not needed.
-                data = np.argmax(self.data_full[modality][self.indices[idx]])
-            else:
-                # get the data
-                # check if modalities are in ascending order, if not, swap for reading and swap for storing
-                modality_idx = np.array(modality_idx)
-                if np.all(np.diff(modality_idx) >= 0):
-                    data = self.data_full[modality][self.indices[idx], modality_idx]
-                else:
-                    swap_idx = np.argsort(modality_idx)
-                    data = self.data_full[modality][
-                        self.indices[idx], modality_idx[swap_idx]
-                    ][swap_idx]
-
-            if modality == "dynamic_world":
-                # the labels of dynamic world are 0, 1, 2, 3, 4, 5, 6, 7, 8, 9. We convert them to 0, 1, 2, 3, 4, 5, 6, 7, 8, nan respectively.
-                # originally when downloading the no return_dict values are 0. hence we remap them to nan.
-                data = np.where(data == NO_DATA_VAL[modality], np.nan, data)
-                old_values = [1, 2, 3, 4, 5, 6, 7, 8, 9, np.nan]
-                new_values = [0, 1, 2, 3, 4, 5, 6, 7, 8, np.nan]
-                for old, new in zip(old_values, new_values):
-                    data = np.where(data == old, new, data)
-                # for any value greater than 8, we map them to nan
-                data = np.where(data > 8, np.nan, data)
-
-            if modality == "esa_worldcover":
-                # the labels of esa worldcover are 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100, 255.
-                # We convert them to 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10 255 respectively.
-                old_values = [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100, 255]
-                new_values = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 255]
-                for old, new in zip(old_values, new_values):
-                    data = np.where(data == old, new, data)
-                # for any value greater than 10, we map them to nan
-                data = np.where(data > 10, np.nan, data)
-
-            # normalize
-            if modality not in [
-                "biome",
-                "eco_region",
-                "dynamic_world",
-                "esa_worldcover",
-            ]:
-                if self.modalities[modality] == "all":
-                    modality_idx = [
-                        i for i in range(len(self.modalities_full[modality]))
-                    ]
-                else:
-                    modality_idx = [
-                        self.modalities_full[modality].index(m)
-                        for m in self.modalities[modality]
-                    ]
-
-                # inside the band_stats, the name for sentinel2 is sentinel2_l1c or sentinel2_l2a
-                if modality == "sentinel2":
-                    modality_ = "sentinel2_l2a" if l2a else "sentinel2_l1c"
-                else:
-                    modality_ = modality
+        if self.sentinel2_storage == "int16":
+            return_dict["sentinel2_l2a"] = np.int64(l2a)
 
-                means = np.array(self.norm_stats[modality_]["mean"])[modality_idx]
-                stds = np.array(self.norm_stats[modality_]["std"])[modality_idx]
-                if modality in ["era5", "lat", "lon", "month"]:
-                    # single value mean and std
-                    data = (data - means) / stds
-                else:
-                    # single value mean and std for each band
-                    data = (data - means[:, None, None]) / stds[:, None, None]
-
-            # converting the nodata values to nan to keep everything consistent
-            data = (
-                np.where(data == NO_DATA_VAL[modality], np.nan, data)
-                if modality != "dynamic_world"
-                else data
-            )
+        # we also return the id, to differentiate between sentinel2_l1c and sentinel2_l2a, since this is given in the tile_info json file. To keep everything
+        # consistent, we name the modality as sentinel2 instead of sentinel2_l1c or sentinel2_l2a
+        return_dict["id"] = name
+
+        return self._finalize(return_dict)
+
+    def __getitems__(self, idxs: list[int]):
+        """Batched version of __getitem__, every modality is returned stacked along a new first axis.
 
-            if MODALITY_TASK[modality] in ["classification", "segmentation"]:
-                data = data.astype(np.dtype("int64"))
+        The requested samples are sorted by their position in the h5 file and read with as few
+        hyperslab selections as possible (see ``coalesce_rows``), instead of one read per sample
+        and modality. Use ``collate_stacked`` as collate function of the DataLoader.
+        """
+        if not hasattr(self, "data_full"):
+            self._open_hdf5(self.data_path)
+
+        # unique sorted rows in the h5 file, and where each requested sample is found in them
+        rows, batch_pos = np.unique(
+            np.asarray(self.indices)[np.asarray(idxs, dtype=np.int64)],
+            return_inverse=True,
+        )
+
+        return_dict = OrderedDict()
+        names = self.tile_index.names(rows[batch_pos])
+        l2a = self.tile_index.l2a[rows][batch_pos]
+
+        for modality, plan in self.read_plan.items():
+            band_idx = slice(None) if plan.one_hot else plan.h5_idx
+            data = read_rows(self.data_full[modality], rows, band_idx)[batch_pos]
+            return_dict[modality] = self._process(modality, plan, data, l2a)
+
+        if self.sentinel2_storage == "int16":
+            return_dict["sentinel2_l2a"] = l2a.astype(np.int64)
+
+        return_dict["id"] = names
+
+        return self._finalize(return_dict)
+
+    def _process(
+        self,
+        modality: str,
+        plan: ModalityReadPlan,
+        data: np.ndarray,
+        l2a: Union[bool, np.ndarray],
+    ) -> np.ndarray:
+        """Reorders, remaps and normalizes the raw data of a single sample or of a stacked batch."""
+        if plan.one_hot:
+            # for these modalities the array is already one hot encoded. hence modality_idx is not needed.
+            data = np.argmax(data, axis=-1)
+        elif plan.inverse_idx is not None:
+            # the band axis is the first axis of a sample, with a leading batch axis if stacked
+            data = np.take(data, plan.inverse_idx, axis=data.ndim - plan.ndim)
+
+        if modality == "sentinel2" and self.sentinel2_storage == "int16":
+            # raw reflectances, the int16 view keeps the bits of uint16 data
+            assert data.dtype in [np.uint16, np.int16], f"can't store {data.dtype} as int16"
+            return data.view(np.int16)
+
+        if plan.label_lut is not None:
+            # class values to class indices, nodata and unknown values to SEGMENTATION_IGNORE_INDEX
+            data = remap_labels(data, plan.label_lut)
+
+        # normalize
+        if plan.mean:
+            if np.ndim(l2a) == 0:
+                stats_name = plan.stats_names[int(l2a)]
+                data = (data - plan.mean[stats_name]) / plan.std[stats_name]
             else:
-                data = data.astype(np.dtype("float32"))
+                # samples of a batch can come from l1c and l2a tiles
+                normalized = np.empty(data.shape, dtype=np.float32)
+                for flag in np.unique(l2a):
+                    stats_name = plan.stats_names[int(flag)]
+                    mask = l2a == flag
+                    normalized[mask] = (data[mask] - plan.mean[stats_name]) / plan.std[stats_name]
+                data = normalized
 
-            return_dict[modality] = data
+        # converting the nodata values to nan to keep everything consistent, segmentation maps use an ignore index
+        if plan.label_lut is None:
+            data = np.where(data == plan.nodata, np.nan, data)
 
-        # we also return the id, to differentiate between sentinel2_l1c and sentinel2_l2a, since this is given in the tile_info json file. To keep everything
-        # consistent, we name the modality as sentinel2 instead of sentinel2_l1c or sentinel2_l2a
-        return_dict["id"] = name
+        return data.astype(plan.dtype, copy=False)
 
+    def _finalize(self, return_dict: OrderedDict):
         # apply transforms on normalized data
         if self.transform is not None:
             return_dict = self.apply_transform(return_dict)
@@ -190,6 +376,59 @@ class MMEarthDataset(Dataset):
         return return_dict
 
 
+def coalesce_rows(rows: np.ndarray, max_gap: int = 0) -> list[Tuple[int, int]]:
+    """Groups sorted, unique row indices into (start, stop) spans.
+
+    Rows are merged into one span if less than max_gap rows are skipped in between. With max_gap set to
+    the chunk length of the h5 dataset, skipped rows never cause an additional chunk to be read.
+    """
+    if len(rows) == 0:
+        return []
+    breaks = np.nonzero(np.diff(rows) - 1 >= max(max_gap, 1))[0] + 1
+    return [
+        (int(span[0]), int(span[-1]) + 1) for span in np.split(rows, breaks)
+    ]
+
+
+def read_rows(
+    h5_dataset: h5py.Dataset, rows: np.ndarray, band_idx: Union[np.ndarray, slice] = slice(None)
+) -> np.ndarray:
+    """Reads sorted, unique rows (first axis) of a h5 dataset into one preallocated array.
+
+    Rows are read in contiguous or chunk aligned hyperslabs (see ``coalesce_rows``), skipped rows of a
+    hyperslab are dropped in memory.
+    """
+    max_gap = h5_dataset.chunks[0] if h5_dataset.chunks is not None else 0
+    sample_shape = list(h5_dataset.shape[1:])
+    if sample_shape:
+        if isinstance(band_idx, slice):
+            sample_shape[0] = len(range(*band_idx.indices(sample_shape[0])))
+        else:
+            sample_shape[0] = len(band_idx)
+    out = np.empty((len(rows), *sample_shape), dtype=h5_dataset.dtype)
+    pos = 0
+    for start, stop in coalesce_rows(rows, max_gap):
+        n_rows = np.searchsorted(rows, stop) - pos
+        if h5_dataset.ndim == 1:
+            span = h5_dataset[start:stop]
+        else:
+            span = h5_dataset[start:stop, band_idx]
+        out[pos : pos + n_rows] = span[rows[pos : pos + n_rows] - start]
+        pos += n_rows
+    return out
+
+
+def collate_stacked(batch: Union[tuple, dict]) -> Union[list, dict]:
+    """Collate function for batches that are already stacked by ``MMEarthDataset.__getitems__``."""
+
+    def convert(value):
+        return to_tensor(value) if isinstance(value, np.ndarray) else value
+
+    if isinstance(batch, dict):
+        return {k: convert(v) for k, v in batch.items()}
+    return [convert(v) for v in batch]
+
+
 def get_single_glob_file(data_root: Path, pattern) -> Path:
     file = [f for f in data_root.glob(pattern)]
     assert len(file) < 2, f"too many {pattern} files at {data_root}"
@@ -205,8 +444,9 @@ def create_MMEearth_args(
     args.data_path = get_single_glob_file(data_root, "data_*.h5")
     args.splits_path = get_single_glob_file(data_root, "data_*_splits.json")
     args.tile_info_path = get_single_glob_file(data_root, "data_*_tile_info.json")
-    with open(args.tile_info_path, "r") as f:
-        args.tile_info = json.load(f)
+    args.tile_index = load_tile_index(
+        args.data_path, args.tile_info_path, args.splits_path
+    )
     args.band_stats_path = get_single_glob_file(data_root, "data_*_band_stats.json")
     with open(args.band_stats_path, "r") as f:
         args.band_stats = json.load(f)
@@ -229,6 +469,10 @@ def get_mmearth_dataloaders(
     splits: list[str] = None,
     no_ffcv: bool = False,
     indices: list[list[int]] = None,
+    storage: str = "float32",
+    num_shards: int = 1,
+    sequential: bool = False,
+    start_sample: int = 0,
 ) -> list[Union[ffcv.Loader, DataLoader]]:
     """
     Creates and returns data loaders for the MMEarth dataset. If the processed beton file does not exist, it processes the data
@@ -243,7 +487,8 @@ def get_mmearth_dataloaders(
     input_modality : dict
         A dictionary specifying the input modality configurations.
     target_modality : dict
-        A dictionary specifying the target modality configurations.
+        A dictionary specifying the target modality configurations. Several target modalities can be given, they are
+        returned after the input in the order they are stored in the beton file.
     num_workers : int
         The number of worker threads to use for data loading.
     batch_size_per_device : int
@@ -254,6 +499,20 @@ def get_mmearth_dataloaders(
         Disables the creation of beton file and return torch Dataloader instead. Default is False.
     indices: list[list[int]], optional
         Select indices to use for each split (starting at 0). Default is None, meaning all samples are used. Only with FFCV enabled.
+    storage: str, optional
+        How sentinel2 is stored in the beton files: "float32", "float16" or "int16" (raw reflectances, normalized
+        per batch while loading, see `data.storage.Dequantize`). Default is "float32". Only with FFCV enabled.
+    num_shards: int, optional
+        Number of beton files each split is written to. Shards are converted in parallel processes, finished shards
+        are kept if the conversion is interrupted. The shards are loaded with `data.sharding.ShardedLoader`.
+        Default is 1, a single beton file per split. Only with FFCV enabled.
+    sequential: bool, optional
+        Loads every split (including train) in the order of the split file without dropping the last batch, e.g., to
+        export embeddings. Default is False, the train split is shuffled.
+    start_sample: int, optional
+        With `sequential`, the loaders start at this sample of the split (over all shards), e.g., to resume an export.
+        Shards before it are not loaded, the shard it is in is loaded from it on. If no sample is left, the loader of
+        the split is None. Default is 0. Only with FFCV enabled.
 
     Returns:
     -------
@@ -288,6 +547,12 @@ def get_mmearth_dataloaders(
     -----
     - The function checks if the processed beton file exists for each split. If it doesn't exist, it processes the data
       and creates the beton file.
+    - Beton file names contain a hash of the band selection, band stats, split file, indices and converter version.
+      A JSON manifest is written next to each beton file and validated before the file is reused (see `data.beton_cache`).
+    - A beton file holds sentinel2 and every target modality requested so far, each in its own field. Only the fields
+      of the requested targets are decoded. Requesting a new target converts the split again, adding it to the file.
+    - Beton files are created by a single process (e.g., one of several DDP ranks) under a file lock and written to a
+      temporary file first, the other processes wait for the lock and reuse the finished file.
     - The input and target modalities are reverse looked up using `IN_MODALITIES` and `MODALITIES_FULL` respectively.
     - The `convert_mmearth` function is used to convert the dataset into beton format.
     - The `ffcv.Loader` is used to create the data loaders with appropriate pipelines for training and validation.
@@ -298,6 +563,9 @@ def get_mmearth_dataloaders(
     assert not no_ffcv or (
         no_ffcv and indices is None
     ), "Providing indices is not supported in no_ffcv mode."
+    assert start_sample == 0 or (
+        sequential and not no_ffcv
+    ), "start_sample is only supported for sequential ffcv loaders."
     assert indices is None or (len(indices) == len(splits)), (
         "If indices are given, the number of splits and number of list of indices"
         "must align (len(indices) != len(splits) = ({len(indices)} != {len(splits))}"
@@ -312,30 +580,55 @@ def get_mmearth_dataloaders(
     # only one input modality at a time supported TODO
     input_name = list(input_modality.keys())[0].replace("_", "-")
 
-    # reverse lookup target modality
-    if target_modality is None:
-        target_name = ""
-    else:
-        # only one task supported TODO
-        target_name = list(target_modality.keys())[0].replace("_", "-")
+    # everything that determines the content of the beton files, besides split and indices
+    data_path = get_single_glob_file(data_dir, "data_*.h5")
+    splits_path = get_single_glob_file(data_dir, "data_*_splits.json")
+    tile_info_path = get_single_glob_file(data_dir, "data_*_tile_info.json")
+    band_stats_path = get_single_glob_file(data_dir, "data_*_band_stats.json")
+    sources = [data_path, splits_path, tile_info_path, band_stats_path]
+    # the targets are not part of the file name, a single beton file holds all of them (see below)
+    key_parts = {
+        "dataset": data_dir.name,
+        "converter_version": CONVERTER_VERSION,
+        "input_modality": input_modality,
+        "band_stats": content_digest(band_stats_path),
+        "splits": content_digest(splits_path),
+        "storage": storage,
+    }
+
+    # Data decoding and augmentation
+    # Pipeline for each data field
+    pipelines = {
+        "sentinel2": [NDArrayDecoder(), ToTensor()],
+    }
+    if storage == "float16":
+        pipelines["sentinel2"].append(Convert(torch.float32))
+
+    if target_modality is not None:
+        for modality, bands in target_modality.items():
+            pipelines[modality] = target_pipeline(modality, len(bands))
+
+    if storage == "int16":
+        pipelines["sentinel2_l2a"] = [IntDecoder(), ToTensor(), Squeeze([1])]
 
     dataloaders = []
     for i, split in enumerate(splits):
         is_train = split == "train"
-        subset = "" if indices is None else "_subset"
-        beton_file = processed_dir / f"{split}_{input_name}_{target_name}{subset}.beton"
+        shuffle = is_train and not sequential
+        idx = None if indices is None else indices[i]
+        split_key_parts = {**key_parts, "split": split, "indices": hash_indices(idx)}
+        beton_file = get_beton_file(
+            processed_dir, f"{split}_{input_name}", split_key_parts
+        )
 
-        if not beton_file.exists() or no_ffcv:
-            if not no_ffcv:
-                print_rank_zero(
-                    f"Processed file {beton_file} does not exist, trying to create it now."
-                )
-                transform = None
-            else:
-                transform = to_tensor
+        if no_ffcv:
             args = create_MMEearth_args(data_dir, input_modality, target_modality)
             dataset = MMEarthDataset(
-                args, split=split, transform=transform, return_tuple=True
+                args,
+                split=split,
+                transform=to_tensor,
+                return_tuple=True,
+                cache_chunks=CHUNK_SHUFFLE_WINDOW if shuffle else None,
             )
 
             if len(dataset) == 0:
@@ -346,71 +639,232 @@ def get_mmearth_dataloaders(
                 dataloaders.append(None)
                 continue
 
-            if no_ffcv:
+            # batches are read at once via MMEarthDataset.__getitems__
+            if shuffle:
+                # shuffle only within a window of hdf5 chunks, which are then served from the chunk cache. The
+                # sampler splits the samples between the DDP ranks itself (see `shards_by_rank`)
+                with h5py.File(args.data_path, "r") as f:
+                    chunk_rows = get_chunk_rows(f["sentinel2"])
                 dataloader = DataLoader(
                     dataset,
+                    sampler=ChunkShuffleSampler(
+                        dataset.indices, chunk_rows, window=CHUNK_SHUFFLE_WINDOW
+                    ),
                     batch_size=batch_size_per_device,
-                    shuffle=is_train,
+                    drop_last=True,
+                    collate_fn=collate_stacked,
                     num_workers=num_workers,
-                    drop_last=is_train,
                     persistent_workers=num_workers > 0,
                 )
-                dataloaders.append(dataloader)
-                continue
             else:
-                input_shape = (
-                    sum([len(input_modality[k]) for k in input_modality]),
-                    ori_input_size,
-                    ori_input_size,
-                )
-                idx = None if indices is None else indices[i]
-                convert_mmearth_to_beton(
+                # each DDP rank reads its own consecutive rows
+                dataloader = DataLoader(
                     dataset,
-                    beton_file,
+                    batch_sampler=SortedBatchSampler(
+                        DistributedSequentialSampler(len(dataset)),
+                        batch_size=batch_size_per_device,
+                        drop_last=False,
+                        rows=dataset.indices,
+                    ),
+                    collate_fn=collate_stacked,
                     num_workers=num_workers,
-                    input_shape=input_shape,
-                    indices=idx,
+                    persistent_workers=num_workers > 0,
+                )
+            dataloaders.append(dataloader)
+            continue
+
+        if idx is None:
+            tile_index = load_tile_index(data_path, tile_info_path, splits_path)
+            split_indices = list(range(len(tile_index.split(split))))
+        else:
+            split_indices = idx
+
+        # a single beton file or a set of shards, each with its own manifest
+        split_shards = max(min(num_shards, len(split_indices)), 1)
+        if split_shards > 1:
+            beton_files = get_shard_files(beton_file, split_shards)
+            shard_key_parts = [
+                {**split_key_parts, "shard": j, "num_shards": split_shards}
+                for j in range(split_shards)
+            ]
+        else:
+            beton_files = [beton_file]
+            shard_key_parts = [split_key_parts]
+
+        # only one process (e.g., one of several ranks) validates and creates the files, the others wait for it
+        with beton_lock(beton_file):
+            # the files keep the targets of earlier runs, files without the requested targets are converted again
+            # with all of them, so that runs with different targets share a single file
+            beton_targets = {}
+            for file in beton_files:
+                manifest = read_manifest(file)
+                if manifest is not None:
+                    beton_targets.update(manifest["metadata"].get("targets", {}))
+            beton_targets.update(target_modality or {})
+            shard_key_parts = [
+                {**file_key_parts, "targets": beton_targets}
+                for file_key_parts in shard_key_parts
+            ]
+            # stored targets that are not requested are not decoded
+            split_pipelines = {
+                **{modality: None for modality in beton_targets},
+                **pipelines,
+            }
+
+            for file, file_key_parts in zip(beton_files, shard_key_parts):
+                if file.exists() and not validate_beton(
+                    file, file_key_parts, sources, split_pipelines
+                ):
+                    remove_beton(file)
+
+            missing = [j for j, file in enumerate(beton_files) if not file.exists()]
+            if missing:
+                print_rank_zero(
+                    f"Processed file {beton_file} does not exist, trying to create it now."
                 )
+                if len(split_indices) == 0:
+                    assert not is_train, "training dataset has no samples"
+                    print_rank_zero(
+                        f"No samples in evaluation split '{split}', skipping it"
+                    )
+                    dataloaders.append(None)
+                    continue
 
-        # Data decoding and augmentation
-        # Pipeline for each data field
-        pipelines = {
-            "sentinel2": [NDArrayDecoder(), ToTensor()],
-        }
-
-        if target_modality is not None:
-            pipelines.update(
-                {
-                    "label": [
-                        IntDecoder(),
-                        ToTensor(),
-                        Squeeze([1]),
-                    ],  # this will only work for classification TODO
-                }
-            )
+                # the size of the stored images, e.g., smaller for synthetic data
+                with h5py.File(data_path, "r") as f:
+                    image_size = f["sentinel2"].shape[-2:]
+                input_shape = (
+                    sum([len(input_modality[k]) for k in input_modality]),
+                    *image_size,
+                )
+                shards = shard_indices(split_indices, split_shards)
+                jobs = [
+                    dict(
+                        data_dir=data_dir,
+                        input_modality=input_modality,
+                        target_modality=beton_targets or None,
+                        split=split,
+                        beton_file=beton_files[j],
+                        key_parts=shard_key_parts[j],
+                        sources=sources,
+                        input_shape=input_shape,
+                        indices=shards[j] if split_shards > 1 else idx,
+                        storage=storage,
+                    )
+                    for j in missing
+                ]
+                if split_shards > 1:
+                    # each shard is converted in its own process, the cpus are shared between them
+                    num_processes = min(len(jobs), max(num_workers, 1))
+                    for job in jobs:
+                        job["num_workers"] = max(num_workers // num_processes, 1)
+                    run_shard_jobs(
+                        convert_mmearth_split,
+                        jobs,
+                        num_processes,
+                        get_progress_file(beton_file),
+                    )
+                else:
+                    convert_mmearth_split(**jobs[0], num_workers=num_workers)
 
         # Replaces PyTorch data loader (`torch.utils.data.Dataloader`)
-        dataloader = ffcv.Loader(
-            beton_file,
-            batch_size=batch_size_per_device,
-            num_workers=num_workers,
-            order=OrderOption.QUASI_RANDOM if is_train else OrderOption.SEQUENTIAL,
-            pipelines=pipelines,
-            drop_last=is_train,
-        )
+        loaders = []
+        # shuffled shards are iterated at the same time and share the workers, sequential ones one after the other
+        shard_workers = max(num_workers // len(beton_files), min(num_workers, 1)) if shuffle else num_workers
+        shard_start = 0
+        for file, shard in zip(beton_files, shard_indices(split_indices, split_shards)):
+            shard_end = shard_start + len(shard)
+            if start_sample > 0 and shard_end <= start_sample:
+                # shard before start_sample
+                shard_start = shard_end
+                continue
+            loaders.append(
+                ffcv.Loader(
+                    file,
+                    batch_size=batch_size_per_device,
+                    num_workers=shard_workers,
+                    order=OrderOption.QUASI_RANDOM if shuffle else OrderOption.SEQUENTIAL,
+                    pipelines=split_pipelines,
+                    drop_last=shuffle,
+                    indices=(
+                        np.arange(start_sample - shard_start, len(shard))
+                        if start_sample > shard_start
+                        else None
+                    ),
+                )
+            )
+            shard_start = shard_end
+        if not loaders:
+            print_rank_zero(f"No samples after sample {start_sample} of split '{split}', skipping it")
+            dataloaders.append(None)
+            continue
+        if split_shards > 1:
+            dataloader = ShardedLoader(loaders, shuffle=shuffle)
+        else:
+            dataloader = loaders[0]
+        if storage == "int16":
+            # normalization of the raw reflectances as batched tensor operation
+            dequantize = Dequantize.from_metadata(read_manifest(beton_files[0])["metadata"])
+            dataloader = DequantizingLoader(dataloader, dequantize)
 
         dataloaders.append(dataloader)
 
     return dataloaders
 
 
+def convert_mmearth_split(
+    data_dir: Path,
+    input_modality: dict,
+    target_modality: dict,
+    split: str,
+    beton_file: Path,
+    key_parts: dict,
+    sources: list[Path],
+    input_shape: Tuple[int, int, int],
+    indices: list = None,
+    storage: str = "float32",
+    num_workers: int = -1,
+) -> int:
+    """Converts (the given indices of) a split into a beton file and writes its manifest.
+
+    All arguments are picklable, so that shards of a split can be converted in separate processes.
+    Returns the number of converted samples.
+    """
+    args = create_MMEearth_args(data_dir, input_modality, target_modality)
+    dataset = MMEarthDataset(
+        args, split=split, return_tuple=True, sentinel2_storage=storage
+    )
+    with atomic_beton(beton_file) as tmp_file:
+        fields = convert_mmearth_to_beton(
+            dataset,
+            tmp_file,
+            num_workers=num_workers,
+            input_shape=input_shape,
+            indices=indices,
+        )
+    num_samples = len(dataset) if indices is None else len(indices)
+    write_manifest(
+        beton_file,
+        key_parts,
+        num_samples=num_samples,
+        fields=fields,
+        sources=sources,
+        metadata={
+            "targets": target_modality or {},
+            **(quantization_metadata(dataset) if storage == "int16" else {}),
+        },
+    )
+    return num_samples
+
+
 def convert_mmearth_to_beton(
     dataset: MMEarthDataset,
     write_path: Path,
     input_shape: Tuple[int, int, int] = (12, 128, 128),
     num_workers: int = -1,
     indices: list = None,
-):
+    block_size: int = 100,
+) -> dict:
     """
     Converts a MMEarth dataset into a format optimized for a specified machine learning task and writes it to a specified path.
 
@@ -426,27 +880,38 @@ def convert_mmearth_to_beton(
         The number of worker threads to use for writing the dataset. A value of -1 indicates that the default number of workers should be used. Default is -1.
     indices : list, optional
         Indices to select from dataset, good for subset creation.
+    block_size : int, optional
+        Number of samples that are read from the h5 file at once (see `BlockReadDataset`). Default is 100.
 
     Fields:
     ------
     sentinel2 : NDArrayField
-        A field for storing Sentinel-2 data with a specified shape and data type float32.
-    label : IntField or FloatField or NDArrayField
-        A field for storing labels, the type of which depends on the supervised_task parameter:
-            - IntField for classification.
-            - NDArrayField(dtype=np.dtype("float32"), shape=(c)) for regression.
+        A field for storing Sentinel-2 data with a specified shape and the data type of `dataset.sentinel2_storage`
+        (float32 or float16 normalized data, or int16 raw reflectances).
+    <target modality> : IntField or FloatField or NDArrayField
+        One field per target modality of the dataset (e.g., biome, era5), named after the modality. The type
+        depends on the task of the modality (see `target_field`):
+            - IntField (single band) or NDArrayField(dtype=np.dtype("int64"), shape=(c)) for classification.
+            - FloatField (single band) or NDArrayField(dtype=np.dtype("float32"), shape=(c)) for regression.
             - NDArrayField(dtype=np.dtype("int64"), shape=(c, input_shape[1], input_shape[2])) for segmentation.
             - NDArrayField(dtype=np.dtype("float32"), shape=(c, input_shape[1], input_shape[2])) for regression map.
+    sentinel2_l2a : IntField
+        Only for int16 storage, whether the sample is from a l2a tile, used for the normalization when loading.
 
     Process:
     -------
     1. Field Initialization:
         Initializes the fields dictionary with a sentinel2 field.
-        Adds a label field to the fields dictionary based on the supervised_task.
+        Adds a field for every target modality based on its supervised task.
     2. Dataset Writing:
         Creates a DatasetWriter instance with the specified write_path, fields, and num_workers.
         Writes the dataset using the from_indexed_dataset method of the DatasetWriter.
 
+    Returns:
+    -------
+    dict
+        The fields written to the beton file.
+
     Example Usage:
     --------------
     ```python
@@ -467,57 +932,118 @@ def convert_mmearth_to_beton(
 
     fields = {
         # Tune options to optimize dataset size, throughput at train-time
-        "sentinel2": NDArrayField(dtype=np.dtype("float32"), shape=input_shape),
+        "sentinel2": NDArrayField(
+            dtype=np.dtype(dataset.sentinel2_storage), shape=input_shape
+        ),
     }
 
-    # if more than 1 modality is selected, we expect the second one to be the supervised task
-    if len(dataset.modalities) >= 2:
-        # only supporting single task here, so check the task and prepare fiel accordingly
-        assert (
-            len(dataset.modalities) == 2
-        ), f"only two modalities should be returned, got: {dataset.modalities.keys()}"
-        target_name, targets = [
-            (k, v) for k, v in dataset.modalities.items() if k != "sentinel2"
-        ][0]
-        c = len(targets)  # number targets
-        supervised_task = MODALITY_TASK[target_name]
-
-        if supervised_task == "classification":
-            if c == 1:
-                fields.update({"label": IntField()})
-            else:
-                fields.update(
-                    {"label": NDArrayField(dtype=np.dtype("int64"), shape=(c,))}
-                )
+    # every other modality is a target, stored in its own field named after the modality
+    for modality, bands in dataset.modalities.items():
+        if modality != "sentinel2":
+            fields[modality] = target_field(modality, len(bands), input_shape)
 
-        elif supervised_task == "segmentation":
-            fields.update(
-                {
-                    "label": NDArrayField(
-                        dtype=np.dtype("int64"),
-                        shape=(c, input_shape[1], input_shape[2]),
-                    )
-                }
-            )
-        elif supervised_task == "regression":
-            if c == 1:
-                fields.update({"label": FloatField()})
-            else:
-                fields.update(
-                    {"label": NDArrayField(dtype=np.dtype("float32"), shape=(c,))}
-                )
-        elif supervised_task == "regression_map":
-            fields.update(
-                {
-                    "label": NDArrayField(
-                        dtype=np.dtype("float32"),
-                        shape=(c, input_shape[1], input_shape[2]),
-                    )
-                }
-            )
+    if dataset.sentinel2_storage == "int16":
+        # needed to select the normalization of the raw reflectances
+        fields.update({"sentinel2_l2a": IntField()})
 
     # Pass a type for each data field
     writer = DatasetWriter(write_path, fields, num_workers=num_workers)
 
-    # Write dataset
-    writer.from_indexed_dataset(dataset, indices=indices)
+    # Write dataset, the writer chunks are aligned with the blocks that are read at once
+    writer.from_indexed_dataset(
+        BlockReadDataset(dataset, block_size=block_size, indices=indices),
+        indices=indices,
+        chunksize=block_size,
+    )
+    return fields
+
+
+def target_field(modality: str, c: int, input_shape: Tuple[int, int, int]):
+    """ffcv field of a target modality with c bands, the type depends on the task (see MODALITY_TASK)."""
+    supervised_task = MODALITY_TASK[modality]
+    if supervised_task == "classification":
+        if c == 1:
+            return IntField()
+        return NDArrayField(dtype=np.dtype("int64"), shape=(c,))
+    if supervised_task == "segmentation":
+        return NDArrayField(
+            dtype=np.dtype("int64"), shape=(c, input_shape[1], input_shape[2])
+        )
+    if supervised_task == "regression":
+        if c == 1:
+            return FloatField()
+        return NDArrayField(dtype=np.dtype("float32"), shape=(c,))
+    if supervised_task == "regression_map":
+        return NDArrayField(
+            dtype=np.dtype("float32"), shape=(c, input_shape[1], input_shape[2])
+        )
+    raise ValueError(f"unknown task '{supervised_task}' of modality '{modality}'")
+
+
+def target_pipeline(modality: str, c: int) -> list:
+    """ffcv pipeline that decodes the field created by `target_field`."""
+    if c == 1 and MODALITY_TASK[modality] == "classification":
+        return [IntDecoder(), ToTensor(), Squeeze([1])]
+    if c == 1 and MODALITY_TASK[modality] == "regression":
+        return [FloatDecoder(), ToTensor(), Squeeze([1])]
+    return [NDArrayDecoder(), ToTensor()]
+
+
+def quantization_metadata(dataset: MMEarthDataset) -> dict:
+    """Per band scale and offset (l1c and l2a) that normalize raw sentinel2 data, see Dequantize."""
+    plan = dataset.read_plan["sentinel2"]
+    with h5py.File(dataset.data_path, "r") as f:
+        unsigned = f["sentinel2"].dtype == np.uint16
+    scale, offset = [], []
+    missing = np.full_like(next(iter(plan.mean.values())), np.nan)
+    for stats_name in plan.stats_names:
+        # missing stats result in nan for the samples concerned
+        mean = plan.mean.get(stats_name, missing)
+        std = plan.std.get(stats_name, missing)
+        scale.append((1 / std).reshape(-1).tolist())
+        offset.append((-mean / std).reshape(-1).tolist())
+    return {
+        "storage": dataset.sentinel2_storage,
+        "scale": scale,
+        "offset": offset,
+        "nodata": plan.nodata,
+        "unsigned": bool(unsigned),
+    }
+
+
+class BlockReadDataset(Dataset):
+    """Serves single samples of a MMEarthDataset from blocks read via ``MMEarthDataset.__getitems__``.
+
+    The ffcv DatasetWriter requests one sample at a time, walking through chunks of consecutive
+    positions in `indices`. On the first access to a block, all samples of the block are read at once.
+    """
+
+    def __init__(self, dataset: MMEarthDataset, block_size: int, indices: list = None):
+        assert dataset.return_tuple, "samples are expected as tuples"
+        self.dataset = dataset
+        self.block_size = block_size
+        self.indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+        # position of each dataset index in the writing order
+        self.positions = np.full(len(dataset), -1, dtype=np.int64)
+        self.positions[self.indices] = np.arange(len(self.indices))
+        self._block_id = None
+        self._block = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int):
+        pos = self.positions[idx]
+        if pos < 0:
+            return self.dataset[idx]
+
+        block_id = pos // self.block_size
+        if block_id != self._block_id:
+            block_indices = self.indices[
+                block_id * self.block_size : (block_id + 1) * self.block_size
+            ]
+            self._block = self.dataset.__getitems__(block_indices.tolist())
+            self._block_id = block_id
+
+        i = pos % self.block_size
+        return tuple(value[i] for value in self._block)
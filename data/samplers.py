@@ -0,0 +1,167 @@
+import math
+from typing import Iterator, Sequence, Union
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import BatchSampler, Sampler
+
+
+class SortedBatchSampler(BatchSampler):
+    """Batches the indices of a sampler and sorts each batch by the position of the samples in the h5 file.
+
+    Which samples end up in a batch is decided by the wrapped sampler, only the order within a batch
+    changes. Together with ``MMEarthDataset.__getitems__`` this allows neighbouring samples of a batch
+    to be read in a single hyperslab.
+
+    `rows` is optional so that the sampler keeps the ``BatchSampler`` signature, which Lightning uses to
+    re-create it with a ``DistributedSampler`` under DDP. Without `rows`, batches are sorted by dataset
+    index, which is the same order for datasets whose indices follow the h5 rows (sorted split rows).
+    """
+
+    def __init__(
+        self,
+        sampler: Union[Sampler[int], Sequence[int]],
+        batch_size: int,
+        drop_last: bool,
+        rows: Union[Sequence[int], None] = None,
+    ):
+        super().__init__(sampler, batch_size, drop_last)
+        # position in the h5 file of each dataset index
+        self.rows = None if rows is None else np.asarray(rows)
+
+    def __iter__(self) -> Iterator[list[int]]:
+        for batch in super().__iter__():
+            positions = batch if self.rows is None else self.rows[batch]
+            order = np.argsort(positions, kind="stable")
+            yield [batch[i] for i in order]
+
+
+def get_replicas(num_replicas: Union[int, None], rank: Union[int, None]) -> tuple[int, int]:
+    """Number of replicas (DDP ranks) and rank, the ones not given are taken from the process group."""
+    distributed = dist.is_available() and dist.is_initialized()
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if distributed else 1
+    if rank is None:
+        assert distributed or num_replicas == 1, (
+            f"rank is needed for {num_replicas} replicas without a process group"
+        )
+        rank = dist.get_rank() if distributed else 0
+    assert 0 <= rank < num_replicas, f"rank {rank} is not in [0, {num_replicas})"
+    return num_replicas, rank
+
+
+def rank_part(order: np.ndarray, num_replicas: int, rank: int) -> np.ndarray:
+    """Contiguous part of the order of a rank, padded like ``DistributedSampler`` so that all ranks get the
+    same number of samples."""
+    if num_replicas == 1:
+        return order
+    num_samples = math.ceil(len(order) / num_replicas)
+    # repeats the first samples to fill up the last rank
+    order = np.resize(order, num_samples * num_replicas)
+    return order[rank * num_samples : (rank + 1) * num_samples]
+
+
+class DistributedSequentialSampler(Sampler[int]):
+    """Dataset indices in order, each rank (DDP) gets a contiguous part of them.
+
+    Unlike ``DistributedSampler``, the ranks read consecutive rows of the h5 file. `num_replicas` and `rank`
+    default to the process group at iteration time, see ``ChunkShuffleSampler``.
+    """
+
+    def __init__(
+        self, num_samples: int, num_replicas: Union[int, None] = None, rank: Union[int, None] = None
+    ):
+        super().__init__()
+        self.num_samples = num_samples
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __len__(self) -> int:
+        num_replicas, _ = get_replicas(self.num_replicas, self.rank)
+        return math.ceil(self.num_samples / num_replicas)
+
+    def __iter__(self) -> Iterator[int]:
+        if self.num_samples == 0:
+            return
+        yield from rank_part(np.arange(self.num_samples), *get_replicas(self.num_replicas, self.rank)).tolist()
+
+
+class ChunkShuffleSampler(Sampler[int]):
+    """Shuffles samples such that reads stay local to a few HDF5 chunks at a time.
+
+    The chunks (blocks of `chunk_rows` consecutive rows in the h5 file) are shuffled first, then
+    `window` consecutive chunks of that order are combined and all samples within them are shuffled.
+    With a chunk cache that holds `window` chunks, every chunk is read from disk once per epoch, while
+    any sample can still end up next to samples from `window` different, randomly chosen chunks.
+
+    With several replicas (DDP ranks), every rank draws the same order and takes its own contiguous part of
+    it, padded like ``DistributedSampler`` so that all ranks get the same number of samples. `num_replicas`
+    and `rank` default to the process group at iteration time, which only exists once Lightning has started
+    the training, so the loader can be created before. Lightning must not replace the sampler, see
+    `shards_by_rank`.
+    """
+
+    def __init__(
+        self,
+        rows: Sequence[int],
+        chunk_rows: int,
+        window: int = 8,
+        seed: int = 0,
+        num_replicas: Union[int, None] = None,
+        rank: Union[int, None] = None,
+    ):
+        super().__init__()
+        self.rows = np.asarray(rows)
+        self.chunk_rows = max(chunk_rows, 1)
+        self.window = max(window, 1)
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.rng = np.random.default_rng(seed)
+
+        # dataset indices grouped by the chunk their row is stored in
+        chunk_ids = self.rows // self.chunk_rows
+        order = np.argsort(chunk_ids, kind="stable")
+        splits = np.nonzero(np.diff(chunk_ids[order]))[0] + 1
+        self.chunks = np.split(order, splits)
+
+    def set_epoch(self, epoch: int):
+        # makes the order reproducible per epoch, otherwise it changes with every iteration
+        self.rng = np.random.default_rng((self.seed, epoch))
+
+    def __len__(self) -> int:
+        num_replicas, _ = get_replicas(self.num_replicas, self.rank)
+        return math.ceil(len(self.rows) / num_replicas)
+
+    def __iter__(self) -> Iterator[int]:
+        if len(self.rows) == 0:
+            return
+        chunk_order = self.rng.permutation(len(self.chunks))
+        order = np.concatenate(
+            [
+                self.rng.permutation(
+                    np.concatenate([self.chunks[c] for c in chunk_order[start : start + self.window]])
+                )
+                for start in range(0, len(chunk_order), self.window)
+            ]
+        )
+        yield from rank_part(order, *get_replicas(self.num_replicas, self.rank)).tolist()
+
+
+def shards_by_rank(dataloader) -> bool:
+    """Whether the sampler of a DataLoader splits the samples between the DDP ranks itself.
+
+    Lightning replaces the sampler of every loader by a ``DistributedSampler`` under DDP, unless the Trainer is
+    created with ``use_distributed_sampler=False``.
+    """
+    sampler = getattr(dataloader, "sampler", None)
+    batch_sampler = getattr(dataloader, "batch_sampler", None)
+    samplers = [sampler, getattr(batch_sampler, "sampler", None)]
+    return any(isinstance(s, (ChunkShuffleSampler, DistributedSequentialSampler)) for s in samplers)
+
+
+def get_chunk_rows(h5_dataset, default: int = 64) -> int:
+    """Number of rows per HDF5 chunk, for contiguous datasets `default` rows are treated as one block."""
+    if h5_dataset.chunks is None:
+        return default
+    return h5_dataset.chunks[0]
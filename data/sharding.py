@@ -0,0 +1,120 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+from lightly.utils.dist import print_rank_zero
+
+
+def get_shard_files(beton_file: Path, num_shards: int) -> list[Path]:
+    """File names of a beton file set, e.g., train_..._<hash>.002-of-008.beton"""
+    return [
+        beton_file.with_name(f"{beton_file.stem}.{i:03d}-of-{num_shards:03d}.beton")
+        for i in range(num_shards)
+    ]
+
+
+def get_progress_file(beton_file: Path) -> Path:
+    return beton_file.with_suffix(".progress.json")
+
+
+def shard_indices(indices: list[int], num_shards: int) -> list[list[int]]:
+    """Splits the indices into contiguous ranges of (almost) equal size."""
+    return [shard.tolist() for shard in np.array_split(np.asarray(indices), num_shards)]
+
+
+def run_shard_jobs(
+    convert_fn: Callable[..., int],
+    jobs: list[dict],
+    num_processes: int,
+    progress_file: Path,
+):
+    """Runs convert_fn(**job) for every shard job, each shard in its own process.
+
+    convert_fn has to return the number of converted samples. Every finished shard is recorded in the
+    progress file, so an interrupted conversion can be resumed by only submitting the missing shards.
+    At the end the conversion throughput is reported.
+    """
+    progress = {"completed": {}}
+    if progress_file.exists():
+        with open(progress_file, "r") as f:
+            progress = json.load(f)
+    for job in jobs:
+        # shards that are converted (again) are not completed
+        progress["completed"].pop(Path(job["beton_file"]).name, None)
+    if progress["completed"]:
+        print_rank_zero(
+            f"Resuming conversion, {len(progress['completed'])} shards already converted."
+        )
+
+    num_samples = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, num_processes)) as executor:
+        futures = {
+            executor.submit(convert_fn, **job): (job, time.perf_counter())
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            job, job_start = futures[future]
+            n = future.result()
+            num_samples += n
+            progress["completed"][Path(job["beton_file"]).name] = {
+                "num_samples": n,
+                "seconds": time.perf_counter() - job_start,
+            }
+            with open(progress_file, "w") as f:
+                json.dump(progress, f, indent=2)
+            print_rank_zero(
+                f"Converted shard {Path(job['beton_file']).name} ({n} samples)."
+            )
+
+    duration = time.perf_counter() - start
+    print_rank_zero(
+        f"Converted {num_samples} samples in {len(jobs)} shards in {duration:.1f}s "
+        f"({num_samples / max(duration, 1e-9):.1f} samples/s)."
+    )
+
+
+class ShardedLoader:
+    """Loads a set of beton files (one ffcv.Loader each) as if it was a single loader.
+
+    Without shuffling, the loaders are iterated one after the other. With shuffling, each batch is taken
+    from a random loader, weighted by the number of batches that are left in it, so that batches of all
+    shards are mixed over the whole epoch. All shards are loaded at the same time then, the loaders should
+    share the workers (see `get_mmearth_dataloaders`).
+    """
+
+    def __init__(self, loaders: list, shuffle: bool, seed: int = 0):
+        self.loaders = loaders
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def num_samples(self) -> int:
+        # the indices of a loader select the samples of its beton file it loads
+        return sum(len(loader.indices) for loader in self.loaders)
+
+    @property
+    def batch_size(self) -> int:
+        return self.loaders[0].batch_size
+
+    def __len__(self):
+        return sum(len(loader) for loader in self.loaders)
+
+    def __iter__(self):
+        if not self.shuffle:
+            for loader in self.loaders:
+                yield from loader
+            return
+
+        iterators = [iter(loader) for loader in self.loaders]
+        remaining = np.array([len(loader) for loader in self.loaders], dtype=np.float64)
+        while remaining.sum() > 0:
+            i = self.rng.choice(len(iterators), p=remaining / remaining.sum())
+            remaining[i] -= 1
+            try:
+                yield next(iterators[i])
+            except StopIteration:
+                remaining[i] = 0
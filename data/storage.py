@@ -0,0 +1,65 @@
+import torch
+from torch import Tensor, nn
+
+# how sentinel2 is stored in beton files:
+# - float32: normalized data
+# - float16: normalized data in half precision
+# - int16: raw 16 bit reflectances, normalized while loading (see Dequantize)
+SENTINEL2_STORAGE = ["float32", "float16", "int16"]
+
+
+class Dequantize(nn.Module):
+    """Normalizes a batch of raw sentinel2 reflectances stored with `sentinel2_storage="int16"`.
+
+    Applies the same normalization as MMEarthDataset, expressed as per band scale (1 / std) and offset
+    (-mean / std), separately for samples from l1c and l2a tiles. Afterwards nodata values are set to nan.
+    """
+
+    def __init__(self, scale: list, offset: list, nodata: float, unsigned: bool):
+        super().__init__()
+        # scale and offset for l1c (index 0) and l2a (index 1) samples, shape: (2, bands, 1, 1)
+        self.register_buffer(
+            "scale", torch.tensor(scale, dtype=torch.float32)[..., None, None]
+        )
+        self.register_buffer(
+            "offset", torch.tensor(offset, dtype=torch.float32)[..., None, None]
+        )
+        self.nodata = nodata
+        # uint16 reflectances are stored with the same bits as int16
+        self.unsigned = unsigned
+
+    @classmethod
+    def from_metadata(cls, metadata: dict) -> "Dequantize":
+        return cls(
+            metadata["scale"], metadata["offset"], metadata["nodata"], metadata["unsigned"]
+        )
+
+    def forward(self, x: Tensor, l2a: Tensor) -> Tensor:
+        if self.unsigned:
+            x = x.to(torch.int32) & 0xFFFF
+        l2a = l2a.long().view(-1)
+        x = x.to(torch.float32) * self.scale[l2a] + self.offset[l2a]
+        # converting the nodata values to nan to keep everything consistent
+        return torch.where(x == self.nodata, torch.nan, x)
+
+
+class DequantizingLoader:
+    """Wraps a loader that yields (raw sentinel2, *targets, l2a) and yields (normalized sentinel2, *targets)."""
+
+    def __init__(self, loader, dequantize: Dequantize):
+        self.loader = loader
+        self.dequantize = dequantize
+
+    def __iter__(self):
+        for images, *rest, l2a in self.loader:
+            yield self.dequantize(images, l2a), *rest
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # without __init__ (e.g., copy or unpickling), there is no loader yet to forward to
+        if name == "loader" or "loader" not in self.__dict__:
+            raise AttributeError(name)
+        # everything else (e.g., reader, batch_size) is taken from the ffcv loader
+        return getattr(self.loader, name)
@@ -0,0 +1,414 @@
+"""Writes a synthetic MMEarth dataset with the same files and h5 schema as the real one, e.g., for tests and benchmarks.
+
+Example:
+    python -m data.synthetic --out-dir /tmp/mmearth_synthetic --num-samples 10000 --chunk-rows 64
+
+The directory can then be used as --data-dir of main.py and the benchmarks. The values are random, but every
+modality of MODALITIES_FULL has the dtype, shape, value range, class values and nodata value of the real data.
+"""
+import json
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import NamedTuple, Sequence, Union
+
+import h5py
+import numpy as np
+from lightly.utils.dist import print_rank_zero
+
+from .constants import (
+    CLASSIFICATION_CLASSES,
+    MODALITIES_FULL,
+    NO_DATA_VAL,
+    SEGMENTATION_CLASS_REMAP,
+    ori_input_size,
+)
+
+
+class ModalitySpec(NamedTuple):
+    """How a modality is stored in the MMEarth h5 file and which values are generated for it."""
+
+    dtype: str
+    # map: (bands, size, size), vector: (bands,), angle: (sin, cos), one_hot: (classes,)
+    kind: str
+    # value range of continuous modalities
+    low: float = 0.0
+    high: float = 1.0
+    # class values of categorical modalities
+    classes: tuple = ()
+    nodata: float = 0
+
+
+SYNTHETIC_MODALITIES = {
+    "sentinel2_cloudmask": ModalitySpec("uint16", "map", classes=(0, 1024, 2048), nodata=65535),
+    "sentinel2_cloudprob": ModalitySpec("uint16", "map", 0, 100, nodata=65535),
+    "sentinel2_scl": ModalitySpec(
+        "uint8", "map", classes=tuple(range(12)), nodata=NO_DATA_VAL["sentinel2_scl"]
+    ),
+    "sentinel2": ModalitySpec("uint16", "map", 1, 10000, nodata=NO_DATA_VAL["sentinel2"]),
+    "sentinel1": ModalitySpec("float32", "map", -30, 5, nodata=NO_DATA_VAL["sentinel1"]),
+    "aster": ModalitySpec("float32", "map", 0, 4000, nodata=NO_DATA_VAL["aster"]),
+    "canopy_height_eth": ModalitySpec(
+        "uint8", "map", 0, 60, nodata=NO_DATA_VAL["canopy_height_eth"]
+    ),
+    "lat": ModalitySpec("float32", "angle", -1, 1, nodata=NO_DATA_VAL["lat"]),
+    "lon": ModalitySpec("float32", "angle", -1, 1, nodata=NO_DATA_VAL["lon"]),
+    "month": ModalitySpec("float32", "angle", -1, 1, nodata=NO_DATA_VAL["month"]),
+    "era5": ModalitySpec("float32", "vector", -30, 40, nodata=NO_DATA_VAL["era5"]),
+    "esa_worldcover": ModalitySpec(
+        "uint8",
+        "map",
+        classes=tuple(SEGMENTATION_CLASS_REMAP["esa_worldcover"]),
+        nodata=NO_DATA_VAL["esa_worldcover"],
+    ),
+    "dynamic_world": ModalitySpec(
+        "uint8",
+        "map",
+        classes=tuple(SEGMENTATION_CLASS_REMAP["dynamic_world"]),
+        nodata=NO_DATA_VAL["dynamic_world"],
+    ),
+    "biome": ModalitySpec("uint8", "one_hot", classes=tuple(range(CLASSIFICATION_CLASSES["biome"]))),
+    "eco_region": ModalitySpec(
+        "uint8", "one_hot", classes=tuple(range(CLASSIFICATION_CLASSES["eco_region"]))
+    ),
+}
+
+# l2a tiles have no B10 band, it is nodata in the h5 file
+L2A_MISSING_BANDS = ["B10"]
+
+# maps are constant in blocks of this many pixels (plus noise), which compresses and caches like real images
+SMOOTHNESS = 8
+# the pixel noise of a map is a random window of a pool of normal values, drawing every value is a lot slower
+NOISE_POOL_SIZE = 1 << 20
+# number of samples per block the band stats are computed from
+STATS_SAMPLES = 32
+
+
+def sample_shape(modality: str, image_size: int) -> tuple:
+    spec = SYNTHETIC_MODALITIES[modality]
+    if spec.kind == "one_hot":
+        return (len(spec.classes),)
+    bands = len(MODALITIES_FULL[modality])
+    if spec.kind == "map":
+        return (bands, image_size, image_size)
+    return (bands,)
+
+
+def band_parameters(rng: np.random.Generator, modality: str) -> tuple[np.ndarray, np.ndarray]:
+    """Mean and std of every band of a continuous modality, for l1c (row 0) and l2a (row 1) tiles."""
+    spec = SYNTHETIC_MODALITIES[modality]
+    bands = len(MODALITIES_FULL[modality])
+    value_range = spec.high - spec.low
+    mean = spec.low + rng.uniform(0.2, 0.5, (2, bands)) * value_range
+    std = rng.uniform(0.05, 0.15, (2, bands)) * value_range
+    if modality != "sentinel2":
+        # only sentinel2 differs between l1c and l2a tiles
+        mean[1], std[1] = mean[0], std[0]
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
+def smooth_noise(rng: np.random.Generator, shape: tuple, image_size: int) -> np.ndarray:
+    """Standard normal noise of shape (*shape, size, size) that is constant in SMOOTHNESS x SMOOTHNESS blocks."""
+    low_res = -(-image_size // SMOOTHNESS)
+    noise = rng.standard_normal((*shape, low_res, low_res), dtype=np.float32)
+    return noise.repeat(SMOOTHNESS, axis=-2).repeat(SMOOTHNESS, axis=-1)[..., :image_size, :image_size]
+
+
+def pixel_noise(rng: np.random.Generator, shape: tuple) -> np.ndarray:
+    """Standard normal noise of shape (samples, bands, size, size), every map is a random window of a noise pool."""
+    map_size = shape[-2] * shape[-1]
+    pool = rng.standard_normal(max(NOISE_POOL_SIZE, 2 * map_size), dtype=np.float32)
+    windows = np.lib.stride_tricks.sliding_window_view(pool, map_size)
+    offsets = rng.integers(0, len(windows), shape[0] * shape[1])
+    return windows[offsets].reshape(shape)
+
+
+def generate_block(
+    rng: np.random.Generator,
+    modality: str,
+    l2a: np.ndarray,
+    image_size: int,
+    parameters: tuple[np.ndarray, np.ndarray],
+    nodata_fraction: float,
+    missing_fraction: float,
+) -> np.ndarray:
+    """Random data of a modality for len(l2a) samples, in the dtype and shape of the h5 dataset."""
+    spec = SYNTHETIC_MODALITIES[modality]
+    n = len(l2a)
+    shape = (n, *sample_shape(modality, image_size))
+
+    if spec.kind == "one_hot":
+        data = np.zeros(shape, dtype=spec.dtype)
+        data[np.arange(n), rng.integers(0, len(spec.classes), n)] = 1
+        return data
+
+    if spec.kind == "angle":
+        angle = rng.uniform(0, 2 * np.pi, n)
+        data = np.stack([np.sin(angle), np.cos(angle)], axis=1)
+    elif spec.classes:
+        if spec.kind == "map":
+            low_res = -(-image_size // SMOOTHNESS)
+            classes = rng.integers(0, len(spec.classes), (*shape[:2], low_res, low_res))
+            classes = classes.repeat(SMOOTHNESS, axis=-2).repeat(SMOOTHNESS, axis=-1)
+            classes = classes[..., :image_size, :image_size]
+        else:
+            classes = rng.integers(0, len(spec.classes), shape)
+        data = np.asarray(spec.classes)[classes]
+    else:
+        mean, std = (p[l2a.astype(np.int64)] for p in parameters)
+        if spec.kind == "map":
+            noise = smooth_noise(rng, shape[:2], image_size)
+            noise += 0.3 * pixel_noise(rng, shape)
+            mean, std = mean[..., None, None], std[..., None, None]
+        else:
+            noise = rng.standard_normal(shape, dtype=np.float32)
+        data = np.clip(mean + std * noise, spec.low, spec.high)
+        if np.dtype(spec.dtype).kind in "ui":
+            data = np.rint(data)
+
+    data = data.astype(spec.dtype)
+    # single nodata values and samples without the modality
+    num_nodata = rng.binomial(data.size, nodata_fraction)
+    data.reshape(-1)[rng.integers(0, data.size, num_nodata)] = spec.nodata
+    if modality != "sentinel2":
+        data[rng.random(n) < missing_fraction] = spec.nodata
+    else:
+        for band in L2A_MISSING_BANDS:
+            data[l2a, MODALITIES_FULL["sentinel2"].index(band)] = spec.nodata
+    return data
+
+
+class BandStats:
+    """Running mean, std, min and max of every band over all valid (not nodata) values."""
+
+    def __init__(self, bands: int):
+        self.count = np.zeros(bands)
+        self.sum = np.zeros(bands)
+        self.sum_sq = np.zeros(bands)
+        self.min = np.full(bands, np.inf)
+        self.max = np.full(bands, -np.inf)
+
+    def update(self, data: np.ndarray, nodata: float):
+        # (samples, bands, ...) -> (bands, values)
+        values = np.moveaxis(data, 1, 0).reshape(data.shape[1], -1).astype(np.float64)
+        valid = values != nodata
+        self.count += valid.sum(axis=1)
+        self.sum += np.where(valid, values, 0).sum(axis=1)
+        self.sum_sq += np.where(valid, values**2, 0).sum(axis=1)
+        self.min = np.minimum(self.min, np.where(valid, values, np.inf).min(axis=1))
+        self.max = np.maximum(self.max, np.where(valid, values, -np.inf).max(axis=1))
+
+    def to_dict(self) -> dict:
+        # bands without any valid value (e.g., B10 of l2a tiles) get mean 0 and std 1
+        count = np.maximum(self.count, 1)
+        mean = self.sum / count
+        std = np.sqrt(np.maximum(self.sum_sq / count - mean**2, 0))
+        empty = self.count == 0
+        return {
+            "mean": np.where(empty, 0.0, mean).tolist(),
+            "std": np.where(empty, 1.0, std).tolist(),
+            "min": np.where(empty, 0.0, self.min).tolist(),
+            "max": np.where(empty, 0.0, self.max).tolist(),
+        }
+
+
+def write_synthetic_mmearth(
+    out_dir: Path,
+    num_samples: int,
+    name: str = "synthetic",
+    modalities: Sequence[str] = None,
+    image_size: int = ori_input_size,
+    l2a_fraction: float = 0.5,
+    nodata_fraction: float = 0.01,
+    missing_fraction: float = 0.05,
+    split_fractions: Sequence[float] = (0.8, 0.1, 0.1),
+    chunk_rows: Union[int, None] = None,
+    compression: Union[str, None] = None,
+    block_size: int = 256,
+    seed: int = 0,
+) -> Path:
+    """Writes a synthetic MMEarth dataset to out_dir and returns the path of the h5 file.
+
+    Written files:
+        data_<name>.h5: one dataset per modality (default: all of MODALITIES_FULL) of shape (samples, ...), see
+            SYNTHETIC_MODALITIES, and the sample names as metadata of shape (samples, 1).
+        data_<name>_splits.json: rows of the train, val and test split (split_fractions of a random permutation).
+        data_<name>_tile_info.json: S2_type (l1c or l2a, l2a_fraction of the samples), S2_DATE, lat and lon per name.
+        data_<name>_band_stats.json: mean, std, min and max per band of the continuous modalities, with
+            sentinel2_l1c and sentinel2_l2a instead of sentinel2. Computed from the first STATS_SAMPLES samples of
+            every block.
+
+    A nodata_fraction of all values and a missing_fraction of the samples of every modality but sentinel2 (the
+    whole sample) are set to the nodata value. With chunk_rows, the h5 datasets are chunked in blocks of that many
+    samples, otherwise they are contiguous (or chunked by h5py if compressed, compression is "gzip" or "lzf").
+    The samples are generated in blocks of block_size samples, the memory does not grow with num_samples.
+    """
+    start = time.perf_counter()
+    modalities = list(MODALITIES_FULL if modalities is None else modalities)
+    assert "sentinel2" in modalities, "sentinel2 is needed, the tile info refers to it"
+    assert len(split_fractions) == 3, "split_fractions are the fractions of train, val and test"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    data_path = out_dir / f"data_{name}.h5"
+
+    rng = np.random.default_rng(seed)
+    names = [f"{name}_{i:07d}" for i in range(num_samples)]
+    l2a = rng.random(num_samples) < l2a_fraction
+    parameters = {modality: band_parameters(rng, modality) for modality in modalities}
+    stats = {}
+    for modality in modalities:
+        spec = SYNTHETIC_MODALITIES[modality]
+        if spec.kind != "one_hot" and not spec.classes:
+            stats_names = ["sentinel2_l1c", "sentinel2_l2a"] if modality == "sentinel2" else [modality]
+            for stats_name in stats_names:
+                stats[stats_name] = BandStats(len(MODALITIES_FULL[modality]))
+
+    with h5py.File(data_path, "w") as f:
+        datasets = {}
+        for modality in ["metadata", *modalities]:
+            if modality == "metadata":
+                shape, dtype = (1,), np.dtype(f"S{max(len(n) for n in names)}")
+            else:
+                shape = sample_shape(modality, image_size)
+                dtype = SYNTHETIC_MODALITIES[modality].dtype
+            datasets[modality] = f.create_dataset(
+                modality,
+                shape=(num_samples, *shape),
+                dtype=dtype,
+                chunks=(min(chunk_rows, num_samples), *shape) if chunk_rows else None,
+                compression=compression,
+            )
+
+        for block, block_start in enumerate(range(0, num_samples, block_size)):
+            block_end = min(block_start + block_size, num_samples)
+            # every block has its own random state, the data doesn't depend on the block size of earlier blocks
+            block_rng = np.random.default_rng((seed, block))
+            block_l2a = l2a[block_start:block_end]
+            datasets["metadata"][block_start:block_end] = np.array(
+                [[n.encode("utf-8")] for n in names[block_start:block_end]]
+            )
+            for modality in modalities:
+                data = generate_block(
+                    block_rng,
+                    modality,
+                    block_l2a,
+                    image_size,
+                    parameters[modality],
+                    nodata_fraction,
+                    missing_fraction,
+                )
+                datasets[modality][block_start:block_end] = data
+                nodata = SYNTHETIC_MODALITIES[modality].nodata
+                data, stats_l2a = data[:STATS_SAMPLES], block_l2a[:STATS_SAMPLES]
+                if modality == "sentinel2":
+                    stats["sentinel2_l1c"].update(data[~stats_l2a], nodata)
+                    stats["sentinel2_l2a"].update(data[stats_l2a], nodata)
+                elif modality in stats:
+                    stats[modality].update(data, nodata)
+
+    permutation = rng.permutation(num_samples)
+    num_val = int(split_fractions[1] * num_samples)
+    num_test = int(split_fractions[2] * num_samples)
+    num_train = min(int(split_fractions[0] * num_samples), num_samples - num_val - num_test)
+    splits = {
+        "train": sorted(permutation[:num_train].tolist()),
+        "val": sorted(permutation[num_train : num_train + num_val].tolist()),
+        "test": sorted(permutation[num_train + num_val : num_train + num_val + num_test].tolist()),
+    }
+    dates = rng.integers(0, 365, num_samples)
+    tile_info = {
+        n: {
+            "S2_type": "l2a" if is_l2a else "l1c",
+            "S2_DATE": str(np.datetime64("2020-01-01") + int(date)),
+            "lat": float(lat),
+            "lon": float(lon),
+        }
+        for n, is_l2a, date, lat, lon in zip(
+            names,
+            l2a,
+            dates,
+            rng.uniform(-60, 80, num_samples),
+            rng.uniform(-180, 180, num_samples),
+        )
+    }
+    for suffix, content in [
+        ("splits", splits),
+        ("tile_info", tile_info),
+        ("band_stats", {stats_name: s.to_dict() for stats_name, s in stats.items()}),
+    ]:
+        with open(out_dir / f"data_{name}_{suffix}.json", "w") as f:
+            json.dump(content, f)
+
+    print_rank_zero(
+        f"Wrote {num_samples} synthetic samples to {data_path} in {time.perf_counter() - start:.1f}s."
+    )
+    return data_path
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Synthetic MMEarth dataset")
+    parser.add_argument("--out-dir", type=Path, required=True, help="Directory the dataset is written to.")
+    parser.add_argument(
+        "--num-samples", type=int, default=1000, help="Number of samples (default: 1000)."
+    )
+    parser.add_argument(
+        "--name", type=str, default="synthetic", help="Files are named data_<name>* (default: 'synthetic')."
+    )
+    parser.add_argument(
+        "--modalities",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Modalities to write (default: all of MODALITIES_FULL).",
+    )
+    parser.add_argument(
+        "--image-size",
+        type=int,
+        default=ori_input_size,
+        help=f"Height and width of the maps (default: {ori_input_size}).",
+    )
+    parser.add_argument(
+        "--l2a-fraction",
+        type=float,
+        default=0.5,
+        help="Fraction of samples from l2a tiles, the others are l1c (default: 0.5).",
+    )
+    parser.add_argument(
+        "--nodata-fraction",
+        type=float,
+        default=0.01,
+        help="Fraction of values set to the nodata value of the modality (default: 0.01).",
+    )
+    parser.add_argument(
+        "--missing-fraction",
+        type=float,
+        default=0.05,
+        help="Fraction of samples without the modality (all nodata), except for sentinel2 (default: 0.05).",
+    )
+    parser.add_argument(
+        "--split-fractions",
+        type=float,
+        nargs=3,
+        default=[0.8, 0.1, 0.1],
+        help="Fractions of the train, val and test split (default: 0.8 0.1 0.1).",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=None,
+        help="Number of samples per h5 chunk, contiguous datasets if not given (default: None).",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        choices=["gzip", "lzf"],
+        help="Compression of the h5 datasets (default: None).",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=256,
+        help="Number of samples generated and written at once (default: 256).",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    write_synthetic_mmearth(**vars(parser.parse_args()))
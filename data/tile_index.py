@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import h5py
+import numpy as np
+from lightly.utils.dist import print_rank_zero
+
+from . import constants
+from .beton_cache import beton_lock, source_mtimes
+
+# increase whenever the content of the tile index changes
+TILE_INDEX_VERSION = 1
+
+
+class TileIndex:
+    """Memory mapped per sample metadata of a MMEarth h5 file (see `build_tile_index`).
+
+    Holds, indexed by the row in the h5 file, whether the sentinel2 data is from a l2a tile and the name of the
+    sample, and the rows of each split. Only the path is pickled, every DataLoader worker maps the arrays again
+    instead of receiving a copy of the tile info.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._arrays = {}
+
+    def _load(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            self._arrays[name] = np.load(self.path / f"{name}.npy", mmap_mode="r")
+        return self._arrays[name]
+
+    @property
+    def l2a(self) -> np.ndarray:
+        return self._load("l2a")
+
+    def split(self, split: str) -> np.ndarray:
+        """Rows in the h5 file of the samples of a split."""
+        return self._load(f"split_{split}")
+
+    def names(self, rows) -> list[str]:
+        offsets = self._load("name_offsets")
+        blob = self._load("names")
+        return [
+            bytes(blob[offsets[row] : offsets[row + 1]]).decode("utf-8") for row in rows
+        ]
+
+    def __getstate__(self):
+        return {"path": self.path, "_arrays": {}}
+
+
+def get_tile_index_dir(data_path: Path) -> Path:
+    """Folder of the index in TILE_INDEX_DIR, named after the h5 file and the hash of its absolute path."""
+    path_hash = hashlib.sha256(str(Path(data_path).resolve()).encode("utf-8")).hexdigest()[:16]
+    return constants.TILE_INDEX_DIR / f"{Path(data_path).stem}_{path_hash}"
+
+
+def build_tile_index(
+    data_path: Path, tile_info_path: Path, splits_path: Path, index_dir: Path
+):
+    """Converts the metadata names, tile info and split json files into numpy arrays.
+
+    Written files (one .npy file per array):
+        l2a: bool per row, whether the sample is from a l2a tile (S2_type of the tile info).
+        names, name_offsets: utf-8 names of all rows concatenated into one blob, and the offsets of each name in it.
+        split_<split>: int32 rows of each split.
+    """
+    with h5py.File(data_path, "r") as f:
+        names = [n[0] for n in f["metadata"][:]]
+    with open(tile_info_path, "r") as f:
+        tile_info = json.load(f)
+    with open(splits_path, "r") as f:
+        splits = json.load(f)
+
+    # written to a temporary directory first, which is renamed once complete
+    tmp_dir = index_dir.with_name(f"{index_dir.name}.{os.getpid()}.partial")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+
+    l2a = np.array(
+        [tile_info[n.decode("utf-8")]["S2_type"] == "l2a" for n in names], dtype=bool
+    )
+    np.save(tmp_dir / "l2a.npy", l2a)
+    name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    name_offsets[1:] = np.cumsum([len(n) for n in names])
+    np.save(tmp_dir / "name_offsets.npy", name_offsets)
+    np.save(tmp_dir / "names.npy", np.frombuffer(b"".join(names), dtype=np.uint8))
+    for split, rows in splits.items():
+        np.save(tmp_dir / f"split_{split}.npy", np.asarray(rows, dtype=np.int32))
+    with open(tmp_dir / "sources.json", "w") as f:
+        json.dump(
+            {
+                "version": TILE_INDEX_VERSION,
+                "sources": source_mtimes([data_path, tile_info_path, splits_path]),
+            },
+            f,
+            indent=2,
+        )
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+
+
+def load_tile_index(data_path: Path, tile_info_path: Path, splits_path: Path) -> TileIndex:
+    """Returns the tile index of the h5 file, it is (re)built if it is missing or outdated."""
+    index_dir = get_tile_index_dir(data_path)
+    index_dir.parent.mkdir(parents=True, exist_ok=True)
+    expected = {
+        "version": TILE_INDEX_VERSION,
+        "sources": source_mtimes([data_path, tile_info_path, splits_path]),
+    }
+
+    def is_valid() -> bool:
+        sources_file = index_dir / "sources.json"
+        if not sources_file.exists():
+            return False
+        with open(sources_file, "r") as f:
+            return json.load(f) == expected
+
+    if not is_valid():
+        # only one process builds the index, the others wait for it
+        with beton_lock(index_dir):
+            if not is_valid():
+                print_rank_zero(f"Creating tile index {index_dir}.")
+                for partial_dir in index_dir.parent.glob(f"{index_dir.name}.*.partial"):
+                    shutil.rmtree(partial_dir, ignore_errors=True)
+                build_tile_index(data_path, tile_info_path, splits_path, index_dir)
+
+    return TileIndex(index_dir)
@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Sequence, Union
+
+import numpy as np
+import torch
+from lightly.utils.dist import print_rank_zero
+from torch import Tensor
+from torch.nn import Module
+from torch.utils.data import DataLoader, Dataset
+
+from data.beton_cache import CONVERTER_VERSION, beton_lock, get_tmp_file, hash_key
+
+# increase whenever the content of the feature files changes
+FEATURE_CACHE_VERSION = 1
+
+# flip variants of the input the features are extracted for
+FLIPS = {
+    "none": lambda x: x,
+    "hflip": lambda x: x.flip(-1),
+    "vflip": lambda x: x.flip(-2),
+    "hvflip": lambda x: x.flip(-2, -1),
+}
+# all outcomes of RandomHorizontalFlip and RandomVerticalFlip (p=0.5 each) are equally likely, picking one of
+# these variants at random per sample reproduces the train transform of the linear evaluation (at 4x the cost
+# of the extraction, only with train_flips)
+TRAIN_FLIPS = ("none", "hflip", "vflip", "hvflip")
+EVAL_FLIPS = ("none",)
+
+
+def model_hash(model: Module) -> str:
+    """Hash of all parameters and buffers, identifies the checkpoint the features are extracted with."""
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy())
+    return digest.hexdigest()[:16]
+
+
+def get_device(accelerator: str) -> torch.device:
+    if accelerator in ["gpu", "cuda", "auto"] and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def get_feature_files(cache_dir: Path, name: str, key_parts: dict) -> tuple[Path, Path, Path]:
+    """Features, labels and manifest file, the name is followed by the hash of the key parts."""
+    stem = f"{name}_{hash_key(key_parts)}"
+    return (
+        cache_dir / f"{stem}_features.npy",
+        cache_dir / f"{stem}_labels.npy",
+        cache_dir / f"{stem}.json",
+    )
+
+
+def loader_num_samples(dataloader: Iterable) -> int:
+    """Number of samples a torch, ffcv or sharded ffcv loader yields, without dropping the last batch."""
+    if hasattr(dataloader, "dataset"):
+        return len(dataloader.dataset)
+    if hasattr(dataloader, "indices"):
+        # ffcv.Loader, indices select the samples (e.g., of a partition) from the beton file
+        return len(dataloader.indices)
+    return dataloader.num_samples
+
+
+@torch.no_grad()
+def extract_features(
+    model: Module,
+    dataloader: Iterable,
+    features_file: Path,
+    labels_file: Path,
+    flips: Sequence[str],
+    device: torch.device,
+) -> int:
+    """Runs the frozen model once per flip variant on every batch and writes the pooled features.
+
+    The features are stored as float32 array of shape (flip variants, samples, feature dim), the labels as
+    (samples, ...). Both files are allocated for all samples of the loader once the shapes are known from the
+    first batch and filled batch by batch, the memory does not grow with the dataset. If the loader drops the
+    last batch, the rows after the returned number of samples stay empty. Both are written to temporary files
+    first.
+    """
+    training = model.training
+    model.eval().to(device)
+    max_samples = loader_num_samples(dataloader)
+    features_tmp_file, labels_tmp_file = get_tmp_file(features_file), get_tmp_file(labels_file)
+    features = labels = None
+    num_samples = 0
+    for batch in dataloader:
+        images = batch[0].to(device)
+        batch_features = torch.stack(
+            [model(FLIPS[flip](images)).flatten(start_dim=1).float().cpu() for flip in flips]
+        ).numpy()
+        batch_labels = batch[1].cpu().numpy()
+        if features is None:
+            features = np.lib.format.open_memmap(
+                features_tmp_file,
+                mode="w+",
+                dtype=batch_features.dtype,
+                shape=(len(flips), max_samples, batch_features.shape[2]),
+            )
+            labels = np.lib.format.open_memmap(
+                labels_tmp_file,
+                mode="w+",
+                dtype=batch_labels.dtype,
+                shape=(max_samples, *batch_labels.shape[1:]),
+            )
+        batch_end = num_samples + len(batch_labels)
+        assert batch_end <= max_samples, f"the loader yields more than {max_samples} samples"
+        features[:, num_samples:batch_end] = batch_features
+        labels[num_samples:batch_end] = batch_labels
+        num_samples = batch_end
+    model.train(training)
+    assert features is not None, "the loader is empty"
+
+    features.flush()
+    labels.flush()
+    # closes the memory maps before the files are moved
+    del features, labels
+    os.replace(features_tmp_file, features_file)
+    os.replace(labels_tmp_file, labels_file)
+    return num_samples
+
+
+class FeatureDataset(Dataset):
+    """Memory mapped features and labels written by `extract_features`.
+
+    With several flip variants, a random variant is returned for every access, like a random flip of the input.
+    Only the first `num_samples` samples are used (default: all), the rest of the files is empty if the loader
+    the features were extracted from dropped its last batch.
+    """
+
+    def __init__(self, features_file: Path, labels_file: Path, num_samples: Union[int, None] = None):
+        self.features_file = Path(features_file)
+        self.labels_file = Path(labels_file)
+        self.features = np.load(features_file, mmap_mode="r")[:, :num_samples]
+        self.labels = np.load(labels_file, mmap_mode="r")[:num_samples]
+
+    def __len__(self):
+        return self.features.shape[1]
+
+    def __getitem__(self, idx: int) -> tuple[Tensor, Tensor]:
+        # torch seeds every worker differently, in contrast to numpy
+        variant = int(torch.randint(len(self.features), ()))
+        return (
+            torch.from_numpy(np.array(self.features[variant, idx])),
+            torch.from_numpy(np.array(self.labels[idx])),
+        )
+
+
+def get_feature_dataloaders(
+    model: Module,
+    dataloaders: list,
+    splits: list[str],
+    cache_dir: Path,
+    name: str,
+    key_parts: dict,
+    batch_size_per_device: int,
+    num_workers: int,
+    device: torch.device,
+    train_flips: bool = False,
+) -> list[Union[DataLoader, None]]:
+    """Replaces the image loaders of a frozen model evaluation by loaders of cached features.
+
+    The features of each split are extracted once and reused as long as the model parameters (see `model_hash`),
+    the key parts (dataset, modalities, ...) and the converter version of the beton files are the same. With
+    train_flips, the train features are extracted for all flip variants of `TRAIN_FLIPS`, which runs the model 4
+    times per sample. Otherwise, and for the other splits, they are extracted without flips.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    model_key = model_hash(model)
+
+    feature_dataloaders = []
+    for split, dataloader in zip(splits, dataloaders):
+        if dataloader is None:
+            feature_dataloaders.append(None)
+            continue
+
+        is_train = split == "train"
+        flips = TRAIN_FLIPS if is_train and train_flips else EVAL_FLIPS
+        split_key_parts = {
+            **key_parts,
+            "version": FEATURE_CACHE_VERSION,
+            # the samples (e.g., label remapping, normalization) change with the converter version
+            "converter_version": CONVERTER_VERSION,
+            "model": model_key,
+            "split": split,
+            "flips": flips,
+        }
+        features_file, labels_file, manifest_file = get_feature_files(
+            cache_dir, f"{split}_{name}", split_key_parts
+        )
+
+        # only one process extracts the features, the others wait for it
+        with beton_lock(manifest_file):
+            if not manifest_file.exists():
+                print_rank_zero(f"Extracting {split} features to {features_file}.")
+                num_samples = extract_features(
+                    model, dataloader, features_file, labels_file, flips, device
+                )
+                tmp_file = get_tmp_file(manifest_file)
+                with open(tmp_file, "w") as f:
+                    json.dump(
+                        {"key_parts": split_key_parts, "num_samples": num_samples},
+                        f,
+                        indent=2,
+                        default=str,
+                    )
+                # the manifest is written last, it marks the feature files as complete
+                os.replace(tmp_file, manifest_file)
+        with open(manifest_file, "r") as f:
+            num_samples = json.load(f)["num_samples"]
+
+        feature_dataloaders.append(
+            DataLoader(
+                FeatureDataset(features_file, labels_file, num_samples),
+                batch_size=batch_size_per_device,
+                shuffle=is_train,
+                num_workers=num_workers,
+                drop_last=is_train,
+                persistent_workers=num_workers > 0,
+            )
+        )
+    return feature_dataloaders
+
+
+def get_mmearth_feature_dataloaders(
+    model: Module,
+    dataloaders: Sequence,
+    data_dir: Path,
+    processed_dir: Path,
+    input_modality: dict,
+    target_modality: dict,
+    storage: str,
+    batch_size_per_device: int,
+    num_workers: int,
+    accelerator: str,
+    train_flips: bool = False,
+) -> list[Union[DataLoader, None]]:
+    """Cached feature loaders of the MMEarth train and val loaders, shared by the linear and KNN evaluation."""
+    return get_feature_dataloaders(
+        model,
+        dataloaders,
+        ["train", "val"],
+        cache_dir=Path(processed_dir or data_dir) / "features",
+        name="mmearth",
+        key_parts={
+            "data_dir": data_dir,
+            "input_modality": input_modality,
+            "target_modality": target_modality,
+            "storage": storage,
+        },
+        batch_size_per_device=batch_size_per_device,
+        num_workers=num_workers,
+        device=get_device(accelerator),
+        train_flips=train_flips,
+    )
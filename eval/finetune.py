@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Sequence, Union
 
 import wandb
 from lightly.utils.benchmarking import MetricCallback
@@ -12,6 +13,7 @@ import kornia.augmentation as K
 from data.mmearth_dataset import (
     get_mmearth_dataloaders,
 )
+from data.samplers import shards_by_rank
 from eval.helper_modules import FinetuneEvalClassifier
 
 
@@ -29,6 +31,9 @@ def finetune_eval(
     precision: str,
     num_classes: int,
     no_ffcv: bool,
+    storage: str = "float32",
+    num_shards: int = 1,
+    dataloaders: Union[Sequence, None] = None,
     debug: bool = False,
 ) -> None:
     """Runs fine-tune evaluation on the given model.
@@ -44,6 +49,8 @@ def finetune_eval(
         - Weight Decay: 0.0
         - LR Schedule: Cosine without warmup
 
+    dataloaders (train, val) can be passed to share them with other evaluations, otherwise they are created.
+
     References:
         - [0]: SimCLR, 2020, https://arxiv.org/abs/2002.05709
     """
@@ -57,16 +64,20 @@ def finetune_eval(
         K.RandomHorizontalFlip(),
         K.RandomVerticalFlip(),
     )
-    train_dataloader, val_dataloader = get_mmearth_dataloaders(
-        data_dir,
-        processed_dir,
-        input_modality,
-        target_modality,
-        num_workers,
-        batch_size_per_device,
-        ["train", "val"],
-        no_ffcv,
-    )
+    if dataloaders is None:
+        dataloaders = get_mmearth_dataloaders(
+            data_dir,
+            processed_dir,
+            input_modality,
+            target_modality,
+            num_workers,
+            batch_size_per_device,
+            ["train", "val"],
+            no_ffcv,
+            storage=storage,
+            num_shards=num_shards,
+        )
+    train_dataloader, val_dataloader = dataloaders
 
     # Train linear classifier.
     metric_callback = MetricCallback()
@@ -91,6 +102,8 @@ def finetune_eval(
         # strategy="ddp_find_unused_parameters_true",
         num_sanity_val_steps=0,
         fast_dev_run=debug,
+        # the no ffcv loaders split the samples between the DDP ranks themselves
+        use_distributed_sampler=not shards_by_rank(train_dataloader),
     )
     classifier = FinetuneEvalClassifier(
         model=model,
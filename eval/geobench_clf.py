@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Sequence
 
 import kornia.augmentation as K
 import wandb
@@ -7,14 +8,18 @@ from lightly.utils.dist import print_rank_zero
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
 from pytorch_lightning.loggers import WandbLogger
-from torch.nn import Module, Sequential
+from torch.nn import Identity, Module, Sequential
 
 from data import get_geobench_dataloaders
+from eval.feature_cache import get_device, get_feature_dataloaders
+from eval.linear_solvers import fit_linear_probe
 from eval.helper_modules import (
-    LinearMultiLabelClassifier,
+    LINEAR_LRS,
+    LINEAR_SEEDS,
+    LINEAR_WEIGHT_DECAYS,
     FinetuneMultiLabelClassifier,
-    LinearClassifier,
     FinetuneEvalClassifier,
+    MultiHeadLinearClassifier,
 )
 
 
@@ -31,6 +36,12 @@ def geobench_clf_eval(
     devices: int,
     precision: str,
     no_ffcv: bool,
+    feature_cache: bool = True,
+    feature_flips: bool = False,
+    linear_lrs: Sequence[float] = LINEAR_LRS,
+    linear_weight_decays: Sequence[float] = LINEAR_WEIGHT_DECAYS,
+    linear_seeds: Sequence[int] = LINEAR_SEEDS,
+    linear_solver: str = "sgd",
     debug: [bool, str] = False,
 ) -> None:
     """Runs a linear evaluation on the given model.
@@ -46,6 +57,11 @@ def geobench_clf_eval(
         - Weight Decay: 0.0
         - LR Schedule: Cosine without warmup
 
+    For the linear method with feature_cache, the linear head is trained on cached features of the frozen
+    backbone (see `eval.feature_cache`), of random flips of the images only with feature_flips. The linear method trains one head per combination of linear_lrs,
+    linear_weight_decays and linear_seeds at once, the head with the best val_top1 is tested. With linear_solver
+    "ridge" or "lbfgs", the linear method is fitted with a convex solver instead (see `eval.linear_solvers`).
+
     References:
         - [0]: SimCLR, 2020, https://arxiv.org/abs/2002.05709
     """
@@ -54,6 +70,9 @@ def geobench_clf_eval(
         "m-so2sat",
         "m-bigearthnet",
     ], f"dataset '{dataset_name}' not supported"  # only classification TODO
+    assert method != "linear" or linear_solver == "sgd" or (
+        feature_cache and not debug
+    ), f"linear solver '{linear_solver}' needs the feature cache, which is disabled"
     print_rank_zero("Running geobench evaluation...")
 
     # Setup training data.
@@ -79,6 +98,47 @@ def geobench_clf_eval(
             indices,
         )
     )
+    classifier_model = model
+    if method == "linear" and feature_cache and not debug:
+        train_dataloader, val_dataloader, test_dataloader = get_feature_dataloaders(
+            model,
+            [train_dataloader, val_dataloader, test_dataloader],
+            ["train", "val", "test"],
+            cache_dir=Path(processed_dir) / "features",
+            name=f"{dataset_name}_{partition}",
+            key_parts={"dataset_name": dataset_name, "partition": partition},
+            batch_size_per_device=batch_size_per_device,
+            num_workers=num_workers,
+            device=get_device(accelerator),
+            train_flips=feature_flips,
+        )
+        # the flips are part of the cached features (with feature_flips), otherwise there are none
+        classifier_model = Identity()
+        train_transform = None
+
+    wandb_config = model.hparams.copy()
+    wandb_config["log_dir"] = str(log_dir)
+    if method == "linear" and linear_solver != "sgd":
+        metrics = fit_linear_probe(
+            linear_solver,
+            train_dataloader.dataset,
+            val_dataloader.dataset,
+            test_dataloader.dataset,
+            num_classes=task.label_type.n_classes,
+            multi_label=dataset_name == "m-bigearthnet",
+            device=get_device(accelerator),
+        )
+        WandbLogger(
+            save_dir=str(log_dir),
+            name=f"{dataset_name}_{method}_eval",
+            project="ssl4eo",
+            config=wandb_config,
+            offline=debug,
+        ).log_metrics(metrics)
+        wandb.finish()
+        for metric, value in metrics.items():
+            print_rank_zero(f"{dataset_name} {linear_solver} {metric}: {value}")
+        return
 
     # Train linear classifier.
     metric_callback = MetricCallback()
@@ -86,8 +146,6 @@ def geobench_clf_eval(
         monitor="val_top1", mode="max", auto_insert_metric_name=True
     )
     epochs = (90 if method == "linear" else 30) if not debug else 1
-    wandb_config = model.hparams.copy()
-    wandb_config["log_dir"] = str(log_dir)
     trainer = Trainer(
         max_epochs=epochs,
         accelerator=accelerator,
@@ -116,12 +174,16 @@ def geobench_clf_eval(
     )
 
     classifier = get_geobench_classifier(
-        model,
+        classifier_model,
         method,
         is_multi_label=dataset_name == "m-bigearthnet",
         num_classes=task.label_type.n_classes,
         batch_size_per_device=batch_size_per_device,
         train_transform=train_transform,
+        feature_dim=model.last_backbone_channel,
+        lrs=linear_lrs,
+        weight_decays=linear_weight_decays,
+        seeds=linear_seeds,
     )
 
     trainer.fit(
@@ -134,9 +196,11 @@ def geobench_clf_eval(
     del train_dataloader, val_dataloader
 
     if not debug:
-        print_rank_zero(
-            f"max {dataset_name} {method} val_top1: {max(metric_callback.val_metrics['val_top1'])}"
-        )
+        if method == "linear":
+            val_top1 = classifier.max_metric(metric_callback.val_metrics, "val_top1")
+        else:
+            val_top1 = max(metric_callback.val_metrics["val_top1"])
+        print_rank_zero(f"max {dataset_name} {method} val_top1: {val_top1}")
 
     # get test results for best val model
     best_model_path = (
@@ -160,22 +224,35 @@ def get_geobench_classifier(
     num_classes: int,
     batch_size_per_device: int,
     train_transform: Module,
+    feature_dim: int,
+    lrs: Sequence[float] = LINEAR_LRS,
+    weight_decays: Sequence[float] = LINEAR_WEIGHT_DECAYS,
+    seeds: Sequence[int] = LINEAR_SEEDS,
 ):
     if method == "linear":
-        # if dataset is multi-label, we need a different classifier class
-        clf_class = LinearMultiLabelClassifier if is_multi_label else LinearClassifier
-    else:
-        # if dataset is multi-label, we need a different classifier class
-        clf_class = (
-            FinetuneMultiLabelClassifier if is_multi_label else FinetuneEvalClassifier
+        # all heads of the grid are trained at once, multi-label datasets use a BCE loss
+        return MultiHeadLinearClassifier(
+            model=model,
+            batch_size_per_device=batch_size_per_device,
+            feature_dim=feature_dim,
+            num_classes=num_classes,
+            lrs=lrs,
+            weight_decays=weight_decays,
+            seeds=seeds,
+            multi_label=is_multi_label,
+            train_transform=train_transform,
         )
 
+    # if dataset is multi-label, we need a different classifier class
+    clf_class = (
+        FinetuneMultiLabelClassifier if is_multi_label else FinetuneEvalClassifier
+    )
     classifier = clf_class(
         model=model,
         batch_size_per_device=batch_size_per_device,
-        feature_dim=model.last_backbone_channel,
+        feature_dim=feature_dim,
         num_classes=num_classes,
-        freeze_model=method == "linear",
+        freeze_model=False,
         train_transform=train_transform,
     )
     return classifier
@@ -1,13 +1,36 @@
-from typing import Tuple, Dict
+import math
+from itertools import product
+from typing import Tuple, Dict, Sequence
 
 import torch
+import torch.nn.functional as F
 from lightly.utils.benchmarking import LinearClassifier as LightningLinearClassifier
 from lightly.utils.scheduler import CosineWarmupScheduler
+from pytorch_lightning import LightningModule
 from torch import Tensor, nn
 from torch.nn import BCEWithLogitsLoss
 from torch.optim import SGD
 from torchmetrics.functional import accuracy, f1_score, average_precision
 
+# default grid of the multi-head linear probe, the base learning rate is scaled by batch size / 256. A single
+# head by default: MMEarth has no test split, the best of several heads would be selected on the reported val
+# metric and not be comparable to single head runs
+LINEAR_LRS = (0.1,)
+LINEAR_WEIGHT_DECAYS = (0.0,)
+LINEAR_SEEDS = (0,)
+
+
+def multilabel_metrics(
+    predictions: Tensor, targets: Tensor, num_classes: int
+) -> Dict[str, Tensor]:
+    """Macro averaged accuracy (top1), f1 and mean average precision (mAP) of multi-label predictions."""
+    kwargs = dict(task="multilabel", num_labels=num_classes, average="macro")
+    return {
+        "top1": accuracy(predictions, targets, **kwargs),
+        "f1": f1_score(predictions, targets, **kwargs),
+        "mAP": average_precision(predictions, targets, **kwargs),
+    }
+
 
 class LinearClassifier(LightningLinearClassifier):
     def __init__(
@@ -65,57 +88,12 @@ class LinearMultiLabelClassifier(LinearClassifier):
         predictions = self.forward(images)
         loss = self.criterion(predictions, targets.to(predictions.dtype))
 
-        metrics = {}
-        acc_glob = accuracy(
-            predictions,
-            targets,
-            task="multilabel",
-            num_labels=self.num_classes,
-            average="macro",
-        )
-        # acc_cls = accuracy(
-        #     predictions,
-        #     targets,
-        #     task="multilabel",
-        #     num_labels=self.num_classes,
-        #     average="none",
-        # )
-        # metrics = {f"top1 cls-{i}": value.item() for i, value in enumerate(acc_cls)}
-        metrics["top1"] = acc_glob.item()
-
-        f1_glob = f1_score(
-            predictions,
-            targets,
-            task="multilabel",
-            num_labels=self.num_classes,
-            average="macro",
-        )
-        # f1_cls = f1_score(
-        #     predictions,
-        #     targets,
-        #     task="multilabel",
-        #     num_labels=self.num_classes,
-        #     average="none",
-        # )
-        # metrics.update({f"f1 cls-{i}": value.item() for i, value in enumerate(f1_cls)})
-        metrics["f1"] = f1_glob.item()
-
-        mAP_glob = average_precision(
-            predictions,
-            targets,
-            task="multilabel",
-            num_labels=self.num_classes,
-            average="macro",
-        )
-        # mAP_cls = average_precision(
-        #     predictions,
-        #     targets,
-        #     task="multilabel",
-        #     num_labels=self.num_classes,
-        #     average="none",
-        # )
-        # metrics.update({f"mAP cls-{i}": value.item() for i, value in enumerate(mAP_glob)})
-        metrics["mAP"] = mAP_glob.item()
+        metrics = {
+            metric: value.item()
+            for metric, value in multilabel_metrics(
+                predictions, targets, self.num_classes
+            ).items()
+        }
 
         return loss, metrics
 
@@ -195,3 +173,208 @@ class FinetuneMultiLabelClassifier(LinearMultiLabelClassifier):
             "interval": "step",
         }
         return [optimizer], [scheduler]
+
+
+class MultiHeadLinearClassifier(LightningModule):
+    """Trains a grid of linear heads (learning rates x weight decays x seeds) on the features of a frozen model.
+
+    All heads see the same batches, the features are computed once per step and the logits of all heads are
+    computed with one batched matmul. Every head has its own param group, so a hyperparameter sweep costs a
+    single pass over the data instead of one run per setting.
+
+    The metrics of every head are logged per epoch (e.g., val_top1_lr0.1_wd0_seed0). val_<metric> is the metric
+    of the head with the best val_top1, which is also the head that is used in the test step.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        batch_size_per_device: int,
+        feature_dim: int,
+        num_classes: int,
+        lrs: Sequence[float] = LINEAR_LRS,
+        weight_decays: Sequence[float] = LINEAR_WEIGHT_DECAYS,
+        seeds: Sequence[int] = LINEAR_SEEDS,
+        multi_label: bool = False,
+        topk: Tuple[int, ...] = (1, 5),
+        train_transform: nn.Module = None,
+    ):
+        super().__init__()
+        self.save_hyperparameters(ignore=["model", "train_transform"])
+        self.model = model
+        self.batch_size_per_device = batch_size_per_device
+        self.num_classes = num_classes
+        self.multi_label = multi_label
+        self.topk = tuple(k for k in topk if k <= num_classes)
+        self.train_transform = nn.Sequential() if train_transform is None else train_transform
+
+        # (lr, weight decay, seed) of each head
+        self.heads = list(product(lrs, weight_decays, seeds))
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        bound = 1 / math.sqrt(feature_dim)
+        for _, _, seed in self.heads:
+            # same initialization as nn.Linear, but reproducible per seed
+            generator = torch.Generator().manual_seed(seed)
+            weight = torch.rand(num_classes, feature_dim, generator=generator)
+            bias = torch.rand(num_classes, generator=generator)
+            self.weights.append(nn.Parameter((2 * weight - 1) * bound))
+            self.biases.append(nn.Parameter((2 * bias - 1) * bound))
+        # part of the checkpoint, so that the best checkpoint is tested with the head it was selected for
+        self.register_buffer("best_head", torch.tensor(0))
+
+    def head_name(self, head: int) -> str:
+        lr, weight_decay, seed = self.heads[head]
+        return f"lr{lr:g}_wd{weight_decay:g}_seed{seed}"
+
+    def forward(self, images: Tensor) -> Tensor:
+        """Returns the logits of all heads, shape: (heads, batch, classes)."""
+        with torch.no_grad():
+            features = self.model.forward(images).flatten(start_dim=1)
+        weight = torch.stack(list(self.weights))
+        bias = torch.stack(list(self.biases))
+        return torch.baddbmm(
+            bias[:, None], features.expand(len(self.heads), -1, -1), weight.transpose(1, 2)
+        )
+
+    def loss(self, logits: Tensor, targets: Tensor) -> Tensor:
+        """Sum of the losses of all heads, the heads are independent of each other."""
+        num_heads = len(self.heads)
+        if self.multi_label:
+            targets = targets.to(logits.dtype).expand_as(logits)
+            return F.binary_cross_entropy_with_logits(logits, targets) * num_heads
+        return (
+            F.cross_entropy(logits.flatten(end_dim=1), targets.repeat(num_heads))
+            * num_heads
+        )
+
+    def head_metrics(self, logits: Tensor, targets: Tensor) -> Dict[str, Tensor]:
+        """Metrics of every head, each of shape (heads,)."""
+        if self.multi_label:
+            metrics = [
+                multilabel_metrics(head_logits, targets, self.num_classes)
+                for head_logits in logits
+            ]
+            return {
+                metric: torch.stack([m[metric] for m in metrics]) for metric in metrics[0]
+            }
+        predicted = logits.topk(max(self.topk), dim=-1).indices
+        correct = predicted == targets[None, :, None]
+        return {
+            f"top{k}": correct[..., :k].any(dim=-1).float().mean(dim=-1)
+            for k in self.topk
+        }
+
+    def _log_head_metrics(self, stage: str, logits: Tensor, targets: Tensor):
+        # averaged over the epoch by lightning, available to callbacks like MetricCallback at the end of the epoch
+        self.log_dict(
+            {
+                f"{stage}_{metric}_{self.head_name(head)}": value
+                for metric, values in self.head_metrics(logits.detach(), targets).items()
+                for head, value in enumerate(values)
+            },
+            on_step=False,
+            on_epoch=True,
+            sync_dist=True,
+            batch_size=len(targets),
+        )
+
+    def _log_best_head_metrics(self, stage: str) -> int:
+        """Logs the epoch metrics of the head with the best top1 as <stage>_<metric>, returns the head."""
+        metrics = self.trainer.callback_metrics
+        top1 = [metrics[f"{stage}_top1_{self.head_name(head)}"] for head in range(len(self.heads))]
+        best = int(torch.stack(top1).argmax())
+        names = ["top1", "f1", "mAP"] if self.multi_label else [f"top{k}" for k in self.topk]
+        self.log_dict(
+            {f"{stage}_{metric}": metrics[f"{stage}_{metric}_{self.head_name(best)}"] for metric in names},
+            prog_bar=stage == "val",
+        )
+        return best
+
+    def max_metric(self, metrics: Dict[str, list], name: str) -> float:
+        """Maximum of a metric (e.g., val_top1) over all epochs and heads, given the metrics of a MetricCallback.
+
+        <stage>_<metric> itself is logged in on_<stage>_epoch_end, after callbacks like MetricCallback have read the
+        metrics of the epoch, the metrics of the single heads are complete.
+        """
+        return max(max(metrics[f"{name}_{self.head_name(head)}"]) for head in range(len(self.heads)))
+
+    def on_train_epoch_start(self):
+        # the model is frozen, e.g., batch norm statistics are not updated
+        self.model.eval()
+
+    def training_step(self, batch: Tuple[Tensor, ...], batch_idx: int) -> Tensor:
+        with torch.no_grad():
+            images = self.train_transform(batch[0])
+        logits = self.forward(images)
+        loss = self.loss(logits, batch[1])
+        self._log_head_metrics("train", logits, batch[1])
+        self.log(
+            "train_loss",
+            loss / len(self.heads),
+            prog_bar=True,
+            sync_dist=True,
+            batch_size=len(batch[1]),
+        )
+        return loss
+
+    def on_train_epoch_end(self):
+        self._log_best_head_metrics("train")
+
+    def validation_step(self, batch: Tuple[Tensor, ...], batch_idx: int) -> Tensor:
+        logits = self.forward(batch[0])
+        loss = self.loss(logits, batch[1])
+        self._log_head_metrics("val", logits, batch[1])
+        self.log(
+            "val_loss",
+            loss / len(self.heads),
+            sync_dist=True,
+            batch_size=len(batch[1]),
+        )
+        return loss
+
+    def on_validation_epoch_end(self):
+        if not self.trainer.sanity_checking:
+            self.best_head.fill_(self._log_best_head_metrics("val"))
+
+    def test_step(self, batch: Tuple[Tensor, ...], batch_idx: int) -> Tensor:
+        logits = self.forward(batch[0])[self.best_head][None]
+        targets = batch[1]
+        batch_size = len(targets)
+        if self.multi_label:
+            loss = F.binary_cross_entropy_with_logits(logits[0], targets.to(logits.dtype))
+        else:
+            loss = F.cross_entropy(logits[0], targets)
+        metrics = {
+            f"test_{metric}": values[0]
+            for metric, values in self.head_metrics(logits, targets).items()
+        }
+        self.log("test_loss", loss, prog_bar=True, sync_dist=True, batch_size=batch_size)
+        self.log_dict(metrics, prog_bar=True, sync_dist=True, batch_size=batch_size)
+        return loss
+
+    def configure_optimizers(self):
+        # one param group per head, the scheduler scales all learning rates by the same factor
+        scale = self.batch_size_per_device * self.trainer.world_size / 256
+        optimizer = SGD(
+            [
+                {
+                    "params": [weight, bias],
+                    "lr": lr * scale,
+                    "weight_decay": weight_decay,
+                }
+                for (lr, weight_decay, _), weight, bias in zip(
+                    self.heads, self.weights, self.biases
+                )
+            ],
+            momentum=0.9,
+        )
+        scheduler = {
+            "scheduler": CosineWarmupScheduler(
+                optimizer=optimizer,
+                warmup_epochs=0,
+                max_epochs=self.trainer.estimated_stepping_batches,
+            ),
+            "interval": "step",
+        }
+        return [optimizer], [scheduler]
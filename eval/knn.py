@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Sequence, Union
 
 import torch
 import wandb
@@ -10,6 +11,15 @@ from pytorch_lightning.loggers import WandbLogger
 from data.mmearth_dataset import (
     get_mmearth_dataloaders,
 )
+from data.samplers import shards_by_rank
+from eval.feature_cache import get_device, get_mmearth_feature_dataloaders
+from eval.knn_bank import knn_evaluate
+
+KNN_K = 200
+KNN_TEMPERATURE = 0.1
+# grid of the KNN evaluation on cached features, all of it is computed from one search for the max(ks) neighbors
+KNN_KS = (1, 5, 10, 20, 50, 100, 200)
+KNN_TEMPERATURES = (0.01, 0.02, 0.05, 0.07, 0.1, 0.2, 0.5, 1.0)
 
 
 def knn_eval(
@@ -25,6 +35,15 @@ def knn_eval(
     devices: int,
     num_classes: int,
     no_ffcv: bool,
+    storage: str = "float32",
+    num_shards: int = 1,
+    feature_cache: bool = True,
+    feature_flips: bool = False,
+    knn_bank_dtype: str = "float16",
+    knn_ks: Sequence[int] = KNN_KS,
+    knn_temperatures: Sequence[float] = KNN_TEMPERATURES,
+    dataloaders: Union[Sequence, None] = None,
+    feature_dataloaders: Union[Sequence, None] = None,
     debug: bool = False,
 ) -> None:
     """Runs KNN evaluation on the given model.
@@ -35,6 +54,15 @@ def knn_eval(
         - Num nearest neighbors: 200
         - Temperature: 0.1
 
+    With feature_cache, the features cached for the linear evaluation (with the same feature_flips) are reused. The normalized train
+    features are stored as memory mapped float16 or int8 (knn_bank_dtype) feature bank, which is searched
+    block by block (see `eval.knn_bank`), instead of keeping all train features in memory. The accuracies of
+    all combinations of knn_ks and knn_temperatures are computed from the same neighbors and logged as
+    val_top<t>_k<k>_t<temperature>, val_top1 and val_top5 are the ones of the settings above.
+
+    dataloaders (train, val) and feature_dataloaders (train, val, see `get_mmearth_feature_dataloaders`) can be
+    passed to share them with other evaluations, otherwise they are created.
+
     References:
        - [0]: InstDict, 2018, https://arxiv.org/abs/1805.01978
     """
@@ -44,21 +72,78 @@ def knn_eval(
     print_rank_zero("Running KNN evaluation...")
 
     # Setup training data.
-    train_dataloader, val_dataloader = get_mmearth_dataloaders(
-        data_dir,
-        processed_dir,
-        input_modality,
-        target_modality,
-        num_workers,
-        batch_size_per_device,
-        ["train", "val"],
-        no_ffcv,
-    )
+    if dataloaders is None:
+        dataloaders = get_mmearth_dataloaders(
+            data_dir,
+            processed_dir,
+            input_modality,
+            target_modality,
+            num_workers,
+            batch_size_per_device,
+            ["train", "val"],
+            no_ffcv,
+            storage=storage,
+            num_shards=num_shards,
+        )
+    train_dataloader, val_dataloader = dataloaders
 
+    if feature_cache and not debug and val_dataloader is not None:
+        if feature_dataloaders is None:
+            feature_dataloaders = get_mmearth_feature_dataloaders(
+                model,
+                dataloaders,
+                data_dir,
+                processed_dir,
+                input_modality,
+                target_modality,
+                storage,
+                batch_size_per_device,
+                num_workers,
+                accelerator,
+                train_flips=feature_flips,
+            )
+        train_dataloader, val_dataloader = feature_dataloaders
+        # the default setting is always evaluated, it is reported as val_top1 and val_top5
+        ks = sorted(set(knn_ks) | {KNN_K})
+        temperatures = sorted(set(knn_temperatures) | {KNN_TEMPERATURE})
+        metrics = knn_evaluate(
+            train_dataloader.dataset,
+            val_dataloader.dataset,
+            num_classes=num_classes,
+            ks=ks,
+            temperatures=temperatures,
+            bank_dtype=knn_bank_dtype,
+            device=get_device(accelerator),
+        )
+        for metric in ["val_top1", "val_top5"]:
+            if f"{metric}_k{KNN_K}_t{KNN_TEMPERATURE:g}" in metrics:
+                metrics[metric] = metrics[f"{metric}_k{KNN_K}_t{KNN_TEMPERATURE:g}"]
+        WandbLogger(
+            save_dir=log_dir / "knn_eval",
+            name="knn_eval",
+            project="ssl4eo",
+            config=model.hparams,
+            offline=debug,
+        ).log_metrics(metrics)
+        wandb.finish()
+        for metric in ["val_top1", "val_top5"]:
+            if metric in metrics:
+                print_rank_zero(f"max knn {metric}: {metrics[metric]}")
+        best = max((m for m in metrics if m.startswith("val_top1_")), key=metrics.get)
+        print_rank_zero(f"best knn setting {best.removeprefix('val_top1_')}: {metrics[best]}")
+        return
+
+    if no_ffcv:
+        num_train_samples = len(train_dataloader.dataset)
+    elif hasattr(train_dataloader, "num_samples"):
+        num_train_samples = train_dataloader.num_samples
+    else:
+        num_train_samples = train_dataloader.reader.num_samples
     classifier = KNNClassifier(
         model=model,
         num_classes=num_classes,
-        knn_k=1 if debug else min(len(train_dataloader.reader.num_samples), 200),
+        knn_k=1 if debug else min(num_train_samples, KNN_K),
+        knn_t=KNN_TEMPERATURE,
         feature_dtype=torch.float16,
     )
 
@@ -80,6 +165,8 @@ def knn_eval(
         # strategy="ddp_find_unused_parameters_true",
         num_sanity_val_steps=0,
         fast_dev_run=debug,
+        # the no ffcv loaders split the samples between the DDP ranks themselves
+        use_distributed_sampler=not shards_by_rank(train_dataloader),
     )
     trainer.fit(
         model=classifier,
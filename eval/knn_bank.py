@@ -0,0 +1,156 @@
+import os
+from pathlib import Path
+from typing import Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from lightly.utils.dist import print_rank_zero
+from torch import Tensor
+
+from data.beton_cache import beton_lock, get_tmp_file
+from eval.feature_cache import FeatureDataset
+
+# how the normalized train features of the KNN evaluation are stored:
+# - float16: half precision
+# - int8: features scaled by 127 and rounded, halves the file size again
+KNN_BANK_DTYPES = ["float16", "int8"]
+INT8_SCALE = 127
+
+# number of bank rows per similarity block and number of queries searched at once
+KNN_BLOCK_SIZE = 8192
+KNN_QUERY_CHUNK_SIZE = 4096
+
+
+def get_knn_bank_file(dataset: FeatureDataset, dtype: str) -> Path:
+    stem = dataset.features_file.name.removesuffix("_features.npy")
+    return dataset.features_file.with_name(f"{stem}_knn_{dtype}.npy")
+
+
+def build_knn_bank(dataset: FeatureDataset, bank_file: Path, dtype: str):
+    """Writes the L2 normalized features (without flip) of a feature cache split as float16 or int8 array."""
+    features = dataset.features[0]
+    tmp_file = get_tmp_file(bank_file)
+    bank = np.lib.format.open_memmap(
+        tmp_file, mode="w+", dtype=np.dtype(dtype), shape=features.shape
+    )
+    for start in range(0, len(features), KNN_BLOCK_SIZE):
+        block = F.normalize(torch.from_numpy(np.array(features[start : start + KNN_BLOCK_SIZE])), dim=1)
+        if dtype == "int8":
+            block = (block * INT8_SCALE).round()
+        bank[start : start + len(block)] = block.numpy().astype(dtype)
+    bank.flush()
+    del bank
+    os.replace(tmp_file, bank_file)
+
+
+def load_knn_bank(dataset: FeatureDataset, dtype: str) -> np.ndarray:
+    """Memory maps the KNN feature bank of a feature cache split, it is created if it doesn't exist yet."""
+    assert dtype in KNN_BANK_DTYPES, f"KNN bank dtype '{dtype}' not supported"
+    bank_file = get_knn_bank_file(dataset, dtype)
+    if not bank_file.exists():
+        # only one process creates the bank, the others wait for it
+        with beton_lock(bank_file):
+            if not bank_file.exists():
+                print_rank_zero(f"Creating KNN feature bank {bank_file}.")
+                build_knn_bank(dataset, bank_file, dtype)
+    return np.load(bank_file, mmap_mode="r")
+
+
+def _bank_block(bank: np.ndarray, start: int, device: torch.device) -> Tensor:
+    block = torch.from_numpy(np.array(bank[start : start + KNN_BLOCK_SIZE])).to(device)
+    if block.dtype == torch.int8:
+        return block.float() / INT8_SCALE
+    return block.float()
+
+
+def knn_search(
+    bank: np.ndarray, queries: Tensor, k: int, device: torch.device
+) -> Tuple[Tensor, Tensor]:
+    """Cosine similarities and bank indices of the k nearest neighbors of every (normalized) query.
+
+    The bank is streamed in blocks of KNN_BLOCK_SIZE rows, so it never has to fit into memory. The blocks are
+    searched one after the other, the similarity matmul of a block already uses all intra-op threads of torch
+    (and only a single block is allocated on the GPU). The top k of the blocks seen so far are merged with the
+    top k of every block.
+    """
+    k = min(k, len(bank))
+    queries = queries.to(device)
+    top_sims = torch.full((len(queries), 0), -torch.inf, device=device)
+    top_indices = torch.zeros((len(queries), 0), dtype=torch.long, device=device)
+    for start in range(0, len(bank), KNN_BLOCK_SIZE):
+        block = _bank_block(bank, start, device)
+        sims, indices = (queries @ block.T).topk(min(k, len(block)), dim=1)
+        top_sims, top_indices = _merge_top_k(top_sims, top_indices, sims, indices + start, k)
+    return top_sims, top_indices
+
+
+def _merge_top_k(
+    sims: Tensor, indices: Tensor, other_sims: Tensor, other_indices: Tensor, k: int
+) -> Tuple[Tensor, Tensor]:
+    sims = torch.cat([sims, other_sims], dim=1)
+    indices = torch.cat([indices, other_indices], dim=1)
+    sims, order = sims.topk(min(k, sims.shape[1]), dim=1)
+    return sims, indices.gather(1, order)
+
+
+def knn_class_scores(
+    sims: Tensor, neighbor_labels: Tensor, num_classes: int, temperatures: Tensor
+) -> Tensor:
+    """Class scores with the weighting of InstDisc, every neighbor votes with exp(similarity / temperature).
+
+    Returns the scores of all temperatures, shape: (temperatures, queries, classes). The similarities are shifted
+    by the one of the nearest neighbor first, which scales the scores of a query by a constant and avoids
+    overflows for small temperatures.
+    """
+    weights = ((sims - sims[:, :1]) / temperatures[:, None, None]).exp()
+    scores = torch.zeros(
+        len(temperatures), len(sims), num_classes, device=sims.device, dtype=weights.dtype
+    )
+    return scores.scatter_add_(2, neighbor_labels.expand_as(weights), weights)
+
+
+def knn_evaluate(
+    train: FeatureDataset,
+    val: FeatureDataset,
+    num_classes: int,
+    ks: Sequence[int],
+    temperatures: Sequence[float],
+    bank_dtype: str,
+    device: torch.device,
+    topk: Tuple[int, ...] = (1, 5),
+) -> dict:
+    """KNN accuracies of the val split with the train split as reference samples, for all k and temperatures.
+
+    The bank is searched once for the max(ks) nearest neighbors of every query, all combinations of k and
+    temperature are computed from these neighbors. Returns {val_top<t>_k<k>_t<temperature>: accuracy}.
+    """
+    bank = load_knn_bank(train, bank_dtype)
+    bank_labels = torch.from_numpy(np.array(train.labels)).view(-1).long().to(device)
+    topk = tuple(t for t in topk if t <= num_classes)
+    temperatures_tensor = torch.tensor(temperatures, dtype=torch.float32, device=device)
+    # number of correct predictions, shape: (k, temperatures, topk)
+    correct = torch.zeros(len(ks), len(temperatures), len(topk), device=device)
+    num_queries = val.features.shape[1]
+    for start in range(0, num_queries, KNN_QUERY_CHUNK_SIZE):
+        end = start + KNN_QUERY_CHUNK_SIZE
+        queries = F.normalize(torch.from_numpy(np.array(val.features[0, start:end])), dim=1)
+        labels = torch.from_numpy(np.array(val.labels[start:end])).view(-1).long().to(device)
+        # sorted by similarity, the first k neighbors are the k nearest ones
+        sims, indices = knn_search(bank, queries, max(ks), device)
+        neighbor_labels = bank_labels[indices]
+        for i, k in enumerate(ks):
+            scores = knn_class_scores(
+                sims[:, :k], neighbor_labels[:, :k], num_classes, temperatures_tensor
+            )
+            hits = scores.topk(max(topk), dim=2).indices == labels[:, None]
+            for j, t in enumerate(topk):
+                correct[i, :, j] += hits[..., :t].any(dim=2).sum(dim=1)
+
+    accuracy = (correct / num_queries).tolist()
+    return {
+        f"val_top{t}_k{k}_t{temperature:g}": accuracy[i][j][l]
+        for i, k in enumerate(ks)
+        for j, temperature in enumerate(temperatures)
+        for l, t in enumerate(topk)
+    }
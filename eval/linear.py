@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Sequence, Union
 
 import wandb
 from lightly.utils.benchmarking import MetricCallback
@@ -6,13 +7,21 @@ from lightly.utils.dist import print_rank_zero
 from pytorch_lightning import Trainer
 from pytorch_lightning.callbacks import LearningRateMonitor
 from pytorch_lightning.loggers import WandbLogger
-from torch.nn import Module, Sequential
+from torch.nn import Identity, Module, Sequential
 import kornia.augmentation as K
 
 from data.mmearth_dataset import (
     get_mmearth_dataloaders,
 )
-from eval.helper_modules import LinearClassifier
+from data.samplers import shards_by_rank
+from eval.feature_cache import get_device, get_mmearth_feature_dataloaders
+from eval.linear_solvers import fit_linear_probe
+from eval.helper_modules import (
+    LINEAR_LRS,
+    LINEAR_SEEDS,
+    LINEAR_WEIGHT_DECAYS,
+    MultiHeadLinearClassifier,
+)
 
 
 def linear_eval(
@@ -29,6 +38,16 @@ def linear_eval(
     precision: str,
     num_classes: int,
     no_ffcv: bool,
+    storage: str = "float32",
+    num_shards: int = 1,
+    feature_cache: bool = True,
+    feature_flips: bool = False,
+    linear_lrs: Sequence[float] = LINEAR_LRS,
+    linear_weight_decays: Sequence[float] = LINEAR_WEIGHT_DECAYS,
+    linear_seeds: Sequence[int] = LINEAR_SEEDS,
+    linear_solver: str = "sgd",
+    dataloaders: Union[Sequence, None] = None,
+    feature_dataloaders: Union[Sequence, None] = None,
     debug: bool = False,
 ) -> None:
     """Runs a linear evaluation on the given model.
@@ -39,17 +58,30 @@ def linear_eval(
         - Backbone: Frozen
         - Epochs: 90
         - Optimizer: SGD
-        - Base Learning Rate: 0.1
+        - Base Learning Rate: 0.1 (one head per value of linear_lrs)
         - Momentum: 0.9
         - Weight Decay: 0.0
         - LR Schedule: Cosine without warmup
 
+    With feature_cache, the frozen backbone is run once per sample and the linear head is trained on the cached
+    features instead (see `eval.feature_cache`). The features of the flip augmentation are only extracted with
+    feature_flips (4 times per train sample). One head is trained per combination of
+    linear_lrs, linear_weight_decays and linear_seeds in the same run, the best head by val_top1 is reported.
+    With linear_solver "ridge" or "lbfgs", the probe is fitted on the cached features with a convex solver
+    instead of SGD (see `eval.linear_solvers`).
+
+    dataloaders (train, val) and feature_dataloaders (train, val, see `get_mmearth_feature_dataloaders`) can be
+    passed to share them with other evaluations, otherwise they are created.
+
     References:
         - [0]: SimCLR, 2020, https://arxiv.org/abs/2002.05709
     """
     assert (
         target_modality is not None
     ), "target modality needs to be set for offline evaluation"
+    assert linear_solver == "sgd" or (
+        feature_cache and not debug
+    ), f"linear solver '{linear_solver}' needs the feature cache, which is disabled"
     print_rank_zero("Running linear evaluation...")
 
     # Setup training data.
@@ -57,16 +89,62 @@ def linear_eval(
         K.RandomHorizontalFlip(),
         K.RandomVerticalFlip(),
     )
-    train_dataloader, val_dataloader = get_mmearth_dataloaders(
-        data_dir,
-        processed_dir,
-        input_modality,
-        target_modality,
-        num_workers,
-        batch_size_per_device,
-        ["train", "val"],
-        no_ffcv,
-    )
+    if dataloaders is None:
+        dataloaders = get_mmearth_dataloaders(
+            data_dir,
+            processed_dir,
+            input_modality,
+            target_modality,
+            num_workers,
+            batch_size_per_device,
+            ["train", "val"],
+            no_ffcv,
+            storage=storage,
+            num_shards=num_shards,
+        )
+    train_dataloader, val_dataloader = dataloaders
+    classifier_model = model
+    if feature_cache and not debug:
+        if feature_dataloaders is None:
+            feature_dataloaders = get_mmearth_feature_dataloaders(
+                model,
+                dataloaders,
+                data_dir,
+                processed_dir,
+                input_modality,
+                target_modality,
+                storage,
+                batch_size_per_device,
+                num_workers,
+                accelerator,
+                train_flips=feature_flips,
+            )
+        train_dataloader, val_dataloader = feature_dataloaders
+        # the flips are part of the cached features (with feature_flips), otherwise there are none
+        classifier_model = Identity()
+        train_transform = None
+
+    if linear_solver != "sgd":
+        metrics = fit_linear_probe(
+            linear_solver,
+            train_dataloader.dataset,
+            None if val_dataloader is None else val_dataloader.dataset,
+            None,
+            num_classes=num_classes,
+            multi_label=False,
+            device=get_device(accelerator),
+        )
+        WandbLogger(
+            save_dir=str(log_dir),
+            name=f"linear_eval",
+            project="ssl4eo",
+            config=model.hparams,
+            offline=debug,
+        ).log_metrics(metrics)
+        wandb.finish()
+        for metric, value in metrics.items():
+            print_rank_zero(f"linear {linear_solver} {metric}: {value}")
+        return
 
     # Train linear classifier.
     metric_callback = MetricCallback()
@@ -91,13 +169,17 @@ def linear_eval(
         # strategy="ddp_find_unused_parameters_true",
         num_sanity_val_steps=0,
         fast_dev_run=debug,
+        # the no ffcv loaders split the samples between the DDP ranks themselves
+        use_distributed_sampler=not shards_by_rank(train_dataloader),
     )
-    classifier = LinearClassifier(
-        model=model,
+    classifier = MultiHeadLinearClassifier(
+        model=classifier_model,
         batch_size_per_device=batch_size_per_device,
         feature_dim=model.last_backbone_channel,
         num_classes=num_classes,
-        freeze_model=True,
+        lrs=linear_lrs,
+        weight_decays=linear_weight_decays,
+        seeds=linear_seeds,
         train_transform=train_transform,
     )
     trainer.fit(
@@ -112,10 +194,10 @@ def linear_eval(
     if val_dataloader is None:
         for metric in ["train_top1", "train_top5"]:
             print_rank_zero(
-                f"max linear {metric}: {max(metric_callback.train_metrics[metric])}"
+                f"max linear {metric}: {classifier.max_metric(metric_callback.train_metrics, metric)}"
             )
     else:
         for metric in ["val_top1", "val_top5"]:
             print_rank_zero(
-                f"max linear {metric}: {max(metric_callback.val_metrics[metric])}"
+                f"max linear {metric}: {classifier.max_metric(metric_callback.val_metrics, metric)}"
             )
@@ -0,0 +1,238 @@
+import time
+from typing import Iterator, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from lightly.utils.dist import print_rank_zero
+from torch import Tensor
+
+from eval.feature_cache import FeatureDataset
+from eval.helper_modules import multilabel_metrics
+
+# how the linear evaluation is trained on cached features:
+# - sgd: MultiHeadLinearClassifier, trained for 90 epochs
+# - ridge: ridge regression on +-1 targets, solved in closed form from the gram matrix of the features
+# - lbfgs: full batch multinomial logistic regression (one-vs-rest BCE for multi-label datasets) with L-BFGS
+LINEAR_SOLVERS = ["sgd", "ridge", "lbfgs"]
+
+# ridge penalties, relative to the mean eigenvalue of the (centered) gram matrix
+RIDGE_ALPHAS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+# weight decays of the logistic regression, fitted from the largest to the smallest (warm started)
+LBFGS_WEIGHT_DECAYS = (1e-2, 1e-3, 1e-4, 1e-5, 0.0)
+LBFGS_MAX_ITER = 100
+
+# number of samples per chunk, the features are never loaded as a whole
+CHUNK_SIZE = 16384
+
+
+def iter_chunks(
+    dataset: FeatureDataset,
+    device: torch.device,
+    dtype: torch.dtype = torch.float32,
+    variants: Sequence[int] = None,
+) -> Iterator[Tuple[Tensor, Tensor]]:
+    """Yields (features, labels) chunks of the flip variants (default: all), read from the memory mapped files."""
+    features, labels = dataset.features, dataset.labels
+    for variant in range(features.shape[0]) if variants is None else variants:
+        for start in range(0, features.shape[1], CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            yield (
+                torch.from_numpy(np.array(features[variant, start:end])).to(device, dtype),
+                torch.from_numpy(np.array(labels[start:end])).to(device),
+            )
+
+
+def ridge_targets(labels: Tensor, num_classes: int, multi_label: bool) -> Tensor:
+    if not multi_label:
+        labels = F.one_hot(labels.view(-1).long(), num_classes)
+    return labels.to(torch.float64) * 2 - 1
+
+
+def accumulate_gram(
+    dataset: FeatureDataset, num_classes: int, multi_label: bool, device: torch.device
+) -> dict:
+    """Centered gram matrix X^T X and X^T Y of the features X and +-1 targets Y, accumulated chunk by chunk."""
+    dim = dataset.features.shape[-1]
+    kwargs = dict(device=device, dtype=torch.float64)
+    n = 0
+    sum_x, sum_y = torch.zeros(dim, **kwargs), torch.zeros(num_classes, **kwargs)
+    xx, xy = torch.zeros(dim, dim, **kwargs), torch.zeros(dim, num_classes, **kwargs)
+    for x, labels in iter_chunks(dataset, device, torch.float64):
+        y = ridge_targets(labels, num_classes, multi_label)
+        n += len(x)
+        sum_x += x.sum(dim=0)
+        sum_y += y.sum(dim=0)
+        xx += x.T @ x
+        xy += x.T @ y
+    mean_x, mean_y = sum_x / n, sum_y / n
+    return {
+        "mean_x": mean_x,
+        "mean_y": mean_y,
+        "xx": xx - n * torch.outer(mean_x, mean_x),
+        "xy": xy - n * torch.outer(mean_x, mean_y),
+    }
+
+
+def fit_ridge(
+    dataset: FeatureDataset,
+    num_classes: int,
+    multi_label: bool,
+    device: torch.device,
+    alphas: Sequence[float] = RIDGE_ALPHAS,
+) -> Iterator[Tuple[float, Tensor, Tensor]]:
+    """Yields (alpha, weight, bias) of the ridge solutions for all alphas, the bias is not penalized.
+
+    The gram matrix is decomposed once, every alpha then only costs a (dim x dim) @ (dim x classes) matmul.
+    """
+    gram = accumulate_gram(dataset, num_classes, multi_label, device)
+    eigvals, eigvecs = torch.linalg.eigh(gram["xx"])
+    eigvals = eigvals.clamp(min=0)
+    projected = eigvecs.T @ gram["xy"]
+    scale = eigvals.mean().clamp(min=1e-12)
+    for alpha in alphas:
+        weight = eigvecs @ (projected / (eigvals + alpha * scale)[:, None])
+        bias = gram["mean_y"] - gram["mean_x"] @ weight
+        yield alpha, weight.float(), bias.float()
+
+
+def feature_moments(dataset: FeatureDataset, device: torch.device) -> Tuple[Tensor, Tensor]:
+    n, sum_x, sum_xx = 0, 0, 0
+    for x, _ in iter_chunks(dataset, device, torch.float64):
+        n += len(x)
+        sum_x = sum_x + x.sum(dim=0)
+        sum_xx = sum_xx + x.pow(2).sum(dim=0)
+    mean = sum_x / n
+    std = (sum_xx / n - mean**2).clamp(min=0).sqrt().clamp(min=1e-6)
+    return mean.float(), std.float()
+
+
+def fit_lbfgs(
+    dataset: FeatureDataset,
+    num_classes: int,
+    multi_label: bool,
+    device: torch.device,
+    weight_decays: Sequence[float] = LBFGS_WEIGHT_DECAYS,
+    max_iter: int = LBFGS_MAX_ITER,
+) -> Iterator[Tuple[float, Tensor, Tensor]]:
+    """Yields (weight decay, weight, bias) of full batch logistic regressions fitted with L-BFGS.
+
+    The loss and gradient of every L-BFGS evaluation are accumulated over chunks of the standardized features.
+    Each weight decay is warm started from the solution of the previous (larger) one.
+    """
+    mean, std = feature_moments(dataset, device)
+    n = dataset.features.shape[0] * dataset.features.shape[1]
+    weight = torch.zeros(len(mean), num_classes, device=device, requires_grad=True)
+    bias = torch.zeros(num_classes, device=device, requires_grad=True)
+
+    for weight_decay in weight_decays:
+        optimizer = torch.optim.LBFGS(
+            [weight, bias],
+            lr=1,
+            max_iter=max_iter,
+            history_size=20,
+            line_search_fn="strong_wolfe",
+        )
+
+        def closure() -> Tensor:
+            optimizer.zero_grad()
+            total = torch.zeros((), device=device)
+            for x, labels in iter_chunks(dataset, device):
+                logits = ((x - mean) / std) @ weight + bias
+                if multi_label:
+                    loss = F.binary_cross_entropy_with_logits(
+                        logits, labels.to(logits.dtype), reduction="sum"
+                    )
+                else:
+                    loss = F.cross_entropy(logits, labels.view(-1).long(), reduction="sum")
+                (loss / n).backward()
+                total += loss.detach() / n
+            penalty = weight_decay / 2 * weight.pow(2).sum()
+            penalty.backward()
+            return total + penalty.detach()
+
+        optimizer.step(closure)
+        with torch.no_grad():
+            # undo the standardization, the solution applies to the raw features
+            raw_weight, raw_bias = weight / std[:, None], bias - (mean / std) @ weight
+        yield weight_decay, raw_weight, raw_bias
+
+
+@torch.no_grad()
+def predict(
+    dataset: FeatureDataset, weight: Tensor, bias: Tensor, device: torch.device
+) -> Tuple[Tensor, Tensor]:
+    """Logits and labels of the first flip variant (no flip) of all samples."""
+    logits, labels = [], []
+    for x, y in iter_chunks(dataset, device, variants=[0]):
+        logits.append(x @ weight + bias)
+        labels.append(y)
+    return torch.cat(logits), torch.cat(labels)
+
+
+def probe_metrics(
+    logits: Tensor,
+    labels: Tensor,
+    num_classes: int,
+    multi_label: bool,
+    topk: Tuple[int, ...] = (1, 5),
+) -> dict:
+    """top1/f1/mAP for multi-label datasets, otherwise topk accuracies, like the SGD linear classifiers."""
+    if multi_label:
+        metrics = multilabel_metrics(logits.sigmoid(), labels, num_classes)
+        return {metric: value.item() for metric, value in metrics.items()}
+    predicted = logits.topk(max(k for k in topk if k <= num_classes), dim=1).indices
+    correct = predicted == labels.view(-1, 1)
+    return {
+        f"top{k}": correct[:, :k].any(dim=1).float().mean().item()
+        for k in topk
+        if k <= num_classes
+    }
+
+
+def fit_linear_probe(
+    solver: str,
+    train: FeatureDataset,
+    val: Union[FeatureDataset, None],
+    test: Union[FeatureDataset, None],
+    num_classes: int,
+    multi_label: bool,
+    device: torch.device,
+) -> dict:
+    """Fits a linear probe on cached features with a convex solver and returns the metrics of all splits.
+
+    The solver fits a probe for every regularization strength (RIDGE_ALPHAS or LBFGS_WEIGHT_DECAYS), the one
+    with the best val_top1 (train_top1 without validation split) is evaluated on all splits. Returns the
+    metrics as {<split>_<metric>: value}, including the selected regularization strength.
+    """
+    assert solver in ["ridge", "lbfgs"], f"solver '{solver}' not supported"
+    fit = fit_ridge if solver == "ridge" else fit_lbfgs
+    regularization = "alpha" if solver == "ridge" else "weight_decay"
+    selection = val if val is not None else train
+
+    start = time.perf_counter()
+    selection_split = "val" if val is not None else "train"
+    best = None
+    for value, weight, bias in fit(train, num_classes, multi_label, device):
+        top1 = probe_metrics(
+            *predict(selection, weight, bias, device), num_classes, multi_label
+        )["top1"]
+        print_rank_zero(
+            f"{solver} probe {regularization}={value:g}: {selection_split}_top1 {top1:.4f}"
+        )
+        if best is None or top1 > best[0]:
+            best = (top1, value, weight, bias)
+    _, value, weight, bias = best
+
+    metrics = {regularization: value}
+    for split, dataset in [("train", train), ("val", val), ("test", test)]:
+        if dataset is None:
+            continue
+        split_metrics = probe_metrics(
+            *predict(dataset, weight, bias, device), num_classes, multi_label
+        )
+        metrics.update({f"{split}_{metric}": v for metric, v in split_metrics.items()})
+    print_rank_zero(
+        f"Fitted {solver} probe in {time.perf_counter() - start:.1f}s ({regularization}={value:g})."
+    )
+    return metrics
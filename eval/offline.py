@@ -0,0 +1,141 @@
+from pathlib import Path
+from typing import Sequence
+
+from lightly.utils.dist import print_rank_zero
+from torch.nn import Module
+
+from data.mmearth_dataset import (
+    get_mmearth_dataloaders,
+)
+from eval.feature_cache import get_mmearth_feature_dataloaders
+from eval.finetune import finetune_eval
+from eval.helper_modules import LINEAR_LRS, LINEAR_SEEDS, LINEAR_WEIGHT_DECAYS
+from eval.knn import KNN_KS, KNN_TEMPERATURES, knn_eval
+from eval.linear import linear_eval
+
+
+def offline_eval(
+    model: Module,
+    input_modality: dict,
+    target_modality: [dict],
+    data_dir: Path,
+    processed_dir: Path,
+    log_dir: Path,
+    batch_size_per_device: int,
+    num_workers: int,
+    accelerator: str,
+    devices: int,
+    precision: str,
+    num_classes: int,
+    no_ffcv: bool,
+    enable_linear_eval: bool,
+    enable_knn_eval: bool,
+    enable_finetune_eval: bool,
+    storage: str = "float32",
+    num_shards: int = 1,
+    feature_cache: bool = True,
+    feature_flips: bool = False,
+    linear_lrs: Sequence[float] = LINEAR_LRS,
+    linear_weight_decays: Sequence[float] = LINEAR_WEIGHT_DECAYS,
+    linear_seeds: Sequence[int] = LINEAR_SEEDS,
+    linear_solver: str = "sgd",
+    knn_bank_dtype: str = "float16",
+    knn_ks: Sequence[int] = KNN_KS,
+    knn_temperatures: Sequence[float] = KNN_TEMPERATURES,
+    debug: bool = False,
+) -> None:
+    """Runs the enabled offline evaluations (linear, KNN, fine-tune) of a model on MMEarth.
+
+    The train and val loaders are created once and shared by all evaluations. With feature_cache, the features
+    of the frozen model are extracted once and used by both the linear and the KNN evaluation. Fine-tuning
+    changes the model, so it runs last and is the only evaluation that uses the images again.
+    """
+    assert (
+        target_modality is not None
+    ), "target modality needs to be set for offline evaluation"
+    if not (enable_linear_eval or enable_knn_eval or enable_finetune_eval):
+        print_rank_zero("Skipping offline eval, no evaluation enabled.")
+        return
+
+    eval_config = {
+        "model": model,
+        "input_modality": input_modality,
+        "target_modality": target_modality,
+        "data_dir": data_dir,
+        "processed_dir": processed_dir,
+        "log_dir": log_dir,
+        "batch_size_per_device": batch_size_per_device,
+        "num_workers": num_workers,
+        "accelerator": accelerator,
+        "devices": devices,
+        "num_classes": num_classes,
+        "no_ffcv": no_ffcv,
+        "storage": storage,
+        "num_shards": num_shards,
+        "debug": debug,
+    }
+    dataloaders = get_mmearth_dataloaders(
+        data_dir,
+        processed_dir,
+        input_modality,
+        target_modality,
+        num_workers,
+        batch_size_per_device,
+        ["train", "val"],
+        no_ffcv,
+        storage=storage,
+        num_shards=num_shards,
+    )
+    feature_dataloaders = None
+    if feature_cache and not debug and (enable_linear_eval or enable_knn_eval):
+        feature_dataloaders = get_mmearth_feature_dataloaders(
+            model,
+            dataloaders,
+            data_dir,
+            processed_dir,
+            input_modality,
+            target_modality,
+            storage,
+            batch_size_per_device,
+            num_workers,
+            accelerator,
+            train_flips=feature_flips,
+        )
+
+    # Perform linear evaluation if enabled
+    if enable_linear_eval:
+        linear_eval(
+            **eval_config,
+            precision=precision,
+            feature_cache=feature_cache,
+            feature_flips=feature_flips,
+            linear_lrs=linear_lrs,
+            linear_weight_decays=linear_weight_decays,
+            linear_seeds=linear_seeds,
+            linear_solver=linear_solver,
+            dataloaders=dataloaders,
+            feature_dataloaders=feature_dataloaders,
+        )
+    else:
+        print_rank_zero("Skipping linear eval.")
+
+    # Perform KNN evaluation if enabled
+    if enable_knn_eval:
+        knn_eval(
+            **eval_config,
+            feature_cache=feature_cache,
+            feature_flips=feature_flips,
+            knn_bank_dtype=knn_bank_dtype,
+            knn_ks=knn_ks,
+            knn_temperatures=knn_temperatures,
+            dataloaders=dataloaders,
+            feature_dataloaders=feature_dataloaders,
+        )
+    else:
+        print_rank_zero("Skipping KNN eval.")
+
+    # Perform fine-tuning evaluation if enabled, it trains the backbone so it has to be the last one
+    if enable_finetune_eval:
+        finetune_eval(**eval_config, precision=precision, dataloaders=dataloaders)
+    else:
+        print_rank_zero("Skipping fine-tune eval.")
@@ -0,0 +1,407 @@
+"""Exports the pooled embeddings of a pretrained backbone for every sample of a MMEarth split or GeoBench task.
+
+Examples:
+    python export_embeddings.py --ckpt-path model.ckpt --split train --out-dir embeddings/mmearth_train
+    python export_embeddings.py --ckpt-path model.ckpt --geobench-dataset m-eurosat --split test \
+        --format parquet --out-dir embeddings/eurosat_test
+
+The embeddings (model(x) flattened, as in the offline evaluations) are written together with the sample ids
+(MMEarth tile names, GeoBench sample names) in shards of --shard-size samples, either as .npy files that can be
+memory mapped (embeddings_<shard>.npy, ids_<shard>.npy) or as parquet files (embeddings_<shard>.parquet).
+Completed shards are recorded in export.json, an interrupted export restarts after the last completed shard.
+"""
+import json
+import os
+import time
+from argparse import ArgumentParser
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Iterable, Union
+
+import numpy as np
+import torch
+from lightly.utils.dist import print_rank_zero
+from pytorch_lightning import LightningModule
+from torch import Tensor
+from torch.utils.data import DataLoader, Subset
+
+from data import GeobenchDataset, get_mmearth_dataloaders
+from data.beton_cache import get_tmp_file
+from data.constants import IN_MODALITIES, MMEARTH_DIR
+from data.mmearth_dataset import MMEarthDataset, collate_stacked, create_MMEearth_args
+from data.samplers import SortedBatchSampler
+from data.storage import SENTINEL2_STORAGE
+from eval.feature_cache import get_device
+from main import METHODS
+from methods.transforms import to_tensor
+
+# file formats of the shards, parquet needs pyarrow
+EXPORT_FORMATS = ["npy", "parquet"]
+EXPORT_PRECISIONS = {"32": None, "16-mixed": torch.float16, "bf16-mixed": torch.bfloat16}
+EXPORT_DTYPES = ["float32", "float16"]
+
+parser = ArgumentParser("MMEarth embedding export")
+parser.add_argument(
+    "--ckpt-path",
+    type=Path,
+    required=True,
+    help="Path to a checkpoint of one of the pretraining methods (see main.py).",
+)
+parser.add_argument(
+    "--out-dir",
+    type=Path,
+    required=True,
+    help="Directory the shards are written to, an export into an existing directory is resumed.",
+)
+parser.add_argument(
+    "--data-dir",
+    type=Path,
+    default=MMEARTH_DIR,
+    help="Path to the raw MMEarth dataset folder (default: MMEARTH_DIR).",
+)
+parser.add_argument(
+    "--processed-dir",
+    type=Path,
+    default=None,
+    help="Path to the processed (beton) dataset folder (default: None). If not given the data_dir will be used",
+)
+parser.add_argument(
+    "--geobench-dataset",
+    type=str,
+    default=None,
+    help="GeoBench dataset to export instead of MMEarth, e.g., 'm-eurosat' (default: None).",
+)
+parser.add_argument(
+    "--geobench-partition",
+    type=str,
+    default="default",
+    help="Partition of the GeoBench dataset (default: 'default').",
+)
+parser.add_argument(
+    "--split",
+    type=str,
+    default="train",
+    help="Split to export: 'train', 'val' or 'test' (default: 'train').",
+)
+parser.add_argument(
+    "--input-channel",
+    "-i",
+    type=str,
+    default="all",
+    help="Sentinel-2 input channel selection the model was trained with: 'all', 'rgb' (default: 'all').",
+)
+parser.add_argument(
+    "--no-ffcv",
+    action="store_true",
+    help="If set, the MMEarth samples are read from the h5 file with a pytorch DataLoader instead of ffcv.Loader.",
+)
+parser.add_argument(
+    "--storage",
+    type=str,
+    default="float32",
+    choices=SENTINEL2_STORAGE,
+    help="How Sentinel-2 data is stored in the processed MMEarth beton files (default: 'float32').",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=256,
+    help="Batch size (default: 256).",
+)
+parser.add_argument(
+    "--num-workers",
+    type=int,
+    default=8,
+    help="Number of threads to use for data loading (default: 8).",
+)
+parser.add_argument(
+    "--accelerator",
+    type=str,
+    default="gpu",
+    help="'gpu' (if available) or 'cpu' (default: 'gpu').",
+)
+parser.add_argument(
+    "--precision",
+    type=str,
+    default="16-mixed",
+    choices=list(EXPORT_PRECISIONS),
+    help="Precision of the forward pass: '32', '16-mixed' or 'bf16-mixed' (default: '16-mixed').",
+)
+parser.add_argument(
+    "--shard-size",
+    type=int,
+    default=65536,
+    help="Number of samples per shard (default: 65536).",
+)
+parser.add_argument(
+    "--format",
+    type=str,
+    default="npy",
+    choices=EXPORT_FORMATS,
+    help="File format of the shards: 'npy' or 'parquet' (default: 'npy').",
+)
+parser.add_argument(
+    "--embedding-dtype",
+    type=str,
+    default="float32",
+    choices=EXPORT_DTYPES,
+    help="Data type the embeddings are stored as (default: 'float32').",
+)
+
+
+def load_model(ckpt_path: Path) -> LightningModule:
+    """Creates the model of the pretraining method of a checkpoint and loads its weights."""
+    ckpt = torch.load(ckpt_path, map_location="cpu")
+    hparams = dict(ckpt["hyper_parameters"])
+    method = hparams.pop("method").lower()
+    model = METHODS[method]["model"](
+        **hparams, train_transform=METHODS[method]["transform"]
+    )
+    model.load_state_dict(ckpt["state_dict"])
+    return model
+
+
+def get_shard_files(out_dir: Path, shard: int, format: str) -> list[Path]:
+    if format == "parquet":
+        return [out_dir / f"embeddings_{shard:05d}.parquet"]
+    return [out_dir / f"embeddings_{shard:05d}.npy", out_dir / f"ids_{shard:05d}.npy"]
+
+
+def get_progress_file(out_dir: Path) -> Path:
+    return out_dir / "export.json"
+
+
+def write_progress(out_dir: Path, progress: dict):
+    progress_file = get_progress_file(out_dir)
+    tmp_file = get_tmp_file(progress_file)
+    with open(tmp_file, "w") as f:
+        json.dump(progress, f, indent=2, default=str)
+    os.replace(tmp_file, progress_file)
+
+
+def write_shard(out_dir: Path, shard: int, embeddings: np.ndarray, ids: list, format: str):
+    """Writes the embeddings and ids of a shard, each file to a temporary file first."""
+    files = get_shard_files(out_dir, shard, format)
+    tmp_files = [get_tmp_file(file) for file in files]
+    if format == "parquet":
+        # optional dependency, only needed for parquet shards
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.table(
+            {
+                "id": pa.array(ids, type=pa.string()),
+                "embedding": pa.FixedSizeListArray.from_arrays(
+                    pa.array(embeddings.reshape(-1)), embeddings.shape[1]
+                ),
+            }
+        )
+        pq.write_table(table, tmp_files[0])
+    else:
+        for data, tmp_file in [(embeddings, tmp_files[0]), (np.array(ids), tmp_files[1])]:
+            out = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=data.dtype, shape=data.shape)
+            out[:] = data
+            out.flush()
+            del out
+    for tmp_file, file in zip(tmp_files, files):
+        os.replace(tmp_file, file)
+
+
+def export_embeddings(
+    model: LightningModule,
+    batches: Iterable[Tensor],
+    get_ids: Callable[[int, int], list],
+    num_samples: int,
+    out_dir: Path,
+    progress: dict,
+    shard_size: int,
+    format: str,
+    embedding_dtype: str,
+    device: torch.device,
+    precision: str,
+) -> int:
+    """Embeds the batches and writes them to the shards that are not completed yet.
+
+    The completed shards of the progress are a prefix of all shards, the batches have to start at the first
+    sample after them. Every written shard is recorded in the progress file. Returns the number of embedded samples.
+    """
+    start = sum(shard["num_samples"] for shard in progress["completed"].values())
+    assert start == len(progress["completed"]) * shard_size or start == num_samples, (
+        "completed shards are not a prefix of the export"
+    )
+    autocast_dtype = EXPORT_PRECISIONS[precision]
+    autocast = (
+        torch.autocast(device.type, dtype=autocast_dtype)
+        if autocast_dtype is not None
+        else nullcontext()
+    )
+
+    model.eval().to(device)
+    buffer, buffered = [], 0
+    shard_start, shard_time = start, time.perf_counter()
+    total_time = time.perf_counter()
+
+    def write_buffer(n: int):
+        nonlocal buffer, buffered, shard_start, shard_time
+        embeddings = np.concatenate(buffer)
+        buffer, buffered = [embeddings[n:]], len(embeddings) - n
+        shard = shard_start // shard_size
+        write_shard(
+            out_dir, shard, embeddings[:n], get_ids(shard_start, shard_start + n), format
+        )
+        seconds = time.perf_counter() - shard_time
+        progress["completed"][get_shard_files(out_dir, shard, format)[0].name] = {
+            "num_samples": n,
+            "seconds": seconds,
+        }
+        write_progress(out_dir, progress)
+        print_rank_zero(
+            f"Exported shard {shard} ({n} samples, {n / max(seconds, 1e-9):.1f} samples/s)."
+        )
+        shard_start, shard_time = shard_start + n, time.perf_counter()
+
+    with torch.no_grad(), autocast:
+        for images in batches:
+            embeddings = model(images.to(device, non_blocking=True)).flatten(start_dim=1)
+            buffer.append(embeddings.float().cpu().numpy().astype(embedding_dtype))
+            buffered += len(images)
+            while buffered >= min(shard_size, num_samples - shard_start) > 0:
+                write_buffer(min(shard_size, num_samples - shard_start))
+
+    exported = shard_start - start
+    assert shard_start == num_samples and buffered == 0, (
+        f"expected {num_samples - start} samples, got {exported + buffered}"
+    )
+    duration = time.perf_counter() - total_time
+    print_rank_zero(
+        f"Exported {exported} samples in {duration:.1f}s ({exported / max(duration, 1e-9):.1f} samples/s), "
+        f"{num_samples} samples in total."
+    )
+    return exported
+
+
+def main(
+    ckpt_path: Path,
+    out_dir: Path,
+    data_dir: Path,
+    processed_dir: Path,
+    geobench_dataset: Union[str, None],
+    geobench_partition: str,
+    split: str,
+    input_channel: str,
+    no_ffcv: bool,
+    storage: str,
+    batch_size: int,
+    num_workers: int,
+    accelerator: str,
+    precision: str,
+    shard_size: int,
+    format: str,
+    embedding_dtype: str,
+):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    torch.set_float32_matmul_precision("high")
+    # shards of an interrupted export that were not completely written
+    for tmp_file in out_dir.glob("*.tmp"):
+        tmp_file.unlink()
+
+    # everything that determines the content of the shards, an existing export has to match it
+    metadata = {
+        "ckpt_path": ckpt_path.resolve(),
+        "dataset": geobench_dataset or data_dir.resolve(),
+        "partition": geobench_partition if geobench_dataset else None,
+        "split": split,
+        "input_channel": None if geobench_dataset else input_channel,
+        "shard_size": shard_size,
+        "format": format,
+        "embedding_dtype": embedding_dtype,
+    }
+    metadata = json.loads(json.dumps(metadata, default=str))
+    progress = {"metadata": metadata, "completed": {}}
+    if get_progress_file(out_dir).exists():
+        with open(get_progress_file(out_dir), "r") as f:
+            progress = json.load(f)
+        assert progress["metadata"] == metadata, (
+            f"{out_dir} holds another export ({progress['metadata']}), use another output directory"
+        )
+        print_rank_zero(f"Resuming export, {len(progress['completed'])} shards already exported.")
+    start = sum(shard["num_samples"] for shard in progress["completed"].values())
+
+    model = load_model(ckpt_path)
+
+    if geobench_dataset is not None:
+        # the GeoBench tasks are small, their samples are read without beton files
+        dataset = GeobenchDataset(geobench_dataset, split=split, partition=geobench_partition)
+        geobench_split = "valid" if split == "val" else split
+        with open(dataset.dataset_dir / f"{geobench_partition}_partition.json", "r") as f:
+            names = json.load(f)[geobench_split]
+        num_samples = len(names)
+
+        def get_ids(start: int, end: int) -> list[str]:
+            return names[start:end]
+
+        dataloader = DataLoader(
+            Subset(dataset, range(start, num_samples)),
+            batch_size=batch_size,
+            num_workers=num_workers,
+        )
+        batches = (images for images, _ in dataloader)
+    else:
+        input_modality = IN_MODALITIES[input_channel]
+        args = create_MMEearth_args(data_dir, input_modality, None)
+        rows = args.tile_index.split(split)
+        num_samples = len(rows)
+
+        def get_ids(start: int, end: int) -> list[str]:
+            return args.tile_index.names(rows[start:end])
+
+        if no_ffcv:
+            dataset = MMEarthDataset(args, split=split, transform=to_tensor, return_tuple=True)
+            # batches of consecutive rows, read at once via MMEarthDataset.__getitems__
+            dataloader = DataLoader(
+                dataset,
+                batch_sampler=SortedBatchSampler(
+                    range(start, num_samples),
+                    batch_size=batch_size,
+                    drop_last=False,
+                    rows=dataset.indices,
+                ),
+                collate_fn=collate_stacked,
+                num_workers=num_workers,
+            )
+            batches = (batch[0] for batch in dataloader)
+        else:
+            (dataloader,) = get_mmearth_dataloaders(
+                data_dir,
+                processed_dir,
+                input_modality,
+                target_modality=None,
+                num_workers=num_workers,
+                batch_size_per_device=batch_size,
+                splits=[split],
+                storage=storage,
+                sequential=True,
+                # the samples of completed shards are not loaded
+                start_sample=start,
+            )
+            # no loader if all shards are completed
+            batches = () if dataloader is None else (batch[0] for batch in dataloader)
+
+    export_embeddings(
+        model,
+        batches,
+        get_ids,
+        num_samples,
+        out_dir,
+        progress,
+        shard_size=shard_size,
+        format=format,
+        embedding_dtype=embedding_dtype,
+        device=get_device(accelerator),
+        precision=precision,
+    )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(**vars(args))
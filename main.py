@@ -24,9 +24,16 @@ from data.constants import (
     input_size,
     IN_MODALITIES,
 )
-from eval import finetune_eval, geobench_clf_eval, knn_eval, linear_eval
+from data.samplers import shards_by_rank
+from data.storage import SENTINEL2_STORAGE
+from eval import geobench_clf_eval, offline_eval
+from eval.helper_modules import LINEAR_LRS, LINEAR_SEEDS, LINEAR_WEIGHT_DECAYS
+from eval.knn import KNN_KS, KNN_TEMPERATURES
+from eval.knn_bank import KNN_BANK_DTYPES
+from eval.linear_solvers import LINEAR_SOLVERS
 from methods import modules
 from methods import transforms
+from methods.profiler import ThroughputProfiler
 
 # Argparser for all your configuration needs
 parser = ArgumentParser("MMEarth Benchmark")
@@ -147,6 +154,103 @@ parser.add_argument(
     action="store_true",
     help="If set, pretraining will be done with regular pytorch DataLoader instead of ffcv.Loader (should be slower).",
 )
+parser.add_argument(
+    "--storage",
+    type=str,
+    default="float32",
+    choices=SENTINEL2_STORAGE,
+    help="How Sentinel-2 data is stored in the processed beton files: 'float32', 'float16' or 'int16' "
+    "(raw reflectances, normalized while loading). Smaller types halve the file size (default: 'float32').",
+)
+parser.add_argument(
+    "--num-shards",
+    type=int,
+    default=1,
+    help="Number of beton files each MMEarth split is converted to in parallel. "
+    "An interrupted conversion resumes from the finished shards (default: 1).",
+)
+parser.add_argument(
+    "--no-feature-cache",
+    action="store_true",
+    help="If set, linear evaluations run the frozen backbone in every epoch instead of training on "
+    "features that are extracted once and cached in <processed-dir>/features.",
+)
+parser.add_argument(
+    "--feature-flips",
+    action="store_true",
+    help="If set, the cached train features are extracted for all four flip variants of each image and the "
+    "linear head sees a random one, like the random flips without the feature cache. This runs the backbone 4 "
+    "times per train sample (default: features of the unflipped images only).",
+)
+parser.add_argument(
+    "--linear-lrs",
+    type=float,
+    nargs="+",
+    default=list(LINEAR_LRS),
+    help="Base learning rates of the linear evaluation, one linear head is trained per combination of "
+    "learning rate, weight decay and seed in the same run. On MMEarth, the best head is selected on the val "
+    f"metrics it reports (default: {' '.join(map(str, LINEAR_LRS))}).",
+)
+parser.add_argument(
+    "--linear-weight-decays",
+    type=float,
+    nargs="+",
+    default=list(LINEAR_WEIGHT_DECAYS),
+    help=f"Weight decays of the linear heads (default: {' '.join(map(str, LINEAR_WEIGHT_DECAYS))}).",
+)
+parser.add_argument(
+    "--linear-seeds",
+    type=int,
+    nargs="+",
+    default=list(LINEAR_SEEDS),
+    help=f"Initialization seeds of the linear heads (default: {' '.join(map(str, LINEAR_SEEDS))}).",
+)
+parser.add_argument(
+    "--linear-solver",
+    type=str,
+    default="sgd",
+    choices=LINEAR_SOLVERS,
+    help="How linear evaluations are trained: 'sgd' (90 epochs of the linear heads), 'ridge' (closed form) or "
+    "'lbfgs' (full batch logistic regression). 'ridge' and 'lbfgs' need the feature cache (default: 'sgd').",
+)
+parser.add_argument(
+    "--knn-bank-dtype",
+    type=str,
+    default="float16",
+    choices=KNN_BANK_DTYPES,
+    help="How the normalized train features of the KNN evaluation are stored: 'float16' or 'int8' "
+    "(default: 'float16').",
+)
+parser.add_argument(
+    "--knn-ks",
+    type=int,
+    nargs="+",
+    default=list(KNN_KS),
+    help="Numbers of neighbors of the KNN evaluation, all combinations with --knn-temperatures are evaluated "
+    f"from a single neighbor search (default: {' '.join(map(str, KNN_KS))}).",
+)
+parser.add_argument(
+    "--knn-temperatures",
+    type=float,
+    nargs="+",
+    default=list(KNN_TEMPERATURES),
+    help=f"Temperatures of the KNN evaluation (default: {' '.join(map(str, KNN_TEMPERATURES))}).",
+)
+parser.add_argument(
+    "--profile-every-n-steps",
+    type=int,
+    default=0,
+    help="If > 0, the throughput of the pretraining (samples/s, time of data loading, augmentation, forward, "
+    "backward and optimizer step, peak memory) is logged every n steps (default: 0).",
+)
+parser.add_argument(
+    "--profile-trace-steps",
+    type=int,
+    nargs=2,
+    default=None,
+    help="Global steps [start, end) of the pretraining to record a Chrome trace of, written to the log dir "
+    "(default: None).",
+)
 parser.add_argument(
     "--geobench-datasets",
     type=str,
@@ -240,6 +344,19 @@ def main(
     geobench_eval_method: str,
     ckpt_path: Union[Path, None],
     no_ffcv: bool,
+    storage: str = "float32",
+    num_shards: int = 1,
+    no_feature_cache: bool = False,
+    feature_flips: bool = False,
+    linear_lrs: Sequence[float] = LINEAR_LRS,
+    linear_weight_decays: Sequence[float] = LINEAR_WEIGHT_DECAYS,
+    linear_seeds: Sequence[int] = LINEAR_SEEDS,
+    linear_solver: str = "sgd",
+    knn_bank_dtype: str = "float16",
+    knn_ks: Sequence[int] = KNN_KS,
+    knn_temperatures: Sequence[float] = KNN_TEMPERATURES,
+    profile_every_n_steps: int = 0,
+    profile_trace_steps: Union[Sequence[int], None] = None,
     debug: bool = False,
 ) -> LightningModule:
     if data_dir is None:
@@ -313,6 +430,8 @@ def main(
             "devices": devices,
             "precision": precision,
             "no_ffcv": no_ffcv,
+            "storage": storage,
+            "num_shards": num_shards,
             "debug": debug,
         }
 
@@ -327,6 +446,8 @@ def main(
             pretrain_config = default_config.copy()
             pretrain_config["epochs"] = epochs
             pretrain_config["ckpt_path"] = ckpt_path
+            pretrain_config["profile_every_n_steps"] = profile_every_n_steps
+            pretrain_config["profile_trace_steps"] = profile_trace_steps
 
             print_rank_zero(f"Running pretraining for {method}...")
             pretrain(**pretrain_config)
@@ -365,6 +486,12 @@ def main(
                         devices=devices,
                         precision=precision,
                         no_ffcv=no_ffcv,
+                        feature_cache=not no_feature_cache,
+                        feature_flips=feature_flips,
+                        linear_lrs=linear_lrs,
+                        linear_weight_decays=linear_weight_decays,
+                        linear_seeds=linear_seeds,
+                        linear_solver=linear_solver,
                         debug=debug,
                     )
                 else:
@@ -382,24 +509,22 @@ def main(
         eval_config = default_config.copy()
         eval_config["num_classes"] = num_classes
 
-        # Perform linear evaluation if enabled
-        if enable_linear_eval and target is not None:
-            linear_eval(**eval_config)
-        else:
-            print_rank_zero("Skipping linear eval.")
-
-        # Perform fine-tuning evaluation if enabled
-        if enable_finetune_eval and target is not None:
-            finetune_eval(**eval_config)
-        else:
-            print_rank_zero("Skipping fine-tune eval.")
-
-        # Perform KNN evaluation if enabled
-        if enable_knn_eval and target is not None:
-            del eval_config["precision"]
-            knn_eval(**eval_config)
-        else:
-            print_rank_zero("Skipping KNN eval.")
+        # linear and KNN evaluation share the loaders and the features of the frozen model, fine-tuning runs last
+        offline_eval(
+            **eval_config,
+            enable_linear_eval=enable_linear_eval,
+            enable_knn_eval=enable_knn_eval,
+            enable_finetune_eval=enable_finetune_eval,
+            feature_cache=not no_feature_cache,
+            feature_flips=feature_flips,
+            linear_lrs=linear_lrs,
+            linear_weight_decays=linear_weight_decays,
+            linear_seeds=linear_seeds,
+            linear_solver=linear_solver,
+            knn_bank_dtype=knn_bank_dtype,
+            knn_ks=knn_ks,
+            knn_temperatures=knn_temperatures,
+        )
 
         return model
 
@@ -419,6 +544,10 @@ def pretrain(
     precision: str,
     ckpt_path: Union[Path, None],
     no_ffcv: bool,
+    storage: str = "float32",
+    num_shards: int = 1,
+    profile_every_n_steps: int = 0,
+    profile_trace_steps: Union[Sequence[int], None] = None,
     debug: bool = False,
 ) -> None:
     # Setup training data.
@@ -431,6 +560,8 @@ def pretrain(
         batch_size_per_device,
         ["train", "val"],
         no_ffcv,
+        storage=storage,
+        num_shards=num_shards,
     )
 
     # Train model.
@@ -438,17 +569,27 @@ def pretrain(
     wandb_config = model.hparams.copy()
     wandb_config["log_dir"] = str(log_dir)
     wandb_config["ckpt_path"] = ckpt_path
+    callbacks = [
+        LearningRateMonitor(),
+        # Stop if training loss diverges.
+        EarlyStopping(monitor="train_loss", patience=int(1e12), check_finite=True),
+        # ModelCheckpoint(monitor="val_top1", mode="max", auto_insert_metric_name=True),
+        metric_callback,
+    ]
+    if profile_every_n_steps > 0 or profile_trace_steps is not None:
+        # time per step of data loading, augmentation, forward, backward and optimizer step
+        callbacks.append(
+            ThroughputProfiler(
+                every_n_steps=profile_every_n_steps if profile_every_n_steps > 0 else 50,
+                trace_steps=profile_trace_steps,
+                trace_dir=log_dir,
+            )
+        )
     trainer = Trainer(
         max_epochs=epochs,
         accelerator=accelerator,
         devices=devices,
-        callbacks=[
-            LearningRateMonitor(),
-            # Stop if training loss diverges.
-            EarlyStopping(monitor="train_loss", patience=int(1e12), check_finite=True),
-            # ModelCheckpoint(monitor="val_top1", mode="max", auto_insert_metric_name=True),
-            metric_callback,
-        ],
+        callbacks=callbacks,
         logger=WandbLogger(
             save_dir=str(log_dir),
             name=f"pretrain",
@@ -463,6 +604,8 @@ def pretrain(
         num_sanity_val_steps=0,
         check_val_every_n_epoch=1,  # TODO
         fast_dev_run=debug,
+        # the no ffcv loaders split the samples between the DDP ranks themselves
+        use_distributed_sampler=not shards_by_rank(train_dataloader),
     )
 
     trainer.fit(
@@ -0,0 +1,202 @@
+import resource
+import time
+from pathlib import Path
+from typing import Sequence, Union
+
+import numpy as np
+import torch
+from lightly.utils.dist import print_rank_zero
+from pytorch_lightning import Callback, LightningModule, Trainer
+from torch import nn
+
+# phases of a training step, in the order they happen
+PROFILER_PHASES = ("data", "augmentation", "forward", "backward", "optimizer")
+PROFILER_PERCENTILES = (50, 90, 99)
+# modules the views are created with in training_step, timed as augmentation
+TRANSFORM_ATTRIBUTES = ("train_transform", "additional_transform")
+
+
+class ThroughputProfiler(Callback):
+    """Times the phases of every training step and logs the throughput every `every_n_steps` steps.
+
+    The phases of a step are:
+        - data: waiting for the batch (loader, copy to the device)
+        - augmentation: the view creation of the module (see TRANSFORM_ATTRIBUTES)
+        - forward: the rest of training_step, including the loss and the logging
+        - backward
+        - optimizer: optimizer step, zero grad and lr scheduler
+
+    Logged are samples/s, the mean time and share of every phase, percentiles of the step and data time and the
+    peak memory, all prefixed with "profiler/". The first `skip_steps` global steps (warmup, compilation) are not
+    timed. With `synchronize`, the GPU is synchronized at every phase boundary
+    so that the timings are exact, which slows down training slightly. With `trace_steps` (start, end), a Chrome
+    trace of these global steps is written to `trace_dir`.
+    """
+
+    def __init__(
+        self,
+        every_n_steps: int = 50,
+        trace_steps: Union[Sequence[int], None] = None,
+        trace_dir: Union[Path, None] = None,
+        synchronize: bool = True,
+        skip_steps: int = 0,
+    ):
+        super().__init__()
+        assert every_n_steps > 0, "every_n_steps has to be positive"
+        assert trace_steps is None or (
+            len(trace_steps) == 2 and 0 <= trace_steps[0] < trace_steps[1]
+        ), f"trace_steps {trace_steps} is not a (start, end) step window"
+        self.every_n_steps = every_n_steps
+        self.trace_steps = trace_steps
+        self.trace_dir = Path(trace_dir or ".")
+        self.synchronize = synchronize
+        self.skip_steps = skip_steps
+        # all logged metrics, one dict per report
+        self.reports = []
+
+        self._cuda = False
+        self._hooks = []
+        self._window = []
+        self._step = None
+        self._last = None
+        self._time = None
+        self._augmentation_start = None
+        self._trace = None
+
+    def _now(self) -> float:
+        if self._cuda and self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _augmentation_pre_hook(self, module: nn.Module, args):
+        if self._step is not None:
+            self._augmentation_start = self._now()
+
+    def _augmentation_hook(self, module: nn.Module, args, output):
+        if self._step is not None and self._augmentation_start is not None:
+            self._step["augmentation"] += self._now() - self._augmentation_start
+            self._augmentation_start = None
+
+    def on_fit_start(self, trainer: Trainer, pl_module: LightningModule):
+        self._cuda = pl_module.device.type == "cuda"
+        for name in TRANSFORM_ATTRIBUTES:
+            transform = getattr(pl_module, name, None)
+            if isinstance(transform, nn.Module):
+                self._hooks.append(transform.register_forward_pre_hook(self._augmentation_pre_hook))
+                self._hooks.append(transform.register_forward_hook(self._augmentation_hook))
+
+    def on_fit_end(self, trainer: Trainer, pl_module: LightningModule):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        if self._trace is not None:
+            self._stop_trace(trainer)
+
+    def on_train_epoch_start(self, trainer: Trainer, pl_module: LightningModule):
+        self._last = self._now()
+
+    def on_train_batch_start(
+        self, trainer: Trainer, pl_module: LightningModule, batch, batch_idx: int
+    ):
+        if (
+            self.trace_steps is not None
+            and self._trace is None
+            and trainer.global_step == self.trace_steps[0]
+        ):
+            self._start_trace()
+        if trainer.global_step < self.skip_steps:
+            return
+
+        self._time = self._now()
+        self._step = {phase: 0.0 for phase in PROFILER_PHASES}
+        self._step["data"] = self._time - self._last
+        self._step["batch_size"] = len(batch[0])
+
+    def on_before_backward(self, trainer: Trainer, pl_module: LightningModule, loss):
+        if self._step is None:
+            return
+        now = self._now()
+        self._step["forward"] += now - self._time - self._step["augmentation"]
+        self._time = now
+
+    def on_after_backward(self, trainer: Trainer, pl_module: LightningModule):
+        if self._step is None:
+            return
+        now = self._now()
+        self._step["backward"] += now - self._time
+        self._time = now
+
+    def on_train_batch_end(
+        self, trainer: Trainer, pl_module: LightningModule, outputs, batch, batch_idx: int
+    ):
+        # the trace can start before skip_steps, where the steps are not timed
+        if self._trace is not None and trainer.global_step >= self.trace_steps[1]:
+            self._stop_trace(trainer)
+        if self._step is None:
+            self._last = self._now()
+            return
+        now = self._now()
+        self._step["optimizer"] += now - self._time
+        self._window.append(self._step)
+        self._step = None
+        self._last = now
+
+        if len(self._window) >= self.every_n_steps:
+            self._report(trainer)
+        # the time of the callbacks (e.g., logging the report) is not counted as data time
+        self._last = self._now()
+
+    def _report(self, trainer: Trainer):
+        times = np.array([[step[phase] for phase in PROFILER_PHASES] for step in self._window])
+        step_times = times.sum(axis=1)
+        num_samples = sum(step["batch_size"] for step in self._window)
+        self._window = []
+
+        samples_per_s = num_samples / max(step_times.sum(), 1e-9)
+        metrics = {
+            "profiler/samples_per_s": samples_per_s,
+            # every device processes its own batches
+            "profiler/global_samples_per_s": samples_per_s * trainer.world_size,
+        }
+        for phase, phase_times in zip(PROFILER_PHASES, times.T):
+            metrics[f"profiler/{phase}_ms"] = phase_times.mean() * 1000
+            metrics[f"profiler/{phase}_fraction"] = phase_times.sum() / max(step_times.sum(), 1e-9)
+        for q in PROFILER_PERCENTILES:
+            metrics[f"profiler/step_p{q}_ms"] = np.percentile(step_times, q) * 1000
+            metrics[f"profiler/data_p{q}_ms"] = np.percentile(times[:, 0], q) * 1000
+        if self._cuda:
+            metrics["profiler/peak_memory_gb"] = torch.cuda.max_memory_allocated() / 1024**3
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            # peak resident memory of the process since it started, in KiB on linux
+            metrics["profiler/peak_memory_gb"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+            )
+        metrics = {name: float(value) for name, value in metrics.items()}
+        self.reports.append(metrics)
+
+        if trainer.logger is not None:
+            trainer.logger.log_metrics(metrics, step=trainer.global_step)
+        print_rank_zero(
+            f"step {trainer.global_step}: {samples_per_s:.1f} samples/s, "
+            + ", ".join(
+                f"{phase} {metrics[f'profiler/{phase}_fraction']:.0%}" for phase in PROFILER_PHASES
+            )
+            + f", peak memory {metrics['profiler/peak_memory_gb']:.2f} GB"
+        )
+
+    def _start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self._cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._trace = torch.profiler.profile(activities=activities)
+        self._trace.__enter__()
+
+    def _stop_trace(self, trainer: Trainer):
+        self._trace.__exit__(None, None, None)
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+        start, end = self.trace_steps
+        trace_file = self.trace_dir / f"trace_steps_{start}-{end}_rank{trainer.global_rank}.json"
+        self._trace.export_chrome_trace(str(trace_file))
+        self._trace = None
+        print_rank_zero(f"Wrote Chrome trace of steps {start} to {end} to {trace_file}.")
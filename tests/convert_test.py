@@ -1,9 +1,39 @@
+import copy
+import json
 import shutil
+from argparse import Namespace
 from pathlib import Path
 
+import numpy as np
+import pytest
+import torch
+
 from data import constants
+from data import get_mmearth_dataloaders
+from data.beton_cache import (
+    atomic_beton,
+    beton_lock,
+    get_beton_file,
+    get_manifest_file,
+    read_manifest,
+    validate_beton,
+)
 from data.constants import MMEARTH_DIR
-from data.mmearth_dataset import MMEarthDataset, create_MMEearth_args, convert_mmearth_to_beton
+from data.sharding import (
+    ShardedLoader,
+    get_progress_file,
+    get_shard_files,
+    run_shard_jobs,
+    shard_indices,
+)
+from data.mmearth_dataset import (
+    MMEarthDataset,
+    convert_mmearth_to_beton,
+    create_MMEearth_args,
+    quantization_metadata,
+)
+from data.storage import Dequantize, DequantizingLoader
+from data.synthetic import write_synthetic_mmearth
 
 
 def test_mmearth_dataset():
@@ -26,3 +56,218 @@ def test_mmearth_dataset():
     finally:
         # cleanup
         shutil.rmtree(test_out, ignore_errors=True)
+
+
+def test_atomic_beton(tmp_path):
+    beton_file = tmp_path / "split_0123456789abcdef.beton"
+
+    # an interrupted conversion leaves neither the beton file nor a temporary file behind
+    with pytest.raises(RuntimeError):
+        with atomic_beton(beton_file) as tmp_file:
+            tmp_file.write_bytes(b"partial")
+            raise RuntimeError
+    assert not beton_file.exists()
+    assert list(tmp_path.glob("*.tmp")) == []
+
+    # partial files of killed processes are removed once the lock is acquired
+    (tmp_path / f"{beton_file.name}.1234.tmp").write_bytes(b"partial")
+    with beton_lock(beton_file):
+        assert list(tmp_path.glob("*.tmp")) == []
+        with atomic_beton(beton_file) as tmp_file:
+            tmp_file.write_bytes(b"complete")
+    assert beton_file.read_bytes() == b"complete"
+
+
+def test_beton_manifest(tmp_path):
+    data_dir = tmp_path / "synthetic"
+    write_synthetic_mmearth(data_dir, 40, image_size=8, modalities=["sentinel2", "biome"])
+    processed_dir = tmp_path / "processed"
+
+    def get_loader():
+        return get_mmearth_dataloaders(
+            data_dir,
+            processed_dir,
+            constants.RGB_MODALITIES,
+            {"biome": constants.MODALITIES_FULL["biome"]},
+            0,
+            4,
+            ["train"],
+            indices=[list(range(10))],
+        )
+
+    get_loader()
+    (beton_file,) = processed_dir.glob("*.beton")
+    manifest = read_manifest(beton_file)
+    assert manifest["num_samples"] == 10
+    # the fields have the size of the stored images
+    assert manifest["fields"]["sentinel2"]["shape"] == [3, 8, 8]
+    key_parts, sources = manifest["key_parts"], [Path(s) for s in manifest["sources"]]
+    # the file name is the readable name followed by the hash of the key, without the targets it holds
+    name_key_parts = {k: v for k, v in key_parts.items() if k != "targets"}
+    assert get_beton_file(processed_dir, "train_sentinel2", name_key_parts) == beton_file
+    assert validate_beton(beton_file, key_parts, sources, ["sentinel2", "biome"])
+    assert not validate_beton(beton_file, {**key_parts, "storage": "int16"}, sources, ["sentinel2"])
+    assert not validate_beton(beton_file, key_parts, sources, ["sentinel2", "eco_region"])
+
+    # a valid file is reused, a file with a stale manifest is converted again
+    modified = beton_file.stat().st_mtime_ns
+    get_loader()
+    assert beton_file.stat().st_mtime_ns == modified
+    with open(get_manifest_file(beton_file), "w") as f:
+        json.dump({**manifest, "checksum": "stale"}, f)
+    assert not validate_beton(beton_file, key_parts, sources, ["sentinel2"])
+    get_loader()
+    assert read_manifest(beton_file)["checksum"] == manifest["checksum"]
+    assert validate_beton(beton_file, key_parts, sources, ["sentinel2", "biome"])
+
+
+def test_int16_storage(tmp_path):
+    data_dir = tmp_path / "synthetic"
+    write_synthetic_mmearth(data_dir, 40, image_size=8, modalities=["sentinel2", "biome"])
+    args = create_MMEearth_args(data_dir, constants.INP_MODALITIES, None)
+    idxs = list(range(16))
+    expected = MMEarthDataset(args, split="train").__getitems__(idxs)["sentinel2"]
+    dataset = MMEarthDataset(args, split="train", sentinel2_storage="int16")
+    batch = dataset.__getitems__(idxs)
+    assert batch["sentinel2"].dtype == np.int16
+
+    # dequantizing the raw reflectances is exact up to the quantization step (the scale of each band)
+    metadata = quantization_metadata(dataset)
+    dequantized = Dequantize.from_metadata(metadata)(
+        torch.from_numpy(batch["sentinel2"]), torch.from_numpy(batch["sentinel2_l2a"])
+    ).numpy()
+    assert np.array_equal(np.isnan(dequantized), np.isnan(expected))
+    step = np.asarray(metadata["scale"])[batch["sentinel2_l2a"].astype(int)][..., None, None]
+    assert np.all(np.nan_to_num(np.abs(dequantized - expected)) <= step / 2)
+
+    # the converted beton file keeps the metadata in its manifest
+    get_mmearth_dataloaders(
+        data_dir,
+        tmp_path / "processed",
+        constants.INP_MODALITIES,
+        None,
+        0,
+        4,
+        ["train"],
+        indices=[idxs],
+        storage="int16",
+    )
+    (beton_file,) = (tmp_path / "processed").glob("*.beton")
+    manifest = read_manifest(beton_file)
+    assert manifest["fields"]["sentinel2"] == {
+        "type": "NDArrayField",
+        "dtype": "int16",
+        "shape": [expected.shape[1], 8, 8],
+    }
+    manifest_metadata = manifest["metadata"]
+    for key in ["scale", "offset", "nodata", "unsigned"]:
+        assert np.allclose(manifest_metadata[key], metadata[key], equal_nan=True)
+
+
+def test_dequantizing_loader():
+    metadata = {"scale": [[1.0], [2.0]], "offset": [[0.0], [0.0]], "nodata": -1.0, "unsigned": False}
+    batches = [(torch.ones(2, 1, 2, 2, dtype=torch.int16), torch.arange(2), torch.tensor([0, 1]))]
+    loader = DequantizingLoader(batches, Dequantize.from_metadata(metadata))
+    (images, targets), = list(loader)
+    assert images[:, 0, 0, 0].tolist() == [1.0, 2.0]
+    assert targets.tolist() == [0, 1]
+    # attributes are taken from the wrapped loader, copies are created without __init__
+    assert copy.copy(loader).count == batches.count
+    assert not hasattr(DequantizingLoader.__new__(DequantizingLoader), "reader")
+
+
+def _write_indices(beton_file: Path, indices: list[int]) -> int:
+    # stands in for the beton conversion of a shard
+    with open(beton_file, "w") as f:
+        json.dump(indices, f)
+    return len(indices)
+
+
+class _IndexLoader:
+    def __init__(self, file: Path, batch_size: int):
+        with open(file, "r") as f:
+            self.indices = json.load(f)
+        self.batch_size = batch_size
+        self.reader = Namespace(num_samples=len(self.indices))
+
+    def __len__(self):
+        return -(-len(self.indices) // self.batch_size)
+
+    def __iter__(self):
+        for start in range(0, len(self.indices), self.batch_size):
+            yield self.indices[start : start + self.batch_size]
+
+
+def test_sharded_conversion(tmp_path):
+    indices = list(range(3, 103, 2))
+    beton_files = get_shard_files(tmp_path / "train_0123456789abcdef.beton", 4)
+    jobs = [
+        dict(beton_file=file, indices=shard)
+        for file, shard in zip(beton_files, shard_indices(indices, 4))
+    ]
+    progress_file = get_progress_file(beton_files[0])
+    run_shard_jobs(_write_indices, jobs, 2, progress_file)
+    with open(progress_file, "r") as f:
+        completed = json.load(f)["completed"]
+    assert sorted(completed) == [file.name for file in beton_files]
+
+    # the shards hold every sample exactly once, in the original order
+    loader = ShardedLoader([_IndexLoader(file, 8) for file in beton_files], shuffle=False)
+    assert loader.num_samples == len(indices)
+    assert sum(loader, []) == indices
+    shuffled = ShardedLoader([_IndexLoader(file, 8) for file in beton_files], shuffle=True)
+    assert len(list(shuffled)) == len(loader)
+    assert sorted(sum(shuffled, [])) == indices
+
+
+def test_sequential_start_sample(tmp_path):
+    data_dir = tmp_path / "synthetic"
+    write_synthetic_mmearth(data_dir, 40, image_size=8, modalities=["sentinel2"])
+
+    def get_loader(start_sample: int):
+        (loader,) = get_mmearth_dataloaders(
+            data_dir,
+            tmp_path / "processed",
+            constants.RGB_MODALITIES,
+            None,
+            0,
+            4,
+            ["train"],
+            indices=[list(range(10))],
+            num_shards=3,
+            sequential=True,
+            start_sample=start_sample,
+        )
+        return loader
+
+    # shards of 4, 3 and 3 samples, the first one is skipped and the second one starts at its second sample
+    loader = get_loader(5)
+    assert loader.num_samples == 5
+    assert [len(shard_loader.indices) for shard_loader in loader.loaders] == [2, 3]
+    assert loader.loaders[0].indices.tolist() == [1, 2]
+    assert get_loader(0).num_samples == 10
+    # a split without samples after start_sample has no loader
+    assert get_loader(10) is None
+
+
+def test_sharded_loader_workers(tmp_path):
+    data_dir = tmp_path / "synthetic"
+    write_synthetic_mmearth(data_dir, 40, image_size=8, modalities=["sentinel2"])
+
+    def get_loader(sequential: bool):
+        (loader,) = get_mmearth_dataloaders(
+            data_dir,
+            tmp_path / "processed",
+            constants.RGB_MODALITIES,
+            None,
+            6,
+            4,
+            ["train"],
+            num_shards=3,
+            sequential=sequential,
+        )
+        return loader
+
+    # the shuffled shards are loaded at the same time and share the workers
+    assert [loader.num_workers for loader in get_loader(False).loaders] == [2, 2, 2]
+    assert [loader.num_workers for loader in get_loader(True).loaders] == [6, 6, 6]
@@ -1,12 +1,28 @@
+import json
+import os
+import pickle
 import shutil
+import stat
 from pathlib import Path
+from types import SimpleNamespace
 
 import numpy as np
 import pytest
+from torch.utils.data import DataLoader
 
 from data import GeobenchDataset, get_mmearth_dataloaders
 from data import MMEarthDataset, create_MMEearth_args
-from data import constants, get_geobench_dataloaders
+from data import constants, geobench_dataset, geobench_index, get_geobench_dataloaders
+from data.geobench_dataset import BAND_NAMES, partition_positions
+from data.geobench_index import get_task_info
+from data.label_remap import build_label_lut, remap_labels
+from data.samplers import (
+    ChunkShuffleSampler,
+    DistributedSequentialSampler,
+    SortedBatchSampler,
+    shards_by_rank,
+)
+from data.synthetic import SYNTHETIC_MODALITIES, write_synthetic_mmearth
 
 
 @pytest.mark.parametrize("split", ["train", "val", "test"])
@@ -51,6 +67,113 @@ def test_mmearth_dataset(split, modalities, target_modalities):
     # no tests for val/test currently
 
 
+@pytest.mark.parametrize(
+    "modalities",
+    [constants.INP_MODALITIES, constants.RGB_MODALITIES],
+)
+def test_mmearth_dataset_getitems(modalities):
+    target_modalities = {"biome": constants.MODALITIES_FULL["biome"]}
+    args = create_MMEearth_args(constants.MMEARTH_DIR, modalities, target_modalities)
+
+    dataset = MMEarthDataset(args, split="train", transform=None)
+
+    idxs = [7, 2, 3, 2, 0]
+    batch = dataset.__getitems__(idxs)
+    for i, idx in enumerate(idxs):
+        data = dataset[idx]
+        assert batch["id"][i] == data["id"]
+        for modality in ["sentinel2", "biome"]:
+            assert batch[modality].dtype == data[modality].dtype
+            np.testing.assert_allclose(batch[modality][i], data[modality], rtol=1e-6)
+
+
+def test_remap_labels():
+    lut = build_label_lut(constants.SEGMENTATION_CLASS_REMAP["esa_worldcover"])
+    ignore = constants.SEGMENTATION_IGNORE_INDEX
+
+    # a batch of two maps, nodata (255) and unknown values (0) are ignored
+    data = np.array([[[10, 20], [100, 255]], [[95, 0], [30, 10]]], dtype=np.uint8)
+    expected = np.array([[[0, 1], [10, ignore]], [[9, ignore], [2, 0]]])
+    np.testing.assert_array_equal(remap_labels(data, lut), expected)
+    np.testing.assert_array_equal(remap_labels(data[0].astype(np.int32), lut), expected[0])
+
+
+def test_chunk_shuffle_sampler():
+    rows = np.arange(100, 164)
+    sampler = ChunkShuffleSampler(rows, chunk_rows=4, window=2, seed=1)
+    sampler.set_epoch(3)
+    order = list(sampler)
+    assert sorted(order) == list(range(64))
+    # every window of 2 chunks (8 samples) is shuffled on its own
+    for start in range(0, 64, 8):
+        assert len(set(rows[order[start : start + 8]] // 4)) == 2
+
+    sampler.set_epoch(3)
+    assert list(sampler) == order
+    sampler.set_epoch(4)
+    assert list(sampler) != order
+
+    # the ranks get equally long, disjoint parts of the same order
+    shards = []
+    for rank in range(3):
+        rank_sampler = ChunkShuffleSampler(rows, chunk_rows=4, window=2, seed=1, num_replicas=3, rank=rank)
+        rank_sampler.set_epoch(3)
+        shards.append(list(rank_sampler))
+        assert len(shards[-1]) == len(rank_sampler) == 22
+    assert sum(shards, []) == (order + order)[:66]
+    # without a process group, the rank has to be given
+    with pytest.raises(AssertionError, match="rank"):
+        list(ChunkShuffleSampler(rows, chunk_rows=4, num_replicas=3))
+
+
+def test_distributed_sequential_sampler():
+    assert list(DistributedSequentialSampler(5)) == list(range(5))
+    shards = [list(DistributedSequentialSampler(5, num_replicas=2, rank=rank)) for rank in range(2)]
+    assert shards == [[0, 1, 2], [3, 4, 0]]
+    assert list(DistributedSequentialSampler(0)) == []
+
+    # Lightning keeps the samplers that split the samples themselves
+    dataset = list(range(5))
+    loader = DataLoader(dataset, batch_sampler=SortedBatchSampler(DistributedSequentialSampler(5), 2, False))
+    assert shards_by_rank(loader)
+    assert shards_by_rank(DataLoader(dataset, sampler=ChunkShuffleSampler(dataset, chunk_rows=2)))
+    assert not shards_by_rank(DataLoader(dataset, shuffle=True))
+    assert not shards_by_rank([])
+
+
+def test_tile_index_read_only_data(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "TILE_INDEX_DIR", tmp_path / "tile_index")
+    data_dir = tmp_path / "synthetic"
+    write_synthetic_mmearth(data_dir, 50, image_size=8, modalities=["sentinel2", "biome"])
+    files = sorted(data_dir.iterdir())
+    os.chmod(data_dir, stat.S_IRUSR | stat.S_IXUSR)
+    try:
+        args = create_MMEearth_args(data_dir, constants.RGB_MODALITIES, None)
+        dataset = MMEarthDataset(args, split="train")
+        assert len(dataset) == 40
+        assert dataset[0]["id"] == args.tile_index.names(args.tile_index.split("train")[:1])[0]
+    finally:
+        os.chmod(data_dir, stat.S_IRWXU)
+    # the index (and its lock) is kept in the cache folder, nothing is written to the data folder
+    assert sorted(data_dir.iterdir()) == files
+    assert args.tile_index.path.parent == tmp_path / "tile_index"
+
+
+def test_mmearth_dataset_pickle():
+    target_modalities = {"biome": constants.MODALITIES_FULL["biome"]}
+    args = create_MMEearth_args(
+        constants.MMEARTH_DIR, constants.RGB_MODALITIES, target_modalities
+    )
+    dataset = MMEarthDataset(args, split="train", transform=None)
+
+    # DataLoader workers receive the dataset pickled, the tile index is mapped again instead of copied
+    copied = pickle.loads(pickle.dumps(dataset))
+    assert copied.tile_index._arrays == {}
+    data, copied_data = dataset[3], copied[3]
+    assert data["id"] == copied_data["id"]
+    np.testing.assert_array_equal(data["sentinel2"], copied_data["sentinel2"])
+
+
 @pytest.mark.parametrize(
     "modalities",
     [constants.INP_MODALITIES, constants.RGB_MODALITIES],
@@ -60,6 +183,10 @@ def test_mmearth_dataset(split, modalities, target_modalities):
     [
         {"biome": constants.MODALITIES_FULL["biome"]},
         {"eco_region": constants.MODALITIES_FULL["eco_region"]},
+        {
+            "biome": constants.MODALITIES_FULL["biome"],
+            "era5": constants.MODALITIES_FULL["era5"],
+        },
     ],
 )
 @pytest.mark.parametrize(
@@ -90,6 +217,32 @@ def test_mmearth_dataloader(modalities, target_modalities, no_ffcv):
         shutil.rmtree(test_out, ignore_errors=True)
 
 
+def test_mmearth_dataloader_shared_targets():
+    test_out = Path("test_out")
+    test_out.mkdir(exist_ok=True)
+
+    try:
+        for target in ["biome", "eco_region", "biome"]:
+            (loader,) = get_mmearth_dataloaders(
+                constants.MMEARTH_DIR,
+                test_out,
+                constants.RGB_MODALITIES,
+                {target: constants.MODALITIES_FULL[target]},
+                2,
+                2,
+                ["train"],
+                indices=[list(range(10))],
+            )
+            # only the requested target is decoded
+            assert len(next(iter(loader))) == 2
+
+        # all targets are kept in a single beton file
+        assert len(list(test_out.glob("*.beton"))) == 1
+    finally:
+        # cleanup
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
 @pytest.mark.parametrize("split", ["train", "val", "test"])
 @pytest.mark.parametrize(
     "dataset_name",
@@ -157,4 +310,150 @@ def test_geobench_dataloader(dataset_name, no_ffcv):
                 break
     finally:
         # cleanup
-        shutil.rmtree(test_out, ignore_errors=True)
\ No newline at end of file
+        shutil.rmtree(test_out, ignore_errors=True)
+
+
+class _StubGeobenchSplit:
+    """Samples of a geobench split, counting how often they are loaded."""
+
+    def __init__(self, num_samples: int, band_names: list[str]):
+        rng = np.random.default_rng(0)
+        self.samples = [
+            SimpleNamespace(
+                bands=[SimpleNamespace(data=rng.random((4, 4), dtype=np.float32)) for _ in band_names],
+                label=i % 3,
+            )
+            for i in range(num_samples)
+        ]
+        self.loads = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        self.loads += 1
+        return self.samples[idx]
+
+    def normalization_stats(self):
+        return [0.5] * len(self.samples[0].bands), [0.25] * len(self.samples[0].bands)
+
+
+class _StubGeobenchTask:
+    """Task specs of a 3 class m-eurosat with 4x4 samples, the bands are in reversed order."""
+
+    dataset_name = "m-eurosat"
+    benchmark_name = "classification_v1.0"
+    patch_size = (4, 4)
+
+    def __init__(self, dataset_dir: Path, num_samples: int = 6):
+        self.dataset_dir = dataset_dir
+        self.bands_info = [SimpleNamespace(name=name) for name in reversed(BAND_NAMES["m-eurosat"])]
+        self.label_type = SimpleNamespace(class_names=["a", "b", "c"], n_classes=3)
+        self.split = _StubGeobenchSplit(num_samples, BAND_NAMES["m-eurosat"])
+
+    def get_dataset_dir(self) -> Path:
+        return self.dataset_dir
+
+    def get_dataset(self, split: str, band_names: list[str], partition_name: str):
+        return self.split
+
+
+def test_geobench_sample_cache(tmp_path, monkeypatch):
+    task = _StubGeobenchTask(tmp_path)
+    task_info = {"band_names": BAND_NAMES["m-eurosat"][::-1], "band_indices": list(range(11, -1, -1))}
+    monkeypatch.setattr(GeobenchDataset, "get_task", staticmethod(lambda name: (task, "classification")))
+    monkeypatch.setattr(geobench_dataset, "get_task_info", lambda *args: task_info)
+
+    sample_bytes = 12 * 4 * 4 * 4 + 8
+    dataset = GeobenchDataset("m-eurosat", cache_bytes=2 * sample_bytes)
+    x, label = dataset[0]
+    # the bands are normalized and selected in the order of BAND_NAMES
+    np.testing.assert_allclose(x[0], (task.split.samples[0].bands[11].data - 0.5) / 0.25)
+    assert label == 0
+
+    # hits are served from the cache, the least recently used sample is dropped
+    dataset[0]
+    assert task.split.loads == 1
+    dataset[1], dataset[2]
+    assert task.split.loads == 3
+    dataset[2], dataset[0]
+    assert task.split.loads == 4
+    assert list(dataset._cache) == [2, 0]
+
+    uncached = GeobenchDataset("m-eurosat")
+    uncached[0], uncached[0]
+    assert task.split.loads == 6
+
+
+def test_geobench_partition_positions(tmp_path):
+    default = {"train": ["a", "b", "c", "d"], "valid": ["e", "f"], "test": ["g"]}
+    partition = {"train": ["d", "b"], "valid": ["f"], "test": ["g"]}
+    for name, content in [("default", default), ("0.5x_train", partition), ("broken", {"train": ["x"]})]:
+        with open(tmp_path / f"{name}_partition.json", "w") as f:
+            json.dump(content, f)
+
+    # the beton file of the default partition is loaded with these indices
+    assert partition_positions(tmp_path, "0.5x_train", "train") == [3, 1]
+    assert partition_positions(tmp_path, "0.5x_train", "val") == [1]
+    assert partition_positions(tmp_path, "default", "train") == [0, 1, 2, 3]
+    with pytest.raises(AssertionError):
+        partition_positions(tmp_path, "broken", "train")
+
+
+def test_geobench_index(tmp_path, monkeypatch):
+    dataset_dir = tmp_path / "m-eurosat"
+    dataset_dir.mkdir()
+    (dataset_dir / "task_specs.pkl").touch()
+    with open(dataset_dir / "default_partition.json", "w") as f:
+        json.dump({"train": ["a", "b", "c"], "valid": ["d"], "test": ["e", "f"]}, f)
+
+    index_file = tmp_path / "index" / "geobench_index.json"
+    calls = []
+
+    def find_task(dataset_name, benchmark_name):
+        calls.append(dataset_name)
+        return _StubGeobenchTask(dataset_dir)
+
+    monkeypatch.setattr(geobench_index, "GEOBENCH_INDEX_FILE", index_file)
+    monkeypatch.setattr(geobench_index, "find_task", find_task)
+
+    band_names = BAND_NAMES["m-eurosat"]
+    entry = get_task_info("m-eurosat", "classification", band_names)
+    assert calls == ["m-eurosat"]
+    assert entry["dataset_dir"] == str(dataset_dir)
+    assert entry["band_indices"] == list(range(len(band_names) - 1, -1, -1))
+    assert entry["n_classes"] == 3
+    assert entry["num_samples"] == {"default": {"train": 3, "valid": 1, "test": 2}}
+    with open(index_file, "r") as f:
+        assert json.load(f)["m-eurosat"] == entry
+
+    # found in the index without walking over the benchmark
+    assert get_task_info("m-eurosat", "classification", band_names) == entry
+    assert calls == ["m-eurosat"]
+
+    # a new partition file invalidates the entry
+    with open(dataset_dir / "0.5x_train_partition.json", "w") as f:
+        json.dump({"train": ["a"], "valid": ["d"], "test": ["e", "f"]}, f)
+    entry = get_task_info("m-eurosat", "classification", band_names)
+    assert calls == ["m-eurosat", "m-eurosat"]
+    assert entry["num_samples"]["0.5x_train"] == {"train": 1, "valid": 1, "test": 2}
+
+
+@pytest.mark.parametrize("chunk_rows", [None, 8])
+def test_synthetic_mmearth(tmp_path, chunk_rows):
+    assert set(SYNTHETIC_MODALITIES) == set(constants.MODALITIES_FULL)
+    write_synthetic_mmearth(tmp_path, 100, image_size=16, chunk_rows=chunk_rows, block_size=32)
+
+    args = create_MMEearth_args(tmp_path, constants.OUT_MODALITIES, None)
+    assert len(args.tile_index.split("train")) == 80
+    assert 0 < args.tile_index.l2a.sum() < 100
+
+    dataset = MMEarthDataset(args, split="train")
+    batch = dataset.__getitems__(list(range(len(dataset))))
+    assert batch["sentinel2"].shape == (80, 12, 16, 16)
+    assert batch["sentinel1"].shape == (80, 8, 16, 16)
+    assert batch["biome"].max() < constants.CLASSIFICATION_CLASSES["biome"]
+    # nodata values are converted to nan or the ignore index
+    assert np.isnan(batch["sentinel1"]).any()
+    assert (batch["esa_worldcover"] == constants.SEGMENTATION_IGNORE_INDEX).any()
+    assert abs(np.nanmean(batch["sentinel2"])) < 0.5
@@ -1,13 +1,26 @@
+import json
 import shutil
 from argparse import Namespace
 from pathlib import Path
 
+import numpy as np
 import pytest
 import torch.cuda
+from pytorch_lightning import LightningModule, Trainer
+from torch import nn
+from torch.utils.data import DataLoader, Subset, TensorDataset
 
+from benchmarks.train_step import run as run_train_step
 from data import constants
-from eval import geobench_clf_eval
+from data.beton_cache import CONVERTER_VERSION
+from eval import geobench_clf_eval, knn_bank
+from eval.feature_cache import FeatureDataset, get_feature_dataloaders
+from eval.helper_modules import MultiHeadLinearClassifier
+from eval.knn_bank import knn_evaluate, knn_search, load_knn_bank
+from eval.linear_solvers import fit_linear_probe
+from export_embeddings import export_embeddings
 from main import main, METHODS
+from methods.profiler import PROFILER_PHASES, ThroughputProfiler
 
 
 @pytest.fixture
@@ -113,3 +126,238 @@ def test_methods(args, methods: str, target, last_backbone_channel):
         shutil.rmtree(args.log_dir, ignore_errors=True)
 
 
+def test_feature_cache(tmp_path):
+    model = nn.Sequential(nn.Conv2d(2, 3, 1), nn.AdaptiveAvgPool2d(1))
+    images, labels = torch.randn(8, 2, 4, 4), torch.arange(8)
+    dataloaders = [
+        # the last batch of the train loader is dropped
+        DataLoader(TensorDataset(images, labels), batch_size=3, drop_last=True),
+        DataLoader(TensorDataset(images, labels), batch_size=3),
+    ]
+
+    def get_loaders(train_flips: bool = True):
+        return get_feature_dataloaders(
+            model,
+            dataloaders,
+            ["train", "val"],
+            cache_dir=tmp_path,
+            name="test",
+            key_parts={},
+            batch_size_per_device=8,
+            num_workers=0,
+            device=torch.device("cpu"),
+            train_flips=train_flips,
+        )
+
+    train_loader, val_loader = get_loaders()
+    features, targets = next(iter(val_loader))
+    assert torch.equal(targets, labels)
+    assert torch.allclose(features, model(images).flatten(start_dim=1), atol=1e-6)
+    # the train features are a random flip of each image, the files are allocated for all 8 samples
+    assert len(train_loader.dataset) == 6
+    assert np.load(sorted(tmp_path.glob("train_*_features.npy"))[0]).shape == (4, 8, 3)
+    flipped = [model(images.flip(dims)).flatten(start_dim=1) for dims in [(), (-1,), (-2,), (-2, -1)]]
+    features, targets = next(iter(DataLoader(train_loader.dataset, batch_size=6)))
+    assert sorted(targets.tolist()) == list(range(6))
+    for feature, target in zip(features, targets):
+        assert any(torch.allclose(feature, f[target], atol=1e-6) for f in flipped)
+
+    # cached features are reused until the model or the converter version changes
+    (manifest_file,) = tmp_path.glob("train_*.json")
+    with open(manifest_file, "r") as f:
+        assert json.load(f)["key_parts"]["converter_version"] == CONVERTER_VERSION
+    files = sorted(tmp_path.glob("*.npy"))
+    assert len(files) == 4
+    get_loaders()
+    assert sorted(tmp_path.glob("*.npy")) == files
+    with torch.no_grad():
+        model[0].bias += 1
+    get_loaders()
+    assert len(list(tmp_path.glob("*.npy"))) == 8
+
+    # by default, the train features are extracted without flips
+    train_loader, _ = get_loaders(train_flips=False)
+    assert train_loader.dataset.features.shape == (1, 6, 3)
+    assert len(list(tmp_path.glob("*.npy"))) == 10
+
+
+@pytest.mark.parametrize("multi_label", [False, True])
+def test_multi_head_linear_classifier(multi_label: bool):
+    features = torch.randn(256, 8)
+    logits = features @ torch.randn(8, 3)
+    targets = (logits > 0).long() if multi_label else logits.argmax(dim=1)
+    dataloader = DataLoader(TensorDataset(features, targets), batch_size=32)
+
+    classifier = MultiHeadLinearClassifier(
+        nn.Identity(),
+        batch_size_per_device=32,
+        feature_dim=8,
+        num_classes=3,
+        lrs=(0.0, 1.0),
+        seeds=(0, 1),
+        multi_label=multi_label,
+    )
+    trainer = Trainer(max_epochs=2, accelerator="cpu", logger=False, enable_checkpointing=False)
+    trainer.fit(classifier, dataloader, dataloader)
+
+    # the heads without learning rate don't learn anything
+    assert classifier.head_name(int(classifier.best_head)).startswith("lr1_")
+    metrics = trainer.callback_metrics
+    assert metrics["val_top1"] == metrics[f"val_top1_{classifier.head_name(int(classifier.best_head))}"]
+    assert metrics["val_top1"] > metrics["val_top1_lr0_wd0_seed0"]
+
+
+@pytest.mark.parametrize("solver", ["ridge", "lbfgs"])
+@pytest.mark.parametrize("multi_label", [False, True])
+def test_linear_solvers(tmp_path, solver: str, multi_label: bool):
+    rng = np.random.default_rng(0)
+    weight = rng.normal(size=(8, 3))
+    datasets = []
+    for split, num_variants in [("train", 2), ("val", 1)]:
+        features = rng.normal(size=(num_variants, 256, 8)).astype(np.float32)
+        logits = features[0] @ weight
+        labels = (logits > 0).astype(np.int64) if multi_label else logits.argmax(axis=1)
+        np.save(tmp_path / f"{split}_features.npy", features)
+        np.save(tmp_path / f"{split}_labels.npy", labels)
+        datasets.append(
+            FeatureDataset(tmp_path / f"{split}_features.npy", tmp_path / f"{split}_labels.npy")
+        )
+
+    metrics = fit_linear_probe(
+        solver, *datasets, None, 3, multi_label, device=torch.device("cpu")
+    )
+    assert metrics["val_top1"] > 0.8
+    assert "test_top1" not in metrics
+
+
+@pytest.mark.parametrize("bank_dtype", ["float16", "int8"])
+def test_knn_bank(tmp_path, monkeypatch, bank_dtype: str):
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(4, 16))
+    datasets = []
+    for split, num_samples in [("train", 1000), ("val", 100)]:
+        labels = rng.integers(0, 4, num_samples)
+        features = (centers[labels] + rng.normal(size=(num_samples, 16)))[None].astype(np.float32)
+        np.save(tmp_path / f"{split}_features.npy", features)
+        np.save(tmp_path / f"{split}_labels.npy", labels)
+        datasets.append(
+            FeatureDataset(tmp_path / f"{split}_features.npy", tmp_path / f"{split}_labels.npy")
+        )
+    train, val = datasets
+
+    # the blockwise search finds the same neighbors as a search over all train features
+    bank = load_knn_bank(train, bank_dtype)
+    queries = nn.functional.normalize(torch.from_numpy(val.features[0]), dim=1)
+    # blocks of 64 rows, the last one is smaller
+    monkeypatch.setattr(knn_bank, "KNN_BLOCK_SIZE", 64)
+    sims, _ = knn_search(bank, queries, k=10, device=torch.device("cpu"))
+    train_features = nn.functional.normalize(torch.from_numpy(train.features[0]), dim=1)
+    expected = (queries @ train_features.T).topk(10, dim=1).values
+    assert torch.allclose(sims, expected, atol=2e-2)
+
+    metrics = knn_evaluate(
+        train, val, 4, ks=[1, 20], temperatures=[0.01, 0.1], bank_dtype=bank_dtype, device=torch.device("cpu")
+    )
+    assert len(metrics) == 2 * 2 * 1
+    assert metrics["val_top1_k20_t0.1"] > 0.8
+    # with a single neighbor, the temperature doesn't matter
+    assert metrics["val_top1_k1_t0.01"] == metrics["val_top1_k1_t0.1"]
+
+
+def test_export_embeddings(tmp_path):
+    model = nn.Sequential(nn.Flatten(), nn.Linear(12, 4))
+    images = torch.randn(23, 3, 2, 2)
+    ids = [f"tile_{i}" for i in range(len(images))]
+    dataset = TensorDataset(images)
+
+    def export(progress: dict, start: int) -> int:
+        # the loader starts at the first sample of the first shard that is not completed
+        loader = DataLoader(Subset(dataset, range(start, len(dataset))), batch_size=5)
+        return export_embeddings(
+            model,
+            (batch[0] for batch in loader),
+            lambda start, end: ids[start:end],
+            len(images),
+            tmp_path,
+            progress,
+            shard_size=10,
+            format="npy",
+            embedding_dtype="float32",
+            device=torch.device("cpu"),
+            precision="32",
+        )
+
+    # resuming after the first shard only embeds the remaining samples
+    progress = {"metadata": {}, "completed": {}}
+    assert export(progress, 0) == 23
+    progress["completed"] = {"embeddings_00000.npy": progress["completed"]["embeddings_00000.npy"]}
+    assert export(progress, 10) == 13
+    assert len(progress["completed"]) == 3
+
+    embeddings = np.concatenate([np.load(tmp_path / f"embeddings_{i:05d}.npy") for i in range(3)])
+    exported_ids = np.concatenate([np.load(tmp_path / f"ids_{i:05d}.npy") for i in range(3)])
+    with torch.no_grad():
+        assert np.allclose(embeddings, model(images).numpy(), atol=1e-6)
+    assert exported_ids.tolist() == ids
+
+
+class _TransformModule(LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.train_transform = nn.Identity()
+        self.layer = nn.Linear(8, 1)
+
+    def training_step(self, batch, batch_idx):
+        with torch.no_grad():
+            x = self.train_transform(batch[0])
+        return self.layer(x).pow(2).mean()
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+def test_throughput_profiler(tmp_path):
+    profiler = ThroughputProfiler(every_n_steps=3, trace_steps=(1, 3), trace_dir=tmp_path)
+    trainer = Trainer(
+        max_epochs=1,
+        accelerator="cpu",
+        callbacks=[profiler],
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+    )
+    trainer.fit(_TransformModule(), DataLoader(TensorDataset(torch.randn(28, 8)), batch_size=4))
+
+    # 7 steps, a report every 3 steps
+    assert len(profiler.reports) == 2
+    report = profiler.reports[0]
+    assert report["profiler/samples_per_s"] > 0
+    assert report["profiler/augmentation_ms"] > 0
+    assert sum(report[f"profiler/{phase}_fraction"] for phase in PROFILER_PHASES) == pytest.approx(1)
+    assert (tmp_path / "trace_steps_1-3_rank0.json").exists()
+
+    # the trace also ends at its last step if it lies in the skipped steps
+    profiler = ThroughputProfiler(every_n_steps=3, skip_steps=5, trace_steps=(1, 3), trace_dir=tmp_path / "skip")
+    stop_steps = []
+    stop_trace = profiler._stop_trace
+    profiler._stop_trace = lambda trainer: (stop_steps.append(trainer.global_step), stop_trace(trainer))
+    trainer = Trainer(
+        max_epochs=1,
+        accelerator="cpu",
+        callbacks=[profiler],
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+    )
+    trainer.fit(_TransformModule(), DataLoader(TensorDataset(torch.randn(28, 8)), batch_size=4))
+    assert stop_steps == [3]
+
+
+def test_train_step_benchmark():
+    result = run_train_step(
+        "simclr", "resnet18", 4, "rgb", "biome", 64, warmup_steps=1, steps=2, precision="32-true"
+    )
+    assert result["samples_per_s"] > 0
+    assert result["step_ms"] == pytest.approx(sum(result[f"{phase}_ms"] for phase in PROFILER_PHASES))
+    assert result["backbone_parameters"] < result["parameters"]
+    assert result["activation_mb"] > 0